@@ -0,0 +1,311 @@
+import argparse
+import concurrent.futures
+import csv
+import glob
+import itertools
+import json
+import multiprocessing
+import os
+import random
+import time
+import traceback
+import typing
+
+import numpy
+
+import benchmark
+import deblur
+import image_io
+import lazy_import
+import noise
+import parallel
+import result_cache
+import settings
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+# A job file (JSON, or TOML on python 3.11+) looks like:
+#
+#   {
+#       "images": ["presets/normal/parrot.jpg", "presets/normal/*.png"],
+#       "blur": {"blur_type": "gaussian", "radius": 15},
+#       "settings": {"iterations": 50, "engine": "ghast"},
+#       "sweep": {"start_intensity": [2, 4, 6], "radius": [12, 15, 18]},
+#       "mode": "grid"
+#   }
+#
+# images are paths or glob patterns (relative to the current directory). They're taken to be blurred targets,
+# unless there's a "blur" section, in which case they're originals that get blurred with it first (and the
+# results are scored against them). "settings" are the deblur settings that every task
+# shares, and "sweep" gives the values to try for the ones that vary. Keys are anything deblur.create_deblurrer
+# accepts: iterations, blur_type, radius, any BlurSettings or SimulationSettings field, etc.
+#
+# In "grid" mode every combination of the sweep values is run. In "random" mode, "samples" combinations are
+# picked at random, and a sweep value can also be a range like {"min": 1.0, "max": 6.0} (ints if both ends are).
+# Other optional keys: "seed" (for the random picks & the simulation's noise), "output" (a directory),
+# "save_images" (default true), "thumbnail_size" (for the contact sheet) and "workers".
+
+GRID = "grid"
+RANDOM = "random"
+
+DEFAULT_OUTPUT_DIR = "userdata/batch"
+DEFAULT_THUMBNAIL_SIZE = 160
+
+
+def get_all_sweep_modes():
+    return [GRID, RANDOM]
+
+
+class Task:
+
+    def __init__(self, image_idx, image_path, combo_idx, deblur_kwargs: dict):
+        self.image_idx = image_idx
+        self.image_path = image_path
+        self.combo_idx = combo_idx
+        self.deblur_kwargs = deblur_kwargs
+        self.cost = 0  # rough relative cost, so the biggest tasks can be started first
+
+    def get_name(self):
+        # the image's index too, since images in different directories can have the same name
+        return f"{self.image_idx:03d}_{os.path.splitext(os.path.basename(self.image_path))[0]}_{self.combo_idx:03d}"
+
+
+def load_job(filepath) -> dict:
+    if filepath.lower().endswith(".toml"):
+        try:
+            import tomllib
+        except ImportError:
+            raise ValueError("TOML job files need python 3.11 or newer, use JSON instead")
+        with open(filepath, "rb") as f:
+            job = tomllib.load(f)
+    else:
+        with open(filepath, "r", encoding="utf-8") as f:
+            job = json.load(f)
+
+    if not job.get("images"):
+        raise ValueError("Job has no images")
+    if job.get("mode", GRID) not in get_all_sweep_modes():
+        raise ValueError(f"Unrecognized sweep mode: {job['mode']}")
+    return job
+
+
+def find_images(job: dict) -> typing.List[str]:
+    res = []
+    for pattern in job["images"]:
+        matches = sorted(glob.glob(pattern))
+        if len(matches) == 0:
+            raise ValueError(f"No images found for: {pattern}")
+        res.extend(matches)
+    return res
+
+
+def expand_sweep(job: dict) -> typing.List[dict]:
+    """
+        Returns the settings of each combination to run, in order.
+    """
+    base = dict(job.get("blur", {}))  # deblur with the same blur that made the targets, unless told otherwise
+    base.pop("max_radius", None)
+    base.update(job.get("settings", {}))
+
+    sweep = job.get("sweep", {})
+    keys = sorted(sweep.keys())
+    if job.get("mode", GRID) == GRID:
+        for key in keys:
+            if not isinstance(sweep[key], list):
+                raise ValueError(f"Grid sweeps need a list of values for: {key}")
+        combos = [dict(zip(keys, values)) for values in itertools.product(*(sweep[key] for key in keys))]
+    else:
+        rng = random.Random(job.get("seed", 0))
+        combos = [{key: _pick(rng, key, sweep[key]) for key in keys} for _ in range(int(job.get("samples", 10)))]
+
+    return [dict(base, **combo) for combo in combos]
+
+
+def _pick(rng: random.Random, key, values):
+    if isinstance(values, list):
+        return rng.choice(values)
+    elif isinstance(values, dict) and "min" in values and "max" in values:
+        if isinstance(values["min"], int) and isinstance(values["max"], int):
+            return rng.randint(values["min"], values["max"])
+        return rng.uniform(values["min"], values["max"])
+    raise ValueError(f"Random sweeps need a list or a {{\"min\", \"max\"}} range for: {key}")
+
+
+def make_tasks(images: typing.List[str], combos: typing.List[dict], seed=0) -> typing.List[Task]:
+    # unless the job gives a noise seed, each image gets its own stream spawned from the job's seed, so runs are
+    # repeatable (and cacheable). Every combination of an image shares its stream, so they only differ by settings.
+    noise_seeds = [src.get_seed() for src in noise.create_noise_source(noise.WHITE, seed).spawn(len(images))]
+
+    # each iteration is a few blurs, which scale with the image & the radius
+    combo_costs = []
+    for combo in combos:
+        sim = deblur.create_deblurrer(**combo)
+        combo_costs.append(sim.get_iteration_limit() * (1 + sim.deblur_settings.radius))
+
+    tasks = []
+    for image_idx, image_path in enumerate(images):
+        try:
+            w, h = image_io.read_image_size(image_path)
+        except (ValueError, OSError):
+            w, h = 0, 0  # the task will report it
+        for combo_idx, combo in enumerate(combos):
+            task = Task(image_idx, image_path, combo_idx, dict(combo))
+            task.deblur_kwargs.setdefault("noise_seed", noise_seeds[image_idx])
+            task.cost = w * h * combo_costs[combo_idx]
+            tasks.append(task)
+    return tasks
+
+
+def run_task(task: Task, blur: typing.Optional[dict], output_dir, save_images, thumbnail_size, use_cache) -> dict:
+    """
+        Runs a single task (in a worker process) and returns its row of the results table, plus a thumbnail.
+    """
+    original = image_io.read_image(task.image_path)
+    if blur is not None:
+        blur_settings = settings.BlurSettings()
+        blur_settings.load_dict(blur)
+        target = blur_settings.do_blur_array(original)
+    else:
+        target = original
+
+    cache = result_cache.ResultCache() if use_cache else None
+    sim = deblur.create_deblurrer(cache=cache, **task.deblur_kwargs)
+
+    start_time = time.perf_counter()
+    sim.set_target_image(target)
+    while sim.get_iteration() < sim.get_iteration_limit():
+        sim.step()
+    sim.flush_display()
+    elapsed = time.perf_counter() - start_time
+
+    output = sim.get_output_px()
+    res = {
+        "image": task.image_path,
+        "combo": task.combo_idx,
+        "iterations": sim.get_iteration(),
+        "error": round(sim.get_error(), 5),
+        "psnr": round(benchmark.psnr(output, original), 3) if blur is not None else "",
+        "seconds": round(elapsed, 3),
+        "output": ""
+    }
+
+    if save_images:
+        res["output"] = os.path.join(output_dir, f"{task.get_name()}.png")
+        image_io.write_image(res["output"], output, high_bit_depth=image_io.is_high_bit_depth(original))
+
+    h, w = output.shape[:2]
+    scale = min(1.0, thumbnail_size / max(w, h))
+    thumbnail = cv2.resize(image_io.to_uint8(output), (max(1, round(w * scale)), max(1, round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+    return {"row": res, "thumbnail": thumbnail}
+
+
+def run_job(job: dict, output_dir=None, workers=None, use_cache=True) -> typing.List[dict]:
+    """
+        Runs every task in a job across a pool of processes, and writes the results table (results.csv) and a
+        contact sheet (contact_sheet.png, a row per image and a column per combination) to the output directory.
+        Returns the table's rows.
+    """
+    images = find_images(job)
+    combos = expand_sweep(job)
+    for combo in combos:
+        # catches bad settings now, rather than once per task
+        if deblur.create_deblurrer(**combo).get_iteration_limit() <= 0:
+            raise ValueError(f"Every task needs a limited number of iterations, got: {combo}")
+
+    output_dir = output_dir or job.get("output") or os.path.join(DEFAULT_OUTPUT_DIR, job.get("name", "job"))
+    os.makedirs(output_dir, exist_ok=True)
+    save_images = job.get("save_images", True)
+    thumbnail_size = job.get("thumbnail_size", DEFAULT_THUMBNAIL_SIZE)
+    workers = workers or job.get("workers") or os.cpu_count() or 1
+
+    tasks = make_tasks(images, combos, seed=job.get("seed", 0))
+    tasks.sort(key=lambda t: t.cost, reverse=True)  # so a big one doesn't start last & leave the others idle
+    print(f"INFO: running {len(tasks)} tasks ({len(images)} images x {len(combos)} settings) on {workers} processes")
+
+    rows = [None] * len(tasks)
+    thumbnails = {}
+    start_time = time.perf_counter()
+    ctx = multiprocessing.get_context("spawn")
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=ctx, initializer=parallel.init_worker) as pool:
+        futures = {pool.submit(run_task, task, job.get("blur"), output_dir, save_images, thumbnail_size, use_cache):
+                   idx for idx, task in enumerate(tasks)}
+        for n_done, future in enumerate(concurrent.futures.as_completed(futures)):
+            task = tasks[futures[future]]
+            try:
+                res = future.result()
+            except Exception:
+                print(f"ERROR: task failed: {task.get_name()}")
+                traceback.print_exc()
+                continue
+            rows[futures[future]] = res["row"]
+            thumbnails[(task.image_idx, task.combo_idx)] = res["thumbnail"]
+            print(f"INFO: [{n_done + 1}/{len(tasks)}] {task.get_name()} error={res['row']['error']} "
+                  f"({res['row']['seconds']}s)")
+
+    # back into image & combo order, with the swept values spelled out
+    sweep_keys = sorted(job.get("sweep", {}).keys())
+    rows = [dict(row, **{key: task.deblur_kwargs[key] for key in sweep_keys})
+            for task, row in zip(tasks, rows) if row is not None]
+    rows.sort(key=lambda row: (images.index(row["image"]), row["combo"]))
+    write_results(os.path.join(output_dir, "results.csv"), rows, sweep_keys)
+
+    sheet = make_contact_sheet(thumbnails, len(images), len(combos), thumbnail_size)
+    if sheet is not None:
+        image_io.write_image(os.path.join(output_dir, "contact_sheet.png"), sheet)
+
+    print(f"INFO: finished {len(rows)}/{len(tasks)} tasks in {time.perf_counter() - start_time:.1f}s, "
+          f"results are in {output_dir}")
+    return rows
+
+
+def write_results(filepath, rows: typing.List[dict], sweep_keys):
+    stats = ["iterations", "error", "psnr", "seconds", "output"]
+    columns = ["image", "combo"] + [key for key in sweep_keys if key not in stats] + stats
+    with open(filepath, "w", newline="", encoding="utf-8") as f:
+        writer = csv.DictWriter(f, fieldnames=columns)
+        writer.writeheader()
+        writer.writerows(rows)
+
+
+def make_contact_sheet(thumbnails: typing.Dict[typing.Tuple[int, int], numpy.ndarray], n_images, n_combos,
+                       thumbnail_size, pad=4) -> typing.Optional[numpy.ndarray]:
+    if len(thumbnails) == 0:
+        return None
+    cell = thumbnail_size + pad
+    sheet = numpy.full((n_images * cell + pad, n_combos * cell + pad, 3), 32, dtype=numpy.uint8)
+    for (image_idx, combo_idx), thumbnail in thumbnails.items():
+        y = pad + image_idx * cell
+        x = pad + combo_idx * cell
+        h, w = thumbnail.shape[:2]
+        sheet[y:y + h, x:x + w] = thumbnail
+        # label each cell with its combo number, which is the results table's 'combo' column
+        cv2.putText(sheet, str(combo_idx), (x + 3, y + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (0, 0, 0), 3)
+        cv2.putText(sheet, str(combo_idx), (x + 3, y + 14), cv2.FONT_HERSHEY_SIMPLEX, 0.4, (255, 255, 255), 1)
+    return sheet
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Runs a parameter sweep described by a job file.")
+    parser.add_argument("job", help="a .json or .toml job file (see the top of batch.py for the format)")
+    parser.add_argument("--output", default=None, help=f"where to put the results (default: {DEFAULT_OUTPUT_DIR}/<job name>)")
+    parser.add_argument("--workers", type=int, default=None, help="how many processes to use (default: one per core)")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse (or store) finished results")
+    args = parser.parse_args(args)
+
+    try:
+        job = load_job(args.job)
+    except (ValueError, OSError) as e:
+        parser.error(f"couldn't load job: {e}")
+    job.setdefault("name", os.path.splitext(os.path.basename(args.job))[0])
+
+    try:
+        run_job(job, output_dir=args.output, workers=args.workers,
+                use_cache=not args.no_cache)
+    except (ValueError, TypeError) as e:
+        parser.error(str(e))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+import argparse
+import math
+import time
+
+import numpy
+
+import blurs
+import deblur
+import image_io
+import lazy_import
+import noise
+import settings
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+def psnr(a: numpy.ndarray, b: numpy.ndarray) -> float:
+    mse = float(numpy.mean((a.astype(numpy.float32) - b.astype(numpy.float32)) ** 2))
+    return math.inf if mse == 0 else 10 * math.log10(255 ** 2 / mse)
+
+
+def run_one(original: numpy.ndarray, blur_settings: 'settings.BlurSettings',
+            deblur_settings: 'settings.BlurSettings', sim_settings: 'settings.SimulationSettings'):
+    """
+        Blurs the original, deblurs it with the given settings, and returns the stats.
+    """
+    sim = deblur.SettingsControlledGhastDeblurrer(sim_settings, deblur_settings)
+    sim.set_target_image(blur_settings.do_blur_array(original))
+
+    errors = []
+    start_time = time.perf_counter()
+    while not sim.is_finished_iterating():
+        sim.step()
+        errors.append(sim.get_error())
+    elapsed = time.perf_counter() - start_time
+    sim.flush_display()
+
+    return {
+        "ms_per_iter": elapsed * 1000 / max(1, sim.get_iteration()),
+        "error": sim.get_error(),
+        "errors": errors,
+        "psnr": psnr(sim.get_output_image(), original)
+    }
+
+
+def iterations_to_reach(errors, target_error):
+    for i, err in enumerate(errors):
+        if err <= target_error:
+            return i + 1
+    return None
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Compares the speed & quality of the deblurring options.")
+    parser.add_argument("image", nargs="?", default="presets/normal/parrot.jpg")
+    parser.add_argument("--blur", default=blurs.GAUSSIAN, help=f"one of: {', '.join(blurs.get_all_blurs())}")
+    parser.add_argument("--radius", type=int, default=15)
+    parser.add_argument("--kernel", default=None, help="kernel file, for custom kernel blurs")
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--compare", choices=["backprojection", "intensity", "engine", "guess", "color", "tiles", "noise"],
+                        default="backprojection",
+                        help="which setting to vary (back-projection type, intensity curve, engine, initial guess, "
+                             "color mode, whether converged tiles are skipped, or noise type)")
+    parser.add_argument("--regularization", type=float, default=None, help="for the wiener & tikhonov initial guesses")
+    parser.add_argument("--seed", type=int, default=12345)
+    parser.add_argument("--max-size", type=int, default=512, help="shrink the image so its longer side is at most this")
+    args = parser.parse_args(args)
+
+    try:
+        original = image_io.read_image(args.image)
+    except (ValueError, OSError):
+        parser.error(f"couldn't read image: {args.image}")
+    h, w = original.shape[:2]
+    scale = args.max_size / max(w, h)
+    if scale < 1:
+        original = cv2.resize(original, (round(w * scale), round(h * scale)), interpolation=cv2.INTER_AREA)
+
+    blur_settings = settings.BlurSettings()
+    blur_settings.blur_type = args.blur.lower()
+    blur_settings.radius = args.radius
+    if args.kernel is not None:
+        blur_settings.bonus_params["kernel_path"] = args.kernel
+
+    sim_settings = settings.SimulationSettings()
+    sim_settings.iteration_limit = args.iterations
+    sim_settings.display_refresh_rate = 0
+    sim_settings.display_refresh_iterations = args.iterations  # we only care about the final frame
+    sim_settings.noise_seed = args.seed  # so that every run gets the same noise
+    if args.regularization is not None:
+        sim_settings.regularization = args.regularization
+
+    if args.compare == "backprojection":
+        options = blurs.get_all_backprojections()
+    elif args.compare == "intensity":
+        options = deblur.get_all_intensity_curves()
+    elif args.compare == "engine":
+        options = deblur.get_all_engines()
+    elif args.compare == "guess":
+        options = deblur.get_all_initial_guesses()
+    elif args.compare == "color":
+        options = deblur.get_all_color_modes()
+    elif args.compare == "tiles":
+        options = ["update all", "skip converged"]
+    else:
+        options = noise.get_all_noise_types()
+
+    print(f"{args.image} ({original.shape[1]}x{original.shape[0]}), "
+          f"{blur_settings.blur_type} r={blur_settings.radius}, {args.iterations} iterations")
+    print(f"{args.compare:<24}{'ms/iter':>10}{'error':>10}{'psnr':>10}{'iters':>8}")
+
+    # the 'iters' column is how long each option took to get as low as the first option's final error
+    baseline_error = None
+    for option in options:
+        deblur_settings = settings.BlurSettings()
+        deblur_settings.load_dict(blur_settings.to_dict())
+        option_sim_settings = settings.SimulationSettings()
+        option_sim_settings.load_dict(sim_settings.to_dict())
+        if args.compare == "backprojection":
+            deblur_settings.backpropagation_type = option
+        elif args.compare == "intensity":
+            option_sim_settings.intensity_curve = option
+        elif args.compare == "engine":
+            option_sim_settings.engine = option
+        elif args.compare == "guess":
+            option_sim_settings.initial_guess = option
+        elif args.compare == "color":
+            option_sim_settings.color_mode = option
+        elif args.compare == "tiles":
+            option_sim_settings.active_set = option == "skip converged"
+        else:
+            option_sim_settings.noise_type = option
+
+        res = run_one(original, blur_settings, deblur_settings, option_sim_settings)
+        if baseline_error is None:
+            baseline_error = res["error"]
+        iters = iterations_to_reach(res["errors"], baseline_error)
+        print(f"{option:<24}{res['ms_per_iter']:>10.2f}{res['error']:>10.3f}{res['psnr']:>10.2f}"
+              f"{iters if iters is not None else '-':>8}")
+
+
+if __name__ == "__main__":
+    main()
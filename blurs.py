@@ -1,21 +1,25 @@
-import pygame
-import cv2
+import collections
+import math
+import os
+import typing
 
+import numpy
 
-def box(img: pygame.Surface, radius, params=None) -> pygame.Surface:
+import lazy_import
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+def box_array(px: numpy.ndarray, radius, params=None) -> numpy.ndarray:
     """
-    Performs a "Box Filter" blur.
+    Performs a "Box Filter" blur on an array of pixels.
     """
-    res = img.copy()
-    px = pygame.surfarray.array3d(res)
-    cv2.blur(px, ksize=(radius, radius), dst=px)
-    pygame.surfarray.blit_array(res, px)
-    return res
+    return cv2.blur(px, ksize=(radius, radius))
 
 
-def gaussian(img: pygame.Surface, radius, params=None) -> pygame.Surface:
+def gaussian_array(px: numpy.ndarray, radius, params=None) -> numpy.ndarray:
     """
-    Performs a Gaussian blur.
+    Performs a Gaussian blur on an array of pixels.
     """
     # radius has to be odd or else cv2 will complain.
     r = radius if radius % 2 == 1 else radius + 1
@@ -25,46 +29,296 @@ def gaussian(img: pygame.Surface, radius, params=None) -> pygame.Surface:
     # can mean different things in two different apps.
     sigma = r / 2
 
-    res = img.copy()
-    px = pygame.surfarray.array3d(res)
-    cv2.GaussianBlur(px, (r, r), sigma, dst=px)
-    pygame.surfarray.blit_array(res, px)
-    return res
+    return cv2.GaussianBlur(px, (r, r), sigma)
 
 
-def median(img: pygame.Surface, radius, params=None):
+def median_array(px: numpy.ndarray, radius, params=None) -> numpy.ndarray:
     """
-        Performs a "Median" blur.
+        Performs a "Median" blur on an array of pixels, of any dtype.
     """
     # radius has to be odd or else cv2 will complain.
     r = radius if radius % 2 == 1 else radius + 1
 
-    res = img.copy()
-    px = pygame.surfarray.array3d(res)
-    cv2.medianBlur(px, r, dst=px)
-    pygame.surfarray.blit_array(res, px)
-    return res
+    if px.dtype == numpy.uint8:
+        # for big kernels, this is cv2's constant-time sliding histogram algorithm
+        return cv2.medianBlur(px, r)
+    elif r <= 5:
+        # cv2 takes uint16s & float32s (but nothing else) for small kernels
+        if px.dtype in (numpy.uint16, numpy.float32):
+            return cv2.medianBlur(px, r)
+        return cv2.medianBlur(px.astype(numpy.float32), r).astype(px.dtype)
+
+    # bigger kernels only take uint8s. But medians commute with monotonic functions, so anything that maps the
+    # values onto [0, 255] in order can go through the uint8 version
+    lo, hi = float(numpy.min(px)), float(numpy.max(px))
+    if hi <= lo:
+        return px.copy()
+    elif hi - lo <= 255 and (numpy.issubdtype(px.dtype, numpy.integer) or numpy.array_equal(px, numpy.rint(px))):
+        # whole numbers that fit in 256 levels, so this is exact
+        return (cv2.medianBlur((px - lo).astype(numpy.uint8), r) + lo).astype(px.dtype)
+    else:
+        # otherwise it's approximate. The array's actual range is stretched onto [0, 255], which is much more
+        # precise than rounding, since error images tend to have a pretty small range.
+        scale = (hi - lo) / 255
+        px_uint8 = numpy.rint((px - lo) / scale).astype(numpy.uint8)
+        res = cv2.medianBlur(px_uint8, r).astype(numpy.float32)
+        res *= scale
+        res += lo
+        if numpy.issubdtype(px.dtype, numpy.integer):
+            res = numpy.rint(res)
+        return res.astype(px.dtype)
+
+
+def custom_kernel_array(px: numpy.ndarray, radius, params=None) -> numpy.ndarray:
+    """
+    Convolves an array of pixels with an arbitrary kernel (a.k.a. point spread function), which is
+    rescaled so that its longer side is (2 * radius + 1) pixels.
+
+    The kernel comes from params["kernel"] (an array) or params["kernel_path"] (see load_kernel).
+    """
+    return _apply_custom_kernel(px, radius, params, adjoint=False)
+
+
+def custom_kernel_adjoint_array(px: numpy.ndarray, radius, params=None) -> numpy.ndarray:
+    """
+    Convolves an array of pixels with the adjoint of a custom kernel (i.e. the kernel rotated 180 degrees).
+    """
+    return _apply_custom_kernel(px, radius, params, adjoint=True)
+
+
+def _apply_custom_kernel(px: numpy.ndarray, radius, params, adjoint=False) -> numpy.ndarray:
+    kernel = _get_kernel(params)
+    plan = _get_kernel_plan(kernel, radius, params.get("kernel_tolerance", 1e-3), adjoint=adjoint)
+
+    src = px if px.dtype == numpy.float32 else px.astype(numpy.float32)
+    res = plan.apply(src)
+
+    if px.dtype == numpy.uint8:
+        return numpy.clip(numpy.rint(res), 0, 255).astype(numpy.uint8)
+    return res.astype(px.dtype, copy=False)
+
+
+def load_kernel(filepath) -> numpy.ndarray:
+    """
+        Loads a kernel from a .npy file or an image (where brighter = more weight). The result is
+        odd-sized and normalized to sum to 1.
+    """
+    if filepath.lower().endswith(".npy"):
+        kernel = numpy.load(filepath).astype(numpy.float32)
+    else:
+        kernel = cv2.imread(filepath, cv2.IMREAD_GRAYSCALE | cv2.IMREAD_ANYDEPTH)
+        if kernel is None:
+            raise ValueError(f"Couldn't read kernel image: {filepath}")
+        kernel = kernel.astype(numpy.float32)
+
+    if kernel.ndim == 3:
+        kernel = kernel.mean(axis=2)
+    if kernel.ndim != 2 or kernel.size == 0:
+        raise ValueError(f"Kernel must be a 2D array, instead got shape {kernel.shape}")
+    if numpy.any(kernel < 0) or kernel.sum() <= 0:
+        raise ValueError("Kernel must be non-negative and non-zero")
+
+    # pad to odd dimensions so the kernel has a center pixel
+    kh, kw = kernel.shape
+    kernel = numpy.pad(kernel, ((0, 1 - kh % 2), (0, 1 - kw % 2)))
+    return kernel / kernel.sum()
+
+
+def get_kernel(name, radius, params=None) -> typing.Optional[numpy.ndarray]:
+    """
+        Returns the 2D kernel that the given blur convolves with (centered at [h // 2, w // 2]), or None if the
+        radius is 0. Median filters aren't convolutions at all, so a box filter is used as the closest match.
+    """
+    name = name.lower() if isinstance(name, str) else name
+    if radius <= 0:
+        return None
+    elif name == BOX_FILTER or name == MEDIAN:
+        r = radius if name == BOX_FILTER else (radius if radius % 2 == 1 else radius + 1)
+        return numpy.full((r, r), 1 / (r * r), dtype=numpy.float32)
+    elif name == GAUSSIAN:
+        r = radius if radius % 2 == 1 else radius + 1
+        vec = cv2.getGaussianKernel(r, r / 2, ktype=cv2.CV_32F)  # same as gaussian_array
+        return vec @ vec.T
+    elif name == CUSTOM_KERNEL:
+        return _get_kernel_plan(_get_kernel(params), radius, params.get("kernel_tolerance", 1e-3)).kernel
+    else:
+        raise ValueError(f"Unrecognized blur style: {name}")
+
+
+def get_kernel_radius(kernel: numpy.ndarray) -> int:
+    return (max(kernel.shape) - 1) // 2
+
+
+_LOADED_KERNELS = {}  # (path, mtime) -> kernel
+
+
+def _get_kernel(params) -> numpy.ndarray:
+    if params and params.get("kernel") is not None:
+        return params["kernel"]
+    elif params and params.get("kernel_path"):
+        path = params["kernel_path"]
+        key = (path, os.path.getmtime(path))
+        if key not in _LOADED_KERNELS:
+            _LOADED_KERNELS.clear()  # one at a time is plenty
+            _LOADED_KERNELS[key] = load_kernel(path)
+        return _LOADED_KERNELS[key]
+    else:
+        raise ValueError("Custom kernel blur requires a kernel (or kernel_path) param")
+
+
+class _KernelPlan:
+    """
+    A kernel, resized for a particular radius, plus the cheapest way we know to convolve with it.
+    Dense 2D convolution with a big kernel is way too slow, so it's either a sum of a few separable
+    rank-1 filters (from an SVD), or an FFT-based convolution, whichever is estimated to be cheaper.
+    """
+
+    # rough per-pixel costs, in units of "one multiply-add per pixel", measured against cv2.sepFilter2D
+    # and cv2.filter2D (which switches to a DFT for large kernels) on a 1000x1000x3 float32 image.
+    FFT_COST_PER_LOG2_KERNEL_AREA = 12
+    MAX_SEPARABLE_RANK = 16
+
+    def __init__(self, kernel: numpy.ndarray, tolerance: float):
+        self.kernel = kernel
+        kh, kw = kernel.shape
+
+        u, s, vt = numpy.linalg.svd(kernel.astype(numpy.float64))
+        total_energy = numpy.sum(s ** 2)
+        rank = len(s)
+        for r in range(1, min(len(s), _KernelPlan.MAX_SEPARABLE_RANK) + 1):
+            if numpy.sqrt(numpy.sum(s[r:] ** 2) / total_energy) <= tolerance:
+                rank = r
+                break
+
+        if rank <= _KernelPlan.MAX_SEPARABLE_RANK:
+            # cv2 filters do correlation, not convolution, so the vectors are flipped.
+            self.separable = [((u[::-1, i] * s[i]).astype(numpy.float32), vt[i, ::-1].astype(numpy.float32))
+                              for i in range(rank)]
+            self.separable_cost = rank * (kh + kw)
+        else:
+            self.separable = None
+            self.separable_cost = float("inf")
+
+        self.fft_cost = _KernelPlan.FFT_COST_PER_LOG2_KERNEL_AREA * math.log2(max(2, kh * kw))
+        self.flipped = numpy.ascontiguousarray(kernel[::-1, ::-1], dtype=numpy.float32)
+
+    def uses_fft(self) -> bool:
+        return self.fft_cost < self.separable_cost
+
+    def apply(self, px: numpy.ndarray) -> numpy.ndarray:
+        if self.uses_fft():
+            # for kernels this big, filter2D does the convolution in the frequency domain
+            return cv2.filter2D(px, -1, self.flipped, borderType=cv2.BORDER_REFLECT_101)
+        else:
+            res = None
+            for col_vec, row_vec in self.separable:
+                term = cv2.sepFilter2D(px, -1, row_vec, col_vec, borderType=cv2.BORDER_REFLECT_101)
+                if res is None:
+                    res = term
+                else:
+                    res += term
+            return res
+
+
+_KERNEL_PLANS = collections.OrderedDict()  # (id(kernel), radius, tolerance, adjoint) -> (kernel, _KernelPlan)
+_MAX_KERNEL_PLANS = 8
+
+
+def _get_kernel_plan(kernel: numpy.ndarray, radius, tolerance, adjoint=False) -> _KernelPlan:
+    key = (id(kernel), radius, tolerance, adjoint)
+    if key in _KERNEL_PLANS and _KERNEL_PLANS[key][0] is kernel:
+        _KERNEL_PLANS.move_to_end(key)
+        return _KERNEL_PLANS[key][1]
+
+    kh, kw = kernel.shape
+    size = 2 * radius + 1
+    if max(kh, kw) != size:
+        scale = size / max(kh, kw)
+        new_h = max(1, int(round(kh * scale)) // 2 * 2 + 1)
+        new_w = max(1, int(round(kw * scale)) // 2 * 2 + 1)
+        interpolation = cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR
+        resized = cv2.resize(kernel.astype(numpy.float32), (new_w, new_h), interpolation=interpolation)
+        resized = numpy.maximum(resized, 0)
+        resized /= resized.sum()
+    else:
+        resized = kernel
+
+    if adjoint:
+        resized = resized[::-1, ::-1]
+
+    plan = _KernelPlan(resized, tolerance)
+    _KERNEL_PLANS[key] = (kernel, plan)  # holding onto the kernel keeps its id() from being reused
+    while len(_KERNEL_PLANS) > _MAX_KERNEL_PLANS:
+        _KERNEL_PLANS.popitem(last=False)
+    return plan
 
 
 BOX_FILTER = "box filter"
 GAUSSIAN = "gaussian"
 MEDIAN = "median filter"
+CUSTOM_KERNEL = "custom kernel"
+
+# back-projection types (in addition to the blurs themselves)
+SAME_AS_BLUR = "same as blur"
+ADJOINT = "adjoint"
+CHEAPEST = "cheapest"
+
+
+_ALL_ARRAY_BLURS = {
+    BOX_FILTER: box_array,
+    GAUSSIAN: gaussian_array,
+    MEDIAN: median_array,
+    CUSTOM_KERNEL: custom_kernel_array
+}
+
 
+# the adjoint of each blur, where that's meaningful. Box & gaussian are symmetric so they're their own
+# adjoints. Median isn't linear so it doesn't have one, a box filter is the closest cheap stand-in.
+_ADJOINT_ARRAY_BLURS = {
+    BOX_FILTER: box_array,
+    GAUSSIAN: gaussian_array,
+    MEDIAN: box_array,
+    CUSTOM_KERNEL: custom_kernel_adjoint_array
+}
 
-_ALL_BLURS = {
-    BOX_FILTER: box,
-    GAUSSIAN: gaussian,
-    MEDIAN: median
+# pairs expensive forward blurs with cheap back-projections that still converge well. Blurs that aren't listed
+# are already cheap, and just use themselves.
+CHEAP_BACKPROJECTIONS = {
+    MEDIAN: BOX_FILTER,
+    CUSTOM_KERNEL: GAUSSIAN
 }
 
 
+def get_all_backprojections():
+    return [SAME_AS_BLUR, CHEAPEST, ADJOINT, BOX_FILTER, GAUSSIAN]
+
+
 def get_all_blurs():
-    return list(_ALL_BLURS.keys())
+    return list(_ALL_ARRAY_BLURS.keys())
 
 
-def get_blur_func(name):
+def get_array_blur_func(name):
     name = name.lower() if isinstance(name, str) else name
-    if name in _ALL_BLURS:
-        return _ALL_BLURS[name]
+    if name in _ALL_ARRAY_BLURS:
+        return _ALL_ARRAY_BLURS[name]
     else:
         raise ValueError(f"Unrecognized blur style: {name}")
+
+
+def get_backprojection_func(name, blur_name):
+    """
+        Returns the array function to use for back-propagating error, for a deblur using the given blur type.
+    """
+    name = name.lower() if isinstance(name, str) else name
+    blur_name = blur_name.lower() if isinstance(blur_name, str) else blur_name
+    if name is None or name == SAME_AS_BLUR:
+        return get_array_blur_func(blur_name)
+    elif name == CHEAPEST:
+        return get_array_blur_func(CHEAP_BACKPROJECTIONS.get(blur_name, blur_name))
+    elif name == ADJOINT:
+        if blur_name in _ADJOINT_ARRAY_BLURS:
+            return _ADJOINT_ARRAY_BLURS[blur_name]
+        else:
+            raise ValueError(f"Unrecognized blur style: {blur_name}")
+    else:
+        return get_array_blur_func(name)
@@ -1,38 +1,101 @@
-import cv2
 import numpy
-import pygame
 import blurs
+import lazy_import
+import noise
+import result_cache
+import settings
 import typing
 import math
+import time
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+_EPSILON = 1e-3
+
+# part of every result cache key. Bump it whenever a change makes the same settings give a different result.
+ENGINE_VERSION = 1
+
+# correction intensity schedules
+LINEAR = "linear"  # goes from the start intensity to the end intensity over the iteration limit
+BACKTRACKING = "backtracking"  # starts at the start intensity, steps that make the error worse are undone & retried more gently
+ADAPTIVE = "adaptive"  # like backtracking, but also ramps the intensity up while the error keeps going down
+MOMENTUM = "momentum"  # like backtracking, but each correction carries on some of the previous one
+
+
+def get_all_intensity_curves():
+    return [LINEAR, BACKTRACKING, ADAPTIVE, MOMENTUM]
+
+
+# engines, i.e. how each iteration updates the image
+GHAST = "ghast"  # randomized corrections by the blurred error (see README)
+RICHARDSON_LUCY = "richardson-lucy"  # multiplicative updates, the classic choice for gaussian-ish blurs
+LANDWEBER = "landweber"  # steepest descent on the squared error, with an exact line search
+
+
+def get_all_engines():
+    return [GHAST, RICHARDSON_LUCY, LANDWEBER]
+
+
+# initial guesses
+BLURRED = "blurred"  # just the target image
+WIENER = "wiener"  # a one-shot FFT deconvolution of the target, which damps every frequency equally
+TIKHONOV = "tikhonov"  # like WIENER, but it damps the high frequencies more, so it rings less
+
+
+def get_all_initial_guesses():
+    return [BLURRED, WIENER, TIKHONOV]
+
+
+# color modes
+RGB = "rgb"  # all three channels are deblurred at full resolution
+LUMINANCE = "luminance"  # only the luminance is deblurred, the chroma is left blurry (which is hard to notice)
+LUMINANCE_HALF_CHROMA = "luminance + half chroma"  # same, but the chroma gets a one-shot deconvolution at half size
+
+
+def get_all_color_modes():
+    return [RGB, LUMINANCE, LUMINANCE_HALF_CHROMA]
 
 
 class AbstractIterativeDeblurrer:
+    """
+    Images come out as uint8 arrays of shape (height, width, 3), so that nothing here depends on pygame. The UI
+    wraps them in Surfaces for display (see ui.array_to_surface). Targets can also be float arrays in [0, 255], which
+    is how high bit depth images keep their precision (see image_io).
+    """
 
     def __init__(self):
         pass
 
-    def get_target_image(self) -> pygame.Surface:
+    def get_target_image(self) -> numpy.ndarray:
         raise NotImplementedError()
 
-    def set_target_image(self, surf: pygame.Surface):
+    def set_target_image(self, px: typing.Optional[numpy.ndarray], keep_image=False):
+        """
+            If keep_image is set, the current image (if it's the right size) is used as the starting point
+            for the new target, rather than the initial guess, and the region (if any) is kept.
+        """
         raise NotImplementedError()
 
-    def get_output_image(self) -> pygame.Surface:
+    def get_output_image(self) -> numpy.ndarray:
         raise NotImplementedError()
 
-    def get_blurred_output_image(self) -> pygame.Surface:
+    def get_blurred_output_image(self) -> numpy.ndarray:
         raise NotImplementedError()
 
-    def get_initial_guess(self) -> pygame.Surface:
+    def get_initial_guess(self) -> numpy.ndarray:
         target = self.get_target_image()
         return None if target is None else target.copy()
 
-    def do_blur(self, surf: pygame.Surface, strength=1.0) -> pygame.Surface:
+    def do_blur(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
         raise NotImplementedError()
 
-    def get_error_image(self) -> typing.Optional[pygame.Surface]:
+    def get_error_image(self) -> typing.Optional[numpy.ndarray]:
         return None
 
+    def set_error_image_wanted(self, wanted: bool):
+        pass  # for deblurrers that can skip making error images while nobody's looking at them
+
     def get_error(self) -> float:
         raise NotImplementedError()
 
@@ -42,6 +105,16 @@ class AbstractIterativeDeblurrer:
     def get_iteration(self) -> int:
         raise NotImplementedError()
 
+    def set_region(self, rect: typing.Optional[typing.Tuple[int, int, int, int]]):
+        """
+            Restricts the deblurring to a rectangle (x, y, w, h) of the target, for quick previews. The rest of
+            the output shows the target as-is. None means the whole image. Takes effect on the next reset().
+        """
+        raise NotImplementedError()
+
+    def get_region(self) -> typing.Optional[typing.Tuple[int, int, int, int]]:
+        return None
+
     def is_finished_iterating(self):
         return self.get_iteration() >= self.get_iteration_limit() > 0
 
@@ -51,158 +124,846 @@ class AbstractIterativeDeblurrer:
     def reset(self):
         raise NotImplementedError()
 
+    def poll(self):
+        pass  # called once per frame by the UI, for deblurrers that do their work asynchronously
+
+    def close(self):
+        pass
+
+    def get_stats(self) -> typing.Dict[str, float]:
+        return {}
+
 
 class AbstractIterativeGhastDeblurrer(AbstractIterativeDeblurrer):
+    """
+    The iteration itself works on float arrays of shape (height, width, 3), or (height, width) in the luminance
+    color modes. Those only get converted into images when a new frame is published for display, which happens
+    at most as often as the display refresh policy allows (see get_display_refresh_iterations &
+    get_display_refresh_rate).
+    """
 
     def __init__(self):
         super().__init__()
         self.target = None
+        self.full_target_px: typing.Optional[numpy.ndarray] = None
+        self.target_rgb_px: typing.Optional[numpy.ndarray] = None  # just the region + halo, if there's a region
+        self.target_px: typing.Optional[numpy.ndarray] = None  # just the luminance, in the luminance color modes
 
-        self.img: typing.Optional[pygame.Surface] = None
+        # in the luminance color modes, the chroma channels (Cr, Cb) of the output & blurred output. They don't
+        # change while iterating.
+        self.chroma_px: typing.Optional[numpy.ndarray] = None
+        self.blurred_chroma_px: typing.Optional[numpy.ndarray] = None
+
+        self.img_px: typing.Optional[numpy.ndarray] = None
         self.iter_count = 0
 
         self.current_error = -1.0
-        self.blurred_img = None
-        self.target_minus_blurred_img = None
-        self.target_minus_blurred_img_blurred = None
-        self.blurred_img_minus_target = None
-        self.blurred_img_minus_target_blurred = None
-        self.combined_error_image = None
+        self.error_history = []  # the error after each iteration
+        self.blurred_img_px = None
+        self.error_px = None  # abs(target - blurred_img)
 
-        self.reset()
+        self._target_hash = None
+        self._run_key = None  # the result cache key of the current run, if it should be cached once it finishes
+
+        # the latest published frame. A new array is made for each one, so they're safe to hold onto.
+        self.img: typing.Optional[numpy.ndarray] = None
+        self.blurred_img: typing.Optional[numpy.ndarray] = None
+        self.published_frame_count = 0
+        self._published_error_px = None
+        self._published_error_img = None  # only built when someone asks for it (it's not needed to iterate)
+        self._last_publish_time = 0.0
+        self._iters_since_publish = 0
+        self._stepped_since_poll = False
+
+        self._region = None
+        self._crop = None  # (x0, y0, x1, y1) of the area that's actually deblurred: the region plus a halo
+        self._base_imgs = None  # full-size images that the region gets composited onto (output, blurred, error)
+
+        self._noise: typing.Optional[noise.NoiseSource] = None
+        self._noise_key = None  # what the noise source was made for (see get_noise_key)
+        self._noise_buffer = numpy.empty(0, dtype=numpy.float32)  # reused between iterations
+
+        # state of the active set (per-tile mean error and mean update, or None if they need a full pass)
+        self._tile_error = None
+        self._tile_update = None
+
+        # state of the adaptive intensity schedules
+        self._intensity = None
+        self._velocity = None
+
+        self._stats = {"compute_ms": 0.0, "display_ms": 0.0}
 
-    def set_target_image(self, surf: pygame.Surface):
-        self.target = surf
         self.reset()
 
-    def get_target_image(self) -> pygame.Surface:
+    def set_target_image(self, px, keep_image=False):
+        same_size = px is not None and self.full_target_px is not None and px.shape == self.full_target_px.shape
+        self.target = None if px is None else to_image(px)
+        self.full_target_px = None if px is None else px.astype(numpy.float32)  # not rounded, for 16-bit images
+        self._target_hash = None
+        if not (keep_image and same_size):
+            self._region = None
+        self.reset(img=not keep_image)
+
+    def get_target_image(self):
         return self.target
 
-    def get_output_image(self) -> pygame.Surface:
+    def get_output_image(self):
         return self.img
 
+    def get_output_px(self) -> typing.Optional[numpy.ndarray]:
+        """
+            The current output as a float32 array in [0, 255], i.e. without being rounded to 8 bits.
+        """
+        if self.img_px is None:
+            return None
+        px = numpy.clip(self._to_rgb(self.img_px, self.chroma_px), 0, 255)
+        if self._crop is None:
+            return px
+        x, y, rw, rh = self._region
+        x0, y0 = self._crop[:2]
+        res = self.full_target_px.copy()
+        res[y:y + rh, x:x + rw] = px[y - y0:y - y0 + rh, x - x0:x - x0 + rw]
+        return res
+
+    def get_initial_guess(self):
+        return None if self.full_target_px is None else self.full_target_px.copy()
+
     def get_blurred_output_image(self):
         return self.blurred_img
 
     def get_error_image(self):
-        return self.combined_error_image
+        if self._published_error_img is None and self._published_error_px is not None:
+            start_time = time.perf_counter()
+            self._published_error_img = self._build_error_image(self._published_error_px)
+            self._add_stat("display_ms", (time.perf_counter() - start_time) * 1000)
+        return self._published_error_img
 
     def get_error(self) -> float:
         return self.current_error
 
+    def get_stats(self) -> typing.Dict[str, float]:
+        return dict(self._stats)
+
     def get_correction_intensity(self, iteration):
         raise NotImplementedError()
 
+    def get_engine(self) -> str:
+        return GHAST
+
+    def get_initial_guess_style(self) -> str:
+        return BLURRED
+
+    def get_regularization(self) -> float:
+        return 0.01  # for the WIENER & TIKHONOV initial guesses
+
+    def get_blur_kernel(self, strength=1.0) -> typing.Optional[numpy.ndarray]:
+        return None  # needed for the WIENER & TIKHONOV initial guesses, and LUMINANCE_HALF_CHROMA
+
+    def get_color_mode(self) -> str:
+        return RGB
+
+    def create_noise_source(self) -> noise.NoiseSource:
+        return noise.GeneratorNoise()
+
+    def get_noise_key(self) -> typing.Optional[str]:
+        # the noise source is only made again when this changes (or the run starts from scratch), so that
+        # resets which don't start the run over carry on with the same stream
+        return None
+
+    def get_result_cache(self) -> typing.Optional[result_cache.ResultCache]:
+        return None
+
+    def get_cache_settings(self) -> typing.Optional[dict]:
+        # everything (other than the target) that the result depends on, or None if it shouldn't be cached
+        return None
+
+    def get_blur_halo(self) -> int:
+        # how far outside a region (or tile) we need to look to deblur it correctly. Anything closer to the
+        # edge of a crop than this gets thrown away.
+        return 0
+
+    def is_active_set_enabled(self) -> bool:
+        return False  # whether to skip tiles that have converged
+
+    def get_tile_size(self) -> int:
+        return 64
+
+    def get_freeze_threshold(self) -> float:
+        return 0.25  # tiles whose mean error and mean update are both below this get skipped
+
+    def get_full_pass_interval(self) -> int:
+        return 10  # every N iterations, all the tiles get updated anyway (in case a skipped one needs it)
+
+    def set_region(self, rect):
+        self._region = None if rect is None else tuple(int(v) for v in rect)
+
+    def get_region(self):
+        return self._region
+
+    def get_intensity_curve(self) -> str:
+        return LINEAR
+
+    def get_intensity_growth(self) -> float:
+        return 1.1  # used by ADAPTIVE, after each step that reduces the error
+
+    def get_intensity_backoff(self) -> float:
+        return 0.5  # used by all the non-linear curves, after each step that increases the error
+
+    def get_min_intensity(self) -> float:
+        return 0.05
+
+    def get_momentum(self) -> float:
+        return 0.6
+
     def get_backpropagation_blur_strength(self) -> float:
         return 1.0
 
+    def do_blur_array(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        raise NotImplementedError()
+
+    def do_backpropagation_blur_array(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        # the error doesn't have to be back-propagated with the same blur as the forward model,
+        # a cheaper approximation is often good enough.
+        return self.do_blur_array(px, strength=strength)
+
     def show_relative_error(self):
         raise NotImplementedError()
 
+    def get_display_refresh_iterations(self) -> int:
+        return 1
+
+    def get_display_refresh_rate(self) -> float:
+        return 0  # no limit
+
     def get_iteration(self) -> int:
         return self.iter_count
 
     def step(self):
-        if self.img is None:
+        if self.img_px is None:
             return
 
-        if None in (self.target_minus_blurred_img_blurred, self.blurred_img_minus_target_blurred):
+        start_time = time.perf_counter()
+
+        if self.error_px is None:
             self._calc_derived_images()
 
-        blur_dist_array = pygame.surfarray.pixels3d(self.target_minus_blurred_img_blurred)
-        blur_anti_dist_array = pygame.surfarray.pixels3d(self.blurred_img_minus_target_blurred)
-        correction_intensity = self.get_correction_intensity(self.iter_count)
+        engine = self.get_engine()
+        if engine == GHAST and self.is_active_set_enabled() and self.get_intensity_curve() == LINEAR:
+            self._active_set_iteration()
+        elif engine == GHAST:
+            self._ghast_iteration()
+        elif engine == RICHARDSON_LUCY:
+            self._richardson_lucy_iteration()
+        elif engine == LANDWEBER:
+            self._landweber_iteration()
+        else:
+            raise ValueError(f"Unrecognized engine: {engine}")
 
-        new_img_int8 = pygame.surfarray.array3d(self.img)
-        new_img = new_img_int8.astype(numpy.float64)
-        rand = numpy.random.rand(*new_img.shape)
+        self.iter_count += 1
+        self.error_history.append(self.current_error)
+        self._iters_since_publish += 1
+        self._stepped_since_poll = True
 
-        new_img[:] = new_img + blur_dist_array * (rand * correction_intensity)
-        new_img[:] = new_img - blur_anti_dist_array * (rand * correction_intensity)
-        new_img[:] = numpy.minimum(new_img, 255)
-        new_img[:] = numpy.maximum(new_img, 0)
+        if self._run_key is not None and self.is_finished_iterating():
+            self._store_result()
 
-        new_img_int8[:] = new_img.astype(numpy.int8, casting='unsafe')
-        pygame.surfarray.blit_array(self.img, new_img_int8)
+        self._add_stat("compute_ms", (time.perf_counter() - start_time) * 1000)
 
+        self._maybe_publish(force=self.is_finished_iterating())
+
+    def _ghast_iteration(self):
+        target_minus_blurred_img_blurred, blurred_img_minus_target_blurred = self._calc_backpropagated_error()
+        curve = self.get_intensity_curve()
+        if curve == LINEAR:
+            correction_intensity = self.get_correction_intensity(self.iter_count)
+        else:
+            if self._intensity is None:
+                self._intensity = self.get_correction_intensity(0)
+            correction_intensity = self._intensity
+
+        correction = target_minus_blurred_img_blurred - blurred_img_minus_target_blurred
+        rand = self._get_noise(self.img_px.shape)
+        rand *= correction_intensity
+        correction *= rand
+
+        if curve == LINEAR:
+            self.img_px += correction
+            numpy.clip(self.img_px, 0, 255, out=self.img_px)
+            self._calc_derived_images()
+        else:
+            self._adaptive_step(curve, correction)
+
+    def _active_set_iteration(self):
+        # like _ghast_iteration, but only tiles that are still changing get updated (along with a halo
+        # around them, which is needed to compute the blurs correctly).
+        tile_size = self.get_tile_size()
+        h, w = self.img_px.shape[:2]
+        if self._tile_error is None or self.iter_count % max(1, self.get_full_pass_interval()) == 0:
+            boxes = [(0, 0, w, h)]
+        else:
+            threshold = self.get_freeze_threshold()
+            boxes = _get_strips((self._tile_error > threshold) | (self._tile_update > threshold), tile_size, (w, h))
+        if self._tile_update is None:
+            self._tile_update = numpy.zeros((-(-h // tile_size), -(-w // tile_size)), dtype=numpy.float32)
+
+        correction_intensity = self.get_correction_intensity(self.iter_count)
+        halo = self.get_blur_halo()
+        bp_blur_strength = self.get_backpropagation_blur_strength()
+
+        # the corrections all have to be computed before any of them get applied, since the strips' halos overlap
+        corrections = []
+        for x0, y0, x1, y1 in boxes:
+            wx0, wy0, wx1, wy1 = max(0, x0 - halo), max(0, y0 - halo), min(w, x1 + halo), min(h, y1 + halo)
+            diff = self.target_px[wy0:wy1, wx0:wx1] - self.blurred_img_px[wy0:wy1, wx0:wx1]
+            correction = (self.do_backpropagation_blur_array(numpy.maximum(diff, 0), strength=bp_blur_strength) -
+                          self.do_backpropagation_blur_array(numpy.maximum(-diff, 0), strength=bp_blur_strength))
+            correction = correction[y0 - wy0:y1 - wy0, x0 - wx0:x1 - wx0]
+            rand = self._get_noise(correction.shape)
+            rand *= correction_intensity
+            correction *= rand
+            corrections.append(correction)
+
+        for (x0, y0, x1, y1), correction in zip(boxes, corrections):
+            img = self.img_px[y0:y1, x0:x1]
+            img += correction
+            numpy.clip(img, 0, 255, out=img)
+            self._tile_update[y0 // tile_size:-(-y1 // tile_size), x0 // tile_size:-(-x1 // tile_size)] = \
+                _tile_means(numpy.abs(correction), tile_size)
+
+        if len(boxes) == 1 and boxes[0] == (0, 0, w, h):
+            self._calc_derived_images()
+        else:
+            # a changed pixel affects the blurred image up to a radius away, which in turn needs pixels up to
+            # another radius away to compute. Hence the halo is two radii.
+            reach = halo // 2
+            if self.error_px is self._published_error_px:
+                self.error_px = self.error_px.copy()  # the published frame's error image is built from it later
+            for x0, y0, x1, y1 in boxes:
+                rx0, ry0, rx1, ry1 = max(0, x0 - reach), max(0, y0 - reach), min(w, x1 + reach), min(h, y1 + reach)
+                wx0, wy0, wx1, wy1 = max(0, x0 - halo), max(0, y0 - halo), min(w, x1 + halo), min(h, y1 + halo)
+                blurred = self.do_blur_array(self.img_px[wy0:wy1, wx0:wx1])
+                self.blurred_img_px[ry0:ry1, rx0:rx1] = blurred[ry0 - wy0:ry1 - wy0, rx0 - wx0:rx1 - wx0]
+                self.error_px[ry0:ry1, rx0:rx1] = self._calc_error_px(ry0, ry1, rx0, rx1)
+            self.current_error = float(numpy.mean(self.error_px))
+
+        self._tile_error = _tile_means(self.error_px, tile_size)
+
+    def _get_noise(self, shape) -> numpy.ndarray:
+        # the returned array is only valid until the next call
+        size = math.prod(shape)
+        if self._noise_buffer.size < size:
+            self._noise_buffer = numpy.empty(size, dtype=numpy.float32)
+        return self._noise.fill(self._noise_buffer[:size].reshape(shape))
+
+    def _richardson_lucy_iteration(self):
+        # x *= H^T(y / Hx). The blurs are all normalized, so H^T(1) = 1 and there's nothing else to divide by.
+        ratio = self.target_px / numpy.maximum(self.blurred_img_px, _EPSILON)
+        self.img_px *= self.do_backpropagation_blur_array(ratio)
+        numpy.clip(self.img_px, _EPSILON, 255, out=self.img_px)  # pixels that hit 0 would be stuck there forever
         self._calc_derived_images()
-        self.iter_count += 1
 
-    def reset(self, iter_count=True, img=True):
-        if iter_count:
-            self.iter_count = 0
+    def _landweber_iteration(self):
+        # minimizes |Hx - y|^2. The gradient is g = H^T(Hx - y), and for a linear blur the best step along it
+        # is |g|^2 / |Hg|^2, which saves us from having to guess at an intensity.
+        gradient = self.do_backpropagation_blur_array(self.blurred_img_px - self.target_px)
+        blurred_gradient = self.do_blur_array(gradient)
+        denom = float(numpy.vdot(blurred_gradient, blurred_gradient))
+        if denom <= 0:
+            return  # already converged
+        alpha = float(numpy.vdot(gradient, gradient)) / denom
+
+        gradient *= alpha
+        self.img_px -= gradient
+        numpy.clip(self.img_px, 0, 255, out=self.img_px)
+        self._calc_derived_images()
 
-        self.img = self.get_initial_guess() if (self.img is None or img) else self.img
-        self.blurred_img = None if self.img is None else self.do_blur(self.img)
+    def _adaptive_step(self, curve, correction):
+        if curve == MOMENTUM:
+            if self._velocity is None:
+                self._velocity = correction
+            else:
+                self._velocity *= self.get_momentum()
+                self._velocity += correction
+            correction = self._velocity
+
+        prev_state = (self.img_px, self.blurred_img_px, self.error_px, self.current_error)
+        self.img_px = self.img_px + correction
+        numpy.clip(self.img_px, 0, 255, out=self.img_px)
+        self._calc_derived_images()
 
-        self.target_minus_blurred_img: pygame.Surface = None
-        self.target_minus_blurred_img_blurred: pygame.Surface = None
-        self.blurred_img_minus_target: pygame.Surface = None
-        self.blurred_img_minus_target_blurred: pygame.Surface = None
-        self.combined_error_image: pygame.Surface = None
+        if 0 <= prev_state[3] < self.current_error:
+            # overshot, so undo it and try again more gently next time
+            self.img_px, self.blurred_img_px, self.error_px, self.current_error = prev_state
+            self._intensity = max(self.get_min_intensity(), self._intensity * self.get_intensity_backoff())
+            self._velocity = None
+        elif curve == ADAPTIVE:
+            self._intensity *= self.get_intensity_growth()
+
+    def poll(self):
+        # if nobody's stepping us anymore, make sure the latest state is actually shown
+        if not self._stepped_since_poll:
+            self.flush_display()
+        self._stepped_since_poll = False
+
+    def flush_display(self):
+        if self._iters_since_publish > 0:
+            self._maybe_publish(force=True)
+
+    def reset(self, iter_count=True, img=True, use_cache=True):
+        if iter_count:
+            self.iter_count = 0
+            self.error_history = []
+        self._intensity = None
+        self._velocity = None
+        self._tile_error = None
+        self._tile_update = None
+        noise_key = self.get_noise_key()
+        if self._noise is None or (iter_count and img) or noise_key != self._noise_key:
+            self._noise = self.create_noise_source()  # restarted, so that seeded runs are reproducible
+            self._noise_key = noise_key
+
+        self._crop_target()
+        self._split_target()
+
+        # only runs that start from scratch can be cached
+        self._run_key = self._get_cache_key() if (iter_count and img) else None
+        cached = None if self._run_key is None or not use_cache else self.get_result_cache().get(self._run_key)
+        if cached is not None and cached.px.shape == self.target_px.shape:
+            self.img_px = cached.px.astype(numpy.float32)
+            self.iter_count = len(cached.errors)
+            self.error_history = list(cached.errors)
+            self._run_key = None
+        elif self.img_px is None or img or (self.target_px is not None and self.img_px.shape != self.target_px.shape):
+            self.img_px = self._calc_initial_guess()
+
+        self.blurred_img_px = None
+        self.error_px = None
         self.current_error = -1.0
 
         self._calc_derived_images()
+        self._maybe_publish(force=True)
+
+    def _get_cache_key(self) -> typing.Optional[str]:
+        cache_settings = self.get_cache_settings()
+        if self.get_result_cache() is None or cache_settings is None or self.full_target_px is None or \
+                self._region is not None:
+            return None
+        if self._target_hash is None:
+            self._target_hash = result_cache.hash_array(self.full_target_px)
+        return result_cache.make_key(ENGINE_VERSION, self._target_hash, cache_settings)
+
+    def _store_result(self):
+        # if the settings were changed partway through, the result doesn't match either key
+        if self._get_cache_key() == self._run_key:
+            self.get_result_cache().put(self._run_key, result_cache.CachedResult(self.img_px.copy(), self.error_history))
+        self._run_key = None
+
+    def _calc_initial_guess(self) -> typing.Optional[numpy.ndarray]:
+        style = self.get_initial_guess_style()
+        if style != BLURRED and self.target_px is not None:
+            kernel = self.get_blur_kernel()
+            if kernel is not None:
+                return deconvolve(self.target_px, kernel, self.get_regularization(), tikhonov=(style == TIKHONOV))
+
+        initial_guess = self.get_initial_guess()
+        if initial_guess is None:
+            return None
+        px = initial_guess.astype(numpy.float32)
+        if self._crop is not None:
+            x0, y0, x1, y1 = self._crop
+            px = numpy.ascontiguousarray(px[y0:y1, x0:x1])
+        if self.chroma_px is not None:
+            px = numpy.ascontiguousarray(rgb_to_ycrcb(px)[..., 0])
+        return px
+
+    def _crop_target(self):
+        self._crop = None
+        self._base_imgs = None
+        self.target_rgb_px = self.full_target_px
+        if self._region is None or self.full_target_px is None:
+            return
+
+        h, w = self.full_target_px.shape[:2]
+        x, y, rw, rh = self._region
+        x, y = max(0, min(x, w - 1)), max(0, min(y, h - 1))
+        rw, rh = max(1, min(rw, w - x)), max(1, min(rh, h - y))
+        self._region = (x, y, rw, rh)
+
+        halo = self.get_blur_halo()
+        self._crop = (max(0, x - halo), max(0, y - halo), min(w, x + rw + halo), min(h, y + rh + halo))
+        x0, y0, x1, y1 = self._crop
+        self.target_rgb_px = numpy.ascontiguousarray(self.full_target_px[y0:y1, x0:x1])
+
+        self._base_imgs = (self.target, self.target, numpy.zeros_like(self.target))
+
+    def _composite(self, idx, px: numpy.ndarray) -> numpy.ndarray:
+        # pastes the region (without its halo) onto a copy of the full-size image
+        x, y, rw, rh = self._region
+        x0, y0 = self._crop[:2]
+        res = self._base_imgs[idx].copy()
+        res[y:y + rh, x:x + rw] = to_image(px[y - y0:y - y0 + rh, x - x0:x - x0 + rw])
+        return res
+
+    def _split_target(self):
+        color_mode = self.get_color_mode()
+        if self.target_rgb_px is None or color_mode == RGB:
+            self.target_px = self.target_rgb_px
+            self.chroma_px = None
+            self.blurred_chroma_px = None
+            return
+
+        ycrcb = rgb_to_ycrcb(self.target_rgb_px)
+        self.target_px = numpy.ascontiguousarray(ycrcb[..., 0])
+        chroma = numpy.ascontiguousarray(ycrcb[..., 1:])
+
+        if color_mode == LUMINANCE_HALF_CHROMA:
+            kernel = self.get_blur_kernel(strength=0.5)
+            if kernel is not None:
+                h, w = chroma.shape[:2]
+                small = cv2.resize(chroma, (max(1, w // 2), max(1, h // 2)), interpolation=cv2.INTER_AREA)
+                small = deconvolve(small, kernel, self.get_regularization())
+                chroma = cv2.resize(small, (w, h), interpolation=cv2.INTER_LINEAR)
+
+        self.chroma_px = chroma
+        self.blurred_chroma_px = numpy.stack([self.do_blur_array(numpy.ascontiguousarray(chroma[..., i]))
+                                              for i in range(chroma.shape[2])], axis=-1)
+
+    def _to_rgb(self, px: numpy.ndarray, chroma_px: typing.Optional[numpy.ndarray]) -> numpy.ndarray:
+        return px if chroma_px is None else ycrcb_to_rgb(px, chroma_px)
 
     def _calc_derived_images(self):
-        self.blurred_img = None if self.img is None else self.do_blur(self.img)
-
-        if self.img is None or self.get_target_image() is None:
-            self.blurred_img_minus_target = None
-            self.target_minus_blurred_img = None
-            self.target_minus_blurred_img_blurred = None
-            self.blurred_img_minus_target_blurred = None
-            self.combined_error_image = None
+        if self.img_px is None or self.target_px is None:
+            self.blurred_img_px = None
+            self.error_px = None
             self.current_error = -1
             return
 
-        self.target_minus_blurred_img, self.blurred_img_minus_target = self._calc_distance_in_both_directions(
-            self.blurred_img, self.get_target_image())
+        self.blurred_img_px = self.do_blur_array(self.img_px)
+        self.error_px = self._calc_error_px(0, self.img_px.shape[0], 0, self.img_px.shape[1])
+        self.current_error = float(numpy.mean(self.error_px))
+
+    def _calc_error_px(self, y0, y1, x0, x1) -> numpy.ndarray:
+        if self.chroma_px is None:
+            return numpy.abs(self.target_px[y0:y1, x0:x1] - self.blurred_img_px[y0:y1, x0:x1])
+        else:
+            # measured in RGB either way, so that it's comparable across color modes
+            blurred_rgb = self._to_rgb(self.blurred_img_px[y0:y1, x0:x1], self.blurred_chroma_px[y0:y1, x0:x1])
+            return numpy.abs(self.target_rgb_px[y0:y1, x0:x1] - blurred_rgb)
+
+    def _calc_backpropagated_error(self) -> typing.Tuple[numpy.ndarray, numpy.ndarray]:
+        target_minus_blurred_img = numpy.maximum(self.target_px - self.blurred_img_px, 0)
+        blurred_img_minus_target = numpy.maximum(self.blurred_img_px - self.target_px, 0)
 
         bp_blur_strength = self.get_backpropagation_blur_strength()
-        self.target_minus_blurred_img_blurred = self.do_blur(self.target_minus_blurred_img, strength=bp_blur_strength)
-        self.blurred_img_minus_target_blurred = self.do_blur(self.blurred_img_minus_target, strength=bp_blur_strength)
+        return (self.do_backpropagation_blur_array(target_minus_blurred_img, strength=bp_blur_strength),
+                self.do_backpropagation_blur_array(blurred_img_minus_target, strength=bp_blur_strength))
+
+    def _maybe_publish(self, force=False):
+        now = time.perf_counter()
+        if not force:
+            if self._iters_since_publish < max(1, self.get_display_refresh_iterations()):
+                return
+            rate = self.get_display_refresh_rate()
+            if rate > 0 and now - self._last_publish_time < 1 / rate:
+                return
+
+        self.img = None if self.img_px is None else self._to_image(0, self._to_rgb(self.img_px, self.chroma_px))
+        self.blurred_img = None if self.blurred_img_px is None else \
+            self._to_image(1, self._to_rgb(self.blurred_img_px, self.blurred_chroma_px))
+        self._published_error_px = self.error_px
+        self._published_error_img = None
+
+        self.published_frame_count += 1
+        self._last_publish_time = now
+        self._iters_since_publish = 0
+        self._add_stat("display_ms", (time.perf_counter() - now) * 1000)
+
+    def _to_image(self, idx, px: numpy.ndarray) -> numpy.ndarray:
+        return to_image(px) if self._crop is None else self._composite(idx, px)
+
+    def _add_stat(self, name, value_ms, smoothing=0.9):
+        self._stats[name] = self._stats[name] * smoothing + value_ms * (1 - smoothing)
+
+    def _build_error_image(self, combo) -> numpy.ndarray:
+        if self.show_relative_error() and self.current_error > 0:
+            max_error = numpy.max(combo)
+            if max_error > 0:
+                combo = combo * (255 / max_error)
 
-        # img_array = pygame.surfarray.pixels3d(self.img)
-        # blurred_img_array = pygame.surfarray.pixels3d(self.blurred_img)
-        # tgt_array = pygame.surfarray.pixels3d(self.get_target_image())
-        tgt_minus_blurred_img_array = pygame.surfarray.pixels3d(self.target_minus_blurred_img)
-        blurred_img_minus_tgt_array = pygame.surfarray.pixels3d(self.blurred_img_minus_target)
-        # tgt_minus_blurred_img_blurred_array = pygame.surfarray.pixels3d(self.target_minus_blurred_img_blurred)
-        # blurred_img_minus_tgt_blurred_array = pygame.surfarray.pixels3d(self.blurred_img_minus_target_blurred)
+        return self._to_image(2, combo)
 
-        combo = numpy.maximum(tgt_minus_blurred_img_array, blurred_img_minus_tgt_array)
-        self.current_error = numpy.mean(combo)
 
-        max_error = numpy.max(combo)
-        if self.show_relative_error() and self.current_error > 0:
-            combo[:] = combo * (255 / max_error)
+class SettingsControlledGhastDeblurrer(AbstractIterativeGhastDeblurrer):
+
+    # settings that don't affect the result of a run from scratch (only what's displayed, or what happens next)
+    _DISPLAY_ONLY_SETTINGS = ("display_refresh_iterations", "display_refresh_rate", "show_relative_error", "max_radius",
+                              "warm_start")
+
+    def __init__(self, settings: 'settings.SimulationSettings', deblur_settings: 'settings.BlurSettings',
+                 result_cache: typing.Optional['result_cache.ResultCache'] = None):
+        self.settings = settings
+        self.deblur_settings = deblur_settings
+        self.result_cache = result_cache
+        super().__init__()  # this resets, which needs the settings
+
+    def get_correction_intensity(self, iteration):
+        return self.settings.get_correction_intensity(iteration)
+
+    def get_engine(self) -> str:
+        return self.settings.engine
+
+    def get_intensity_curve(self) -> str:
+        return self.settings.intensity_curve
+
+    def get_initial_guess_style(self) -> str:
+        return self.settings.initial_guess
+
+    def get_regularization(self) -> float:
+        return self.settings.regularization
+
+    def get_blur_kernel(self, strength=1.0) -> typing.Optional[numpy.ndarray]:
+        return self.deblur_settings.get_kernel(strength=strength)
+
+    def get_color_mode(self) -> str:
+        return self.settings.color_mode
+
+    def create_noise_source(self) -> noise.NoiseSource:
+        return noise.create_noise_source(self.settings.noise_type, self.settings.noise_seed)
+
+    def get_result_cache(self):
+        return self.result_cache
+
+    def get_cache_settings(self):
+        if self.settings.noise_seed is None:
+            return None  # the run's meant to be different every time
+        return self._get_run_settings()
+
+    def get_noise_key(self):
+        return result_cache.make_key(self._get_run_settings())
+
+    def _get_run_settings(self) -> dict:
+        res = {}
+        for name, values in (("simulation", self.settings.to_dict()), ("blur", self.deblur_settings.to_dict())):
+            res[name] = {key: val for key, val in values.items() if key not in self._DISPLAY_ONLY_SETTINGS}
+        res["kernel"] = self.get_blur_kernel()  # in case a custom kernel's file has changed
+        return res
+
+    def get_blur_halo(self) -> int:
+        # two radii, since the error gets blurred twice (forward and back) before it reaches the image
+        return math.ceil(2 * self.deblur_settings.radius * max(1.0, self.deblur_settings.backpropagation_blur_strength))
 
-        self.combined_error_image = self.img.copy()
-        pygame.surfarray.blit_array(self.combined_error_image, combo)
+    def is_active_set_enabled(self) -> bool:
+        return self.settings.active_set
 
-    def _calc_distance_in_both_directions(self, img, target) -> typing.Tuple[pygame.Surface, pygame.Surface]:
-        if img is None or target is None:
-            return None, None
+    def get_tile_size(self) -> int:
+        return self.settings.tile_size
+
+    def get_freeze_threshold(self) -> float:
+        return self.settings.freeze_threshold
+
+    def get_full_pass_interval(self) -> int:
+        return self.settings.full_pass_interval
+
+    def get_intensity_growth(self) -> float:
+        return self.settings.intensity_growth
+
+    def get_intensity_backoff(self) -> float:
+        return self.settings.intensity_backoff
+
+    def get_min_intensity(self) -> float:
+        return self.settings.min_intensity
+
+    def get_momentum(self) -> float:
+        return self.settings.momentum
+
+    def show_relative_error(self):
+        return self.settings.show_relative_error
+
+    def get_backpropagation_blur_strength(self) -> float:
+        return self.deblur_settings.backpropagation_blur_strength
+
+    def do_blur(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        return self.deblur_settings.do_blur_array(px, strength=strength)
+
+    def do_blur_array(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        return self.deblur_settings.do_blur_array(px, strength=strength)
+
+    def do_backpropagation_blur_array(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        return self.deblur_settings.do_backpropagation_blur_array(px, strength=strength)
+
+    def get_iteration_limit(self) -> int:
+        return self.settings.iteration_limit
+
+    def get_display_refresh_iterations(self) -> int:
+        return self.settings.display_refresh_iterations
+
+    def get_display_refresh_rate(self) -> float:
+        return self.settings.display_refresh_rate
+
+
+def _tile_means(px: numpy.ndarray, tile_size) -> numpy.ndarray:
+    """
+        Averages an array of shape (height, width[, channels]) over square tiles (and channels). Tiles at the
+        bottom & right edges may be partial.
+    """
+    h, w = px.shape[:2]
+    n_rows, n_cols = -(-h // tile_size), -(-w // tile_size)
+    padded = cv2.copyMakeBorder(px, 0, n_rows * tile_size - h, 0, n_cols * tile_size - w, cv2.BORDER_CONSTANT, value=0)
+    res = cv2.resize(padded, (n_cols, n_rows), interpolation=cv2.INTER_AREA)  # exact block averages
+    if res.ndim == 3:
+        res = numpy.mean(res, axis=2)
+    elif res.ndim == 1:
+        res = res.reshape(n_rows, n_cols)
+
+    # the partial tiles were averaged with some zero padding, so scale those back up
+    row_counts = numpy.minimum(tile_size, h - numpy.arange(n_rows) * tile_size)
+    col_counts = numpy.minimum(tile_size, w - numpy.arange(n_cols) * tile_size)
+    return (res * (tile_size * tile_size / numpy.outer(row_counts, col_counts))).astype(numpy.float32)
+
+
+def _get_strips(active_tiles: numpy.ndarray, tile_size, size) -> typing.List[typing.Tuple[int, int, int, int]]:
+    """
+        Groups active tiles into horizontal strips (x0, y0, x1, y1). Each row's strip spans from its leftmost to its
+        rightmost active tile, and consecutive rows with the same span get merged (which saves a halo).
+    """
+    w, h = size
+    strips = []
+    for row in range(active_tiles.shape[0]):
+        cols = numpy.flatnonzero(active_tiles[row])
+        if len(cols) == 0:
+            continue
+        x0, x1 = int(cols[0]) * tile_size, min(w, (int(cols[-1]) + 1) * tile_size)
+        y0, y1 = row * tile_size, min(h, (row + 1) * tile_size)
+        if len(strips) > 0 and strips[-1][3] == y0 and strips[-1][0] == x0 and strips[-1][2] == x1:
+            strips[-1] = (x0, strips[-1][1], x1, y1)
+        else:
+            strips.append((x0, y0, x1, y1))
+    return strips
+
+
+def deconvolve(px: numpy.ndarray, kernel: numpy.ndarray, regularization, tikhonov=False) -> numpy.ndarray:
+    """
+        Regularized FFT deconvolution of an array of shape (height, width[, channels]) by a kernel (centered at [h // 2, w // 2]).
+        Computes X = conj(K) * Y / (|K|^2 + regularization * |L|^2), where L is 1 (Wiener) or a laplacian (Tikhonov).
+        The result is clamped to [0, 255].
+    """
+    h, w = px.shape[:2]
+    kh, kw = kernel.shape
+
+    # the FFT wraps around at the edges, so pad the image by reflecting it to keep the far side from bleeding in
+    pad_y, pad_x = kh, kw
+    padded = cv2.copyMakeBorder(px.astype(numpy.float32, copy=False), pad_y, pad_y, pad_x, pad_x, cv2.BORDER_REFLECT_101)
+    ph, pw = padded.shape[:2]
+
+    # kernels sum to 1, so the mean brightness isn't changed by the blur. Taking it out first means the
+    # regularization can't dim the whole image.
+    mean = numpy.mean(padded, axis=(0, 1))
+    padded = padded - mean
+
+    def _transfer_function(k):
+        full = numpy.zeros((ph, pw), dtype=numpy.float64)
+        full[:k.shape[0], :k.shape[1]] = k
+        full = numpy.roll(full, (-(k.shape[0] // 2), -(k.shape[1] // 2)), axis=(0, 1))
+        return numpy.fft.rfft2(full)
+
+    k_hat = _transfer_function(kernel)
+    if tikhonov:
+        # scaled so that about the same regularization works for both (found by trial & error on the presets)
+        laplacian = numpy.array([[0, -1, 0], [-1, 4, -1], [0, -1, 0]], dtype=numpy.float64)
+        penalty = 30 * numpy.abs(_transfer_function(laplacian)) ** 2
+    else:
+        penalty = 1.0
+    inverse = numpy.conj(k_hat) / (numpy.abs(k_hat) ** 2 + regularization * penalty)
+
+    if padded.ndim == 3:
+        inverse = inverse[..., None]
+    res = numpy.fft.irfft2(numpy.fft.rfft2(padded, axes=(0, 1)) * inverse, s=(ph, pw), axes=(0, 1))
+    res = res[pad_y:pad_y + h, pad_x:pad_x + w] + mean
+    return numpy.clip(res, 0, 255).astype(numpy.float32)
+
+
+# full-range BT.601 (like JPEG uses), as a 3x4 affine matrix for cv2.transform. Outputs (Y, Cr, Cb).
+_RGB_TO_YCRCB = numpy.array([[0.299, 0.587, 0.114, 0],
+                             [0.5, -0.418688, -0.081312, 128],
+                             [-0.168736, -0.331264, 0.5, 128]], dtype=numpy.float64)
+_YCRCB_TO_RGB = numpy.linalg.inv(numpy.vstack([_RGB_TO_YCRCB, [0, 0, 0, 1]]))[:3]
+
+
+def rgb_to_ycrcb(px: numpy.ndarray) -> numpy.ndarray:
+    return cv2.transform(px.astype(numpy.float32, copy=False), _RGB_TO_YCRCB)
+
+
+def ycrcb_to_rgb(y_px: numpy.ndarray, chroma_px: numpy.ndarray) -> numpy.ndarray:
+    """
+        Converts a luminance array of shape (height, width) plus a chroma array of shape (height, width, 2) to RGB.
+    """
+    return cv2.transform(numpy.dstack((y_px, chroma_px)), _YCRCB_TO_RGB)
+
+
+def to_image(px: numpy.ndarray) -> numpy.ndarray:
+    """
+        Converts an array of shape (height, width, 3) into a uint8 image, clamping values to [0, 255].
+    """
+    if px.dtype == numpy.uint8:
+        return numpy.ascontiguousarray(px)
+    return numpy.clip(px, 0, 255).astype(numpy.uint8)
+
+
+def create_deblurrer(blur_type=blurs.GAUSSIAN, radius=15, iterations=50, engine=GHAST, params=None,
+                     cache: typing.Optional[result_cache.ResultCache] = None, **kwargs) -> SettingsControlledGhastDeblurrer:
+    """
+        Makes a simulation that's set up to run headlessly, see deblur_image for the args. Raises a TypeError
+        for kwargs that aren't settings.
+    """
+    blur_settings = settings.BlurSettings()
+    blur_settings.blur_type = blur_type
+    blur_settings.radius = radius
+    blur_settings.bonus_params = dict(params) if params else {}
+
+    sim_settings = settings.SimulationSettings()
+    sim_settings.iteration_limit = iterations
+    sim_settings.engine = engine
+    sim_settings.display_refresh_iterations = iterations  # only the final frame is needed
+    sim_settings.display_refresh_rate = 0
+
+    for key, val in kwargs.items():
+        if hasattr(blur_settings, key):
+            setattr(blur_settings, key, val)
+        elif hasattr(sim_settings, key):
+            setattr(sim_settings, key, val)
         else:
-            target_channels = self._color_channel_refs(target)
-            res = img.copy()
-            for i, channel in enumerate(self._color_channel_refs(res)):
-                too_low = target_channels[i] > channel
-                channel[too_low] = (target_channels[i] - channel)[too_low]
-                channel[~too_low] = 0
-
-            res_anti = img.copy()
-            for i, channel in enumerate(self._color_channel_refs(res_anti)):
-                too_high = channel > target_channels[i]
-                channel[too_high] = (channel - target_channels[i])[too_high]
-                channel[~too_high] = 0
-
-            return res, res_anti
-
-    def _color_channel_refs(self, img):
-        return [
-            pygame.surfarray.pixels_red(img),
-            pygame.surfarray.pixels_green(img),
-            pygame.surfarray.pixels_blue(img)
-        ]
\ No newline at end of file
+            raise TypeError(f"Unrecognized setting: {key}")
+
+    return SettingsControlledGhastDeblurrer(sim_settings, blur_settings, result_cache=cache)
+
+
+def deblur_image(px: numpy.ndarray, blur_type=blurs.GAUSSIAN, radius=15, iterations=50, engine=GHAST,
+                 params=None, cache: typing.Optional[result_cache.ResultCache] = None, recorder=None,
+                 **kwargs) -> numpy.ndarray:
+    """
+        Deblurs an image array of shape (height, width, 3) or (height, width), with values in [0, 255], and returns
+        the result as an array of the same shape. uint8 images give a uint8 result, anything else gives float32s.
+        This is the whole simulation without any UI, for scripts & worker processes. params are the blur's bonus
+        params (e.g. a custom kernel), and any other BlurSettings or SimulationSettings field can be passed as a
+        keyword arg, e.g. color_mode=LUMINANCE. If a cache is given, a matching earlier result is returned straight
+        away. If a recorder.ConvergenceRecorder is given, it captures the run (it's up to the caller to close it
+        afterwards).
+    """
+    sim = create_deblurrer(blur_type=blur_type, radius=radius, iterations=iterations, engine=engine, params=params,
+                           cache=cache, **kwargs)
+    if recorder is not None:
+        # so there's a frame whenever one's due
+        sim.settings.display_refresh_iterations = recorder.every
+        sim.settings.display_refresh_rate = 0
+    grayscale = px.ndim == 2
+    sim.set_target_image(numpy.dstack((px, px, px)) if grayscale else px)
+    while sim.get_iteration() < iterations:
+        if recorder is not None:
+            recorder.capture(sim)
+        sim.step()
+    sim.flush_display()
+    if recorder is not None:
+        recorder.capture(sim)
+
+    res = sim.get_output_image() if px.dtype == numpy.uint8 else sim.get_output_px()
+    return numpy.ascontiguousarray(res[..., 0]) if grayscale else res
@@ -1,10 +1,17 @@
+import multiprocessing
+import sys
+import time
 
-try:
-    import pyi_splash  # special pyinstaller thing - import will not resolve in dev
-    pyi_splash.close()
-except Exception:
-    pass  # this is expected to throw an exception in non-splash launch contexts.
+if __name__ == "__main__":
+    start_time = time.perf_counter()
+    multiprocessing.freeze_support()  # the simulation can run in a child process, which pyinstaller needs help with
 
-import ui
+    try:
+        import pyi_splash  # special pyinstaller thing - import will not resolve in dev
+        pyi_splash.close()
+    except Exception:
+        pass  # this is expected to throw an exception in non-splash launch contexts.
 
-ui.launch_app()
\ No newline at end of file
+    import ui
+
+    ui.launch_app(separate_process="--separate-process" in sys.argv, start_time=start_time)
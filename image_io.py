@@ -0,0 +1,212 @@
+import concurrent.futures
+import os
+import queue
+import traceback
+import typing
+
+import numpy
+
+import lazy_import
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+# images are RGB arrays of shape (height, width, 3) with values in [0, 255], which is what the simulation works in.
+# 8-bit images are uint8, and anything with more precision (16-bit PNGs & TIFFs, float TIFFs) is float32.
+
+JPEG_EXTENSIONS = (".jpg", ".jpeg", ".jpe")
+HIGH_BIT_DEPTH_EXTENSIONS = (".png", ".tif", ".tiff")  # formats that can store 16 bits per channel
+
+DEFAULT_PNG_COMPRESSION = 3  # 0-9, anything past 3 is a lot slower and barely any smaller for photos
+DEFAULT_JPEG_QUALITY = 95
+
+
+def read_image(filepath, max_size=None) -> numpy.ndarray:
+    """
+        Decodes an image file, keeping its precision. If max_size is given, JPEGs are decoded at a reduced
+        resolution (1/2, 1/4 or 1/8) that's still at least that big, which is much faster. Other formats are
+        always decoded at full size. Raises a ValueError if the file can't be decoded.
+    """
+    # imdecode rather than imread, since imread can't handle non-ascii paths on windows
+    data = numpy.fromfile(filepath, dtype=numpy.uint8)
+
+    flags = cv2.IMREAD_UNCHANGED
+    if max_size is not None and filepath.lower().endswith(JPEG_EXTENSIONS):
+        flags = _get_reduced_flags(data, max_size)
+    return _decode(data, flags, filepath)
+
+
+def decode_image(data: bytes) -> numpy.ndarray:
+    """
+        Like read_image, for an image file that's already in memory.
+    """
+    return _decode(numpy.frombuffer(data, dtype=numpy.uint8), cv2.IMREAD_UNCHANGED, "image data")
+
+
+def read_image_size(filepath) -> typing.Tuple[int, int]:
+    """
+        Returns an image file's (width, height), rounded up to a multiple of 8. It comes from a 1/8 scale
+        decode, which is quick for JPEGs (other formats still have to be decoded, but only in grayscale).
+        Raises a ValueError if the file can't be decoded.
+    """
+    px = cv2.imdecode(numpy.fromfile(filepath, dtype=numpy.uint8), cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if px is None:
+        raise ValueError(f"Couldn't decode image: {filepath}")
+    return px.shape[1] * 8, px.shape[0] * 8
+
+
+def _decode(data: numpy.ndarray, flags, name) -> numpy.ndarray:
+    px = cv2.imdecode(data, flags)
+    if px is None:
+        raise ValueError(f"Couldn't decode image: {name}")
+
+    if px.ndim == 2:
+        px = cv2.cvtColor(px, cv2.COLOR_GRAY2RGB)
+    elif px.shape[2] == 4:
+        px = cv2.cvtColor(px, cv2.COLOR_BGRA2RGB)  # alpha is dropped, same as the simulation always did
+    else:
+        px = cv2.cvtColor(px, cv2.COLOR_BGR2RGB)
+
+    return _normalize_range(px)
+
+
+def _get_reduced_flags(data: numpy.ndarray, max_size):
+    # the header's cheap to read, but cv2 has no way to do just that. So do a tiny decode to get the size.
+    tiny = cv2.imdecode(data, cv2.IMREAD_REDUCED_GRAYSCALE_8)
+    if tiny is None:
+        return cv2.IMREAD_UNCHANGED
+    longest = max(tiny.shape[:2]) * 8
+    for factor, flags in ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                          (2, cv2.IMREAD_REDUCED_COLOR_2)):
+        if longest // factor >= max_size:
+            return flags
+    return cv2.IMREAD_UNCHANGED
+
+
+def write_image(filepath, px: numpy.ndarray, high_bit_depth=False, png_compression=DEFAULT_PNG_COMPRESSION,
+                jpeg_quality=DEFAULT_JPEG_QUALITY):
+    """
+        Encodes an RGB array (uint8, or float32 in [0, 255]) to a file, whose format is picked by its extension.
+        If high_bit_depth is True and the format supports it (PNG & TIFF), it's saved with 16 bits per channel.
+        BMP & PPM are the fastest formats to write. Raises a ValueError if the image can't be encoded.
+    """
+    encode_image(px, os.path.splitext(filepath)[1], high_bit_depth=high_bit_depth, png_compression=png_compression,
+                 jpeg_quality=jpeg_quality).tofile(filepath)
+
+
+def encode_image(px: numpy.ndarray, ext=".png", high_bit_depth=False, png_compression=DEFAULT_PNG_COMPRESSION,
+                 jpeg_quality=DEFAULT_JPEG_QUALITY) -> numpy.ndarray:
+    """
+        Like write_image, but returns the encoded file as an array of bytes. ext picks the format, e.g. ".png".
+    """
+    ext = ext.lower()
+    if high_bit_depth and ext in HIGH_BIT_DEPTH_EXTENSIONS:
+        px = numpy.rint(numpy.clip(px.astype(numpy.float32, copy=False), 0, 255) * (65535 / 255)).astype(numpy.uint16)
+    else:
+        px = to_uint8(px)
+
+    params = []
+    if ext == ".png":
+        params = [cv2.IMWRITE_PNG_COMPRESSION, int(png_compression)]
+    elif ext in JPEG_EXTENSIONS:
+        params = [cv2.IMWRITE_JPEG_QUALITY, int(jpeg_quality)]
+
+    success, data = cv2.imencode(ext, cv2.cvtColor(px, cv2.COLOR_RGB2BGR), params)
+    if not success:
+        raise ValueError(f"Couldn't encode image as {ext}")
+    return data
+
+
+def _normalize_range(px: numpy.ndarray) -> numpy.ndarray:
+    # no rounding, so 16-bit images don't lose any precision. Float images are assumed to be in [0, 1].
+    if px.dtype == numpy.uint8:
+        return px
+    elif px.dtype == numpy.uint16:
+        return px.astype(numpy.float32) * numpy.float32(255 / 65535)
+    else:
+        return px.astype(numpy.float32) * numpy.float32(255)
+
+
+def to_uint8(px: numpy.ndarray) -> numpy.ndarray:
+    """
+        Rounds an image to 8 bits, e.g. for display.
+    """
+    if px.dtype == numpy.uint8:
+        return px
+    return numpy.rint(numpy.clip(px, 0, 255)).astype(numpy.uint8)
+
+
+def is_high_bit_depth(px: typing.Optional[numpy.ndarray]) -> bool:
+    return px is not None and px.dtype != numpy.uint8
+
+
+class BackgroundImageIO:
+    """
+    Runs image decoding and encoding on worker threads so that big images don't freeze the UI.
+    Finished jobs are queued up and their callbacks are invoked from poll(), which should be
+    called regularly from the main thread.
+    """
+
+    def __init__(self, max_workers=2):
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=max_workers,
+                                                               thread_name_prefix="image_io")
+        self._finished = queue.Queue()  # (callback, result)
+        self._in_flight = 0
+
+    def load(self, filepath, callback: typing.Callable[[typing.Optional[numpy.ndarray]], None],
+             preview_callback: typing.Callable[[numpy.ndarray], None] = None, preview_size=256):
+        """
+            Decodes an image in the background. The callback receives the array (see read_image), or None if
+            it couldn't be loaded. For JPEGs, preview_callback (if given) first gets a quick, reduced-resolution
+            decode that's at least preview_size pixels across.
+        """
+        if preview_callback is not None and filepath.lower().endswith(JPEG_EXTENSIONS):
+            self._in_flight += 1
+            self._executor.submit(self._do_load, filepath, preview_callback, preview_size)
+        self._in_flight += 1
+        self._executor.submit(self._do_load, filepath, callback, None)
+
+    def save(self, px: numpy.ndarray, filepath, callback: typing.Callable[[bool], None], **kwargs):
+        """
+            Encodes and writes an image in the background (see write_image for the kwargs). The callback
+            receives whether it succeeded.
+        """
+        # copy here, on the caller's thread, so the simulation can keep modifying its images in the meantime
+        px = px.copy()
+        self._in_flight += 1
+        self._executor.submit(self._do_save, px, filepath, callback, kwargs)
+
+    def is_busy(self) -> bool:
+        return self._in_flight > 0
+
+    def poll(self):
+        while True:
+            try:
+                callback, result = self._finished.get_nowait()
+            except queue.Empty:
+                return
+            self._in_flight -= 1
+            if callback is not None:
+                callback(result)
+
+    def _do_load(self, filepath, callback, max_size):
+        px = None
+        try:
+            px = read_image(filepath, max_size=max_size)
+        except Exception:
+            if max_size is None:  # a failed preview isn't worth reporting, the full load will fail too
+                print(f"ERROR: failed to import image: {filepath}")
+                traceback.print_exc()
+        is_failed_preview = px is None and max_size is not None
+        self._finished.put((None if is_failed_preview else callback, px))
+
+    def _do_save(self, px, filepath, callback, kwargs):
+        success = False
+        try:
+            write_image(filepath, px, **kwargs)
+            print(f"INFO: saved image to {filepath}")
+            success = True
+        except Exception:
+            print(f"ERROR: failed to export image to: {filepath}")
+            traceback.print_exc()
+        self._finished.put((callback, success))
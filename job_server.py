@@ -0,0 +1,443 @@
+import argparse
+import base64
+import heapq
+import http.server
+import itertools
+import json
+import multiprocessing
+import threading
+import time
+import traceback
+import typing
+import urllib.error
+import urllib.request
+
+import numpy
+
+import deblur
+import image_io
+import parallel
+import result_cache
+
+
+# A local HTTP service that queues up deblur jobs and runs them on a pool of worker processes. Everything's JSON,
+# and images go both ways as base64-encoded image files (PNG, JPEG, etc.):
+#
+#   POST   /jobs               {"image": <base64>, "settings": {"radius": 10, ...}, "priority": 0} -> {"id": ...}
+#   GET    /jobs               the status of every job
+#   GET    /jobs/<id>          its status, progress & error curve so far
+#   GET    /jobs/<id>/result   the deblurred image (a PNG, 16-bit if the input had more than 8 bits)
+#   DELETE /jobs/<id>          cancels it, if it hasn't finished
+#
+# settings are anything deblur.create_deblurrer accepts. Jobs with a higher priority run first, and jobs with the
+# same priority run in the order they were submitted. JobClient wraps all of this for scripts.
+
+DEFAULT_HOST = "127.0.0.1"  # only reachable from this machine
+DEFAULT_PORT = 8765
+
+# job states
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+CANCELLED = "cancelled"
+
+
+def get_all_job_states():
+    return [QUEUED, RUNNING, DONE, FAILED, CANCELLED]
+
+
+class Job:
+
+    def __init__(self, job_id, px: numpy.ndarray, deblur_kwargs: dict, priority=0, iterations=50):
+        self.id = job_id
+        self.px = px  # the target, dropped once it's been handed to a worker
+        self.deblur_kwargs = deblur_kwargs
+        self.priority = priority
+        self.iterations = iterations
+        self.high_bit_depth = image_io.is_high_bit_depth(px)
+
+        self.state = QUEUED
+        self.iteration = 0
+        self.errors = []
+        self.message = None  # what went wrong, if it failed
+        self.result_px = None
+
+        self.submit_time = time.time()
+        self.start_time = None
+        self.end_time = None
+        self.cancel_requested = False
+
+    def is_finished(self):
+        return self.state in (DONE, FAILED, CANCELLED)
+
+    def to_dict(self) -> dict:
+        return {
+            "id": self.id,
+            "state": self.state,
+            "priority": self.priority,
+            "settings": self.deblur_kwargs,
+            "iteration": self.iteration,
+            "iterations": self.iterations,
+            "error": self.errors[-1] if len(self.errors) > 0 else None,
+            "errors": self.errors,
+            "message": self.message,
+            "submit_time": self.submit_time,
+            "start_time": self.start_time,
+            "end_time": self.end_time
+        }
+
+
+class JobQueue:
+    """
+    Runs jobs on a fixed number of worker processes, highest priority first. Each worker process is
+    driven by a thread of ours, which relays its progress back into the job.
+    """
+
+    def __init__(self, n_workers=2, use_cache=True, max_finished=100):
+        self.max_finished = max_finished  # how many finished jobs (and their results) to hold onto
+
+        self._jobs: typing.Dict[str, Job] = {}
+        self._queue = []  # heap of (-priority, seq, job id), so equal priorities are first come first served
+        self._seq = itertools.count()
+        self._cond = threading.Condition()
+        self._closed = False
+
+        self._threads = []
+        for idx in range(n_workers):
+            thread = threading.Thread(target=self._run_thread, args=(use_cache,), name=f"job_worker_{idx}",
+                                      daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def submit(self, px: numpy.ndarray, deblur_kwargs: dict, priority=0) -> Job:
+        """
+            Queues up a job. Raises a TypeError or ValueError if the settings are bad.
+        """
+        sim = deblur.create_deblurrer(**deblur_kwargs)  # so bad settings are the caller's error, not a failed job
+        with self._cond:
+            seq = next(self._seq)
+            job = Job(f"{seq:06d}", px, dict(deblur_kwargs), priority=priority, iterations=sim.get_iteration_limit())
+            self._jobs[job.id] = job
+            heapq.heappush(self._queue, (-priority, seq, job.id))
+            self._cond.notify()
+        return job
+
+    def get(self, job_id) -> typing.Optional[Job]:
+        with self._cond:
+            return self._jobs.get(job_id)
+
+    def get_all(self) -> typing.List[Job]:
+        with self._cond:
+            return list(self._jobs.values())
+
+    def cancel(self, job_id) -> bool:
+        """
+            Cancels a queued or running job, and returns whether there was one to cancel.
+        """
+        with self._cond:
+            job = self._jobs.get(job_id)
+            if job is None or job.is_finished():
+                return False
+            if job.state == QUEUED:
+                self._finish(job, CANCELLED)  # it stays in the heap, but gets skipped when it comes up
+            else:
+                job.cancel_requested = True  # its thread passes this on to the worker process
+            return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        for thread in self._threads:
+            thread.join(timeout=5)
+
+    def _next_job(self) -> typing.Optional[Job]:
+        with self._cond:
+            while True:
+                if self._closed:
+                    return None
+                while len(self._queue) > 0:
+                    job = self._jobs.get(heapq.heappop(self._queue)[2])
+                    if job is not None and job.state == QUEUED:
+                        job.state = RUNNING
+                        job.start_time = time.time()
+                        return job
+                self._cond.wait()
+
+    def _finish(self, job: Job, state, message=None):
+        # must hold self._cond
+        job.state = state
+        job.message = message
+        job.px = None
+        job.end_time = time.time()
+
+        finished = [j for j in self._jobs.values() if j.is_finished()]
+        for old_job in finished[:max(0, len(finished) - self.max_finished)]:
+            del self._jobs[old_job.id]  # they're in submission order, so these are the oldest
+
+    def _run_thread(self, use_cache):
+        ctx = multiprocessing.get_context("spawn")
+        conn, process = None, None
+        try:
+            while True:
+                job = self._next_job()
+                if job is None:
+                    return
+                if process is None or not process.is_alive():
+                    conn, child_conn = ctx.Pipe()
+                    process = ctx.Process(target=_run_worker, args=(child_conn, use_cache), name="job_worker",
+                                          daemon=True)
+                    process.start()
+                    child_conn.close()  # otherwise the pipe never reports EOF if the worker dies
+                self._run_job(job, conn, process)
+        finally:
+            if process is not None and process.is_alive():
+                try:
+                    conn.send(("stop",))
+                except OSError:
+                    pass
+                process.join(timeout=2)
+                if process.is_alive():
+                    process.terminate()
+
+    def _run_job(self, job: Job, conn, process):
+        # the images go through shared memory, only handles go through the pipe
+        target = parallel.SharedArray.from_array(job.px)
+        output = parallel.SharedArray(job.px.shape, numpy.uint8 if job.px.dtype == numpy.uint8 else numpy.float32)
+        try:
+            conn.send(("run", target, output, job.deblur_kwargs))
+            cancel_sent = False
+            while True:
+                if job.cancel_requested and not cancel_sent:
+                    conn.send(("cancel",))
+                    cancel_sent = True
+                if not conn.poll(0.05):
+                    if not process.is_alive():
+                        raise EOFError()
+                    continue
+                msg = conn.recv()
+                with self._cond:
+                    if msg[0] == "progress":
+                        job.iteration = msg[1]
+                        job.errors.append(msg[2])
+                    elif msg[0] == "done":
+                        job.result_px, job.errors, job.iteration = output.px.copy(), msg[1], len(msg[1])
+                        self._finish(job, DONE)
+                        return
+                    elif msg[0] == "cancelled":
+                        self._finish(job, CANCELLED)
+                        return
+                    elif msg[0] == "failed":
+                        self._finish(job, FAILED, message=msg[1])
+                        return
+        except (EOFError, OSError):
+            with self._cond:
+                self._finish(job, FAILED, message="The worker process died")
+        finally:
+            target.close()
+            output.close()
+
+
+def _run_worker(conn, use_cache):
+    cache = result_cache.ResultCache() if use_cache else None
+    try:
+        while True:
+            msg = conn.recv()
+            if msg[0] == "stop":
+                return
+            elif msg[0] != "run":
+                continue  # e.g. a cancel that arrived after its job was done
+
+            _, target, output, deblur_kwargs = msg
+            try:
+                sim = deblur.create_deblurrer(cache=cache, **deblur_kwargs)
+                sim.set_target_image(target.px)
+                cancelled = False
+                while not sim.is_finished_iterating():
+                    if conn.poll() and conn.recv()[0] == "cancel":
+                        cancelled = True
+                        break
+                    sim.step()
+                    conn.send(("progress", sim.get_iteration(), sim.get_error()))
+                if cancelled:
+                    conn.send(("cancelled",))
+                else:
+                    output.px[:] = sim.get_output_image() if output.dtype == numpy.uint8 else sim.get_output_px()
+                    conn.send(("done", list(sim.error_history)))
+            except Exception:
+                traceback.print_exc()
+                conn.send(("failed", traceback.format_exc()))
+            finally:
+                target.close()
+                output.close()
+    except (EOFError, BrokenPipeError, KeyboardInterrupt):
+        pass  # the server went away
+
+
+class _RequestHandler(http.server.BaseHTTPRequestHandler):
+
+    server: 'JobServer'
+
+    def do_GET(self):
+        parts = self._get_path_parts()
+        if parts == ["jobs"]:
+            self._send_json(200, [job.to_dict() for job in self.server.job_queue.get_all()])
+        elif len(parts) in (2, 3) and parts[0] == "jobs":
+            job = self.server.job_queue.get(parts[1])
+            if job is None:
+                self._send_json(404, {"message": f"No such job: {parts[1]}"})
+            elif len(parts) == 2:
+                self._send_json(200, job.to_dict())
+            elif parts[2] != "result":
+                self._send_json(404, {"message": f"Unknown path: {self.path}"})
+            elif job.state != DONE:
+                self._send_json(409, {"message": f"Job is {job.state}"})
+            else:
+                data = image_io.encode_image(job.result_px, ".png", high_bit_depth=job.high_bit_depth).tobytes()
+                self._send(200, "image/png", data)
+        else:
+            self._send_json(404, {"message": f"Unknown path: {self.path}"})
+
+    def do_POST(self):
+        if self._get_path_parts() != ["jobs"]:
+            self._send_json(404, {"message": f"Unknown path: {self.path}"})
+            return
+        try:
+            body = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            px = image_io.decode_image(base64.b64decode(body["image"]))
+            job = self.server.job_queue.submit(px, body.get("settings", {}), priority=int(body.get("priority", 0)))
+        except (KeyError, ValueError, TypeError) as e:
+            self._send_json(400, {"message": f"Bad job: {e}"})
+            return
+        self._send_json(201, job.to_dict())
+
+    def do_DELETE(self):
+        parts = self._get_path_parts()
+        if len(parts) != 2 or parts[0] != "jobs":
+            self._send_json(404, {"message": f"Unknown path: {self.path}"})
+        elif self.server.job_queue.get(parts[1]) is None:
+            self._send_json(404, {"message": f"No such job: {parts[1]}"})
+        else:
+            cancelled = self.server.job_queue.cancel(parts[1])
+            self._send_json(200, {"cancelled": cancelled})
+
+    def log_message(self, format, *args):
+        pass  # scripts polling the status would flood the console
+
+    def _get_path_parts(self):
+        return [part for part in self.path.split("?")[0].split("/") if part]
+
+    def _send_json(self, code, obj):
+        self._send(code, "application/json", json.dumps(obj).encode("utf-8"))
+
+    def _send(self, code, content_type, data: bytes):
+        self.send_response(code)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+class JobServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, host=DEFAULT_HOST, port=DEFAULT_PORT, job_queue: typing.Optional[JobQueue] = None):
+        super().__init__((host, port), _RequestHandler)
+        self.job_queue = job_queue or JobQueue()
+
+    def get_url(self):
+        host, port = self.server_address[:2]
+        return f"http://{host}:{port}"
+
+    def server_close(self):
+        super().server_close()
+        self.job_queue.close()
+
+
+class JobClient:
+    """
+    Talks to a JobServer. Raises a JobError for any request the server rejects.
+    """
+
+    def __init__(self, url=f"http://{DEFAULT_HOST}:{DEFAULT_PORT}", timeout=30):
+        self.url = url.rstrip("/")
+        self.timeout = timeout
+
+    def submit(self, px: numpy.ndarray, priority=0, **deblur_kwargs) -> str:
+        """
+            Queues up an image (see image_io for the format), and returns the job's id.
+        """
+        image = base64.b64encode(image_io.encode_image(px, ".png", high_bit_depth=image_io.is_high_bit_depth(px)))
+        body = {"image": image.decode("ascii"), "settings": deblur_kwargs, "priority": priority}
+        return self._request("POST", "/jobs", body)["id"]
+
+    def get_status(self, job_id) -> dict:
+        return self._request("GET", f"/jobs/{job_id}")
+
+    def get_all(self) -> typing.List[dict]:
+        return self._request("GET", "/jobs")
+
+    def get_result(self, job_id) -> numpy.ndarray:
+        return image_io.decode_image(self._request("GET", f"/jobs/{job_id}/result", raw=True))
+
+    def cancel(self, job_id) -> bool:
+        return self._request("DELETE", f"/jobs/{job_id}")["cancelled"]
+
+    def wait(self, job_id, poll_interval=0.1, timeout=None) -> dict:
+        """
+            Waits for a job to finish, and returns its final status.
+        """
+        start_time = time.time()
+        while True:
+            status = self.get_status(job_id)
+            if status["state"] in (DONE, FAILED, CANCELLED):
+                return status
+            if timeout is not None and time.time() - start_time > timeout:
+                raise TimeoutError(f"Job {job_id} didn't finish within {timeout}s")
+            time.sleep(poll_interval)
+
+    def _request(self, method, path, body=None, raw=False):
+        data = None if body is None else json.dumps(body).encode("utf-8")
+        request = urllib.request.Request(self.url + path, data=data, method=method,
+                                         headers={"Content-Type": "application/json"})
+        try:
+            with urllib.request.urlopen(request, timeout=self.timeout) as response:
+                res = response.read()
+        except urllib.error.HTTPError as e:
+            try:
+                message = json.loads(e.read())["message"]
+            except (ValueError, KeyError):
+                message = str(e)
+            raise JobError(e.code, message) from None
+        return res if raw else json.loads(res)
+
+
+class JobError(Exception):
+
+    def __init__(self, code, message):
+        super().__init__(f"{code}: {message}")
+        self.code = code
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Runs a local service that deblurs images sent to it over HTTP.")
+    parser.add_argument("--host", default=DEFAULT_HOST)
+    parser.add_argument("--port", type=int, default=DEFAULT_PORT)
+    parser.add_argument("--workers", type=int, default=2, help="how many jobs can run at once")
+    parser.add_argument("--no-cache", action="store_true", help="don't reuse (or store) finished results")
+    args = parser.parse_args(args)
+
+    server = JobServer(args.host, args.port, JobQueue(n_workers=args.workers, use_cache=not args.no_cache))
+    print(f"INFO: serving on {server.get_url()} with {args.workers} workers")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
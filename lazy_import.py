@@ -0,0 +1,29 @@
+import importlib
+import time
+
+
+class LazyModule:
+    """
+    Stands in for a module that's slow to import, and only imports it the first time one of its attributes
+    is used. For cv2, which takes longer to import than everything else the simulation needs put together,
+    and isn't needed at all until the first blur.
+    """
+
+    def __init__(self, name):
+        self._name = name
+        self._module = None
+        self.load_ms = None  # how long the import took, once it's happened
+
+    def is_loaded(self) -> bool:
+        return self._module is not None
+
+    def __getattr__(self, attr):
+        # only called for attributes that aren't found normally, i.e. the module's
+        if self._module is None:
+            start_time = time.perf_counter()
+            self._module = importlib.import_module(self._name)
+            self.load_ms = (time.perf_counter() - start_time) * 1000
+        return getattr(self._module, attr)
+
+
+cv2 = LazyModule("cv2")
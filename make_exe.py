@@ -4,6 +4,7 @@ import tempfile
 import shutil
 import stat
 import struct
+import sys
 
 ####   OPTIONS   ####
 
@@ -15,7 +16,9 @@ ICON_PATH_ICNS = "assets/icons/icon.icns"  # mac-style icons
 
 SPLASH_IMAGE_PATH = "assets/splash.png"
 
-ONEFILE_MODE = True
+# onefile builds unpack themselves into a temp dir on every launch, which makes startup a lot slower. Onedir
+# builds are unpacked once (that's the folder you get), so pass --onedir for those.
+ONEFILE_MODE = "--onedir" not in sys.argv
 SHOW_CONSOLE = False
 
 SHOW_TRACEBACK_ON_CRASH = True
@@ -235,9 +238,12 @@ def do_it():
     if os.path.exists(str(spec_filename)):
         os.remove(str(spec_filename))
 
+    # in onedir mode the exe & its files end up in a folder of their own, and the data goes next to them
+    app_dir = dist_dir_subdir if ONEFILE_MODE else os.path.join(dist_dir_subdir, NAME_OF_GAME)
+
     if OS_SYSTEM_STR == _LINUX:
         print("INFO: chmod'ing execution permissions to all users (linux)")
-        exe_path = os.path.join(dist_dir_subdir, NAME_OF_GAME)
+        exe_path = os.path.join(app_dir, NAME_OF_GAME)
         if not os.path.exists(str(exe_path)):
             raise ValueError("couldn't find exe to apply exec permissions: {}".format(exe_path))
         else:
@@ -248,7 +254,7 @@ def do_it():
         if not os.path.exists(src_path):
             raise ValueError("couldn't find data to copy: {}".format(src_path))
         else:
-            full_dest_path = os.path.join(dist_dir_subdir, dest_path)
+            full_dest_path = os.path.join(app_dir, dest_path)
             print("INFO: copying {} to {}".format(src_path, full_dest_path))
             if os.path.isfile(src_path):
                 shutil.copy2(src_path, full_dest_path)  # copying a single file
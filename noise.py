@@ -0,0 +1,146 @@
+import typing
+
+import numpy
+
+
+# noise types
+WHITE = "white"  # fresh noise from a seeded generator every iteration
+WHITE_TILE = "white tile"  # a precomputed tile of white noise, repeated at a random offset every iteration
+BLUE_TILE = "blue tile"  # same, but the tile has no low frequencies, so the corrections come out less blotchy
+
+
+_TILE_SPAWN_KEY = 2 ** 32 - 1  # way past the spawn keys that spawn() will ever hand out
+
+
+def get_all_noise_types():
+    return [WHITE, WHITE_TILE, BLUE_TILE]
+
+
+class NoiseSource:
+    """
+    Fills arrays with uniform noise in [0, 1). Sources are seeded (or seeded from the OS if the seed is None),
+    so runs can be reproduced, and each one has its own state, so they're safe to use from separate threads.
+
+    A seed is an int, or a list of ints [seed, i, j, ...] for a source spawned from another one (see spawn()),
+    which keeps seeds JSON-able so they can go in settings.
+    """
+
+    def fill(self, out: numpy.ndarray) -> numpy.ndarray:
+        raise NotImplementedError()
+
+    def spawn(self, n) -> typing.List['NoiseSource']:
+        """
+            Creates n independent child sources, e.g. for tiles or workers that run in parallel. The children
+            only depend on this source's seed, not on how much noise it has generated.
+        """
+        raise NotImplementedError()
+
+    def get_seed(self) -> typing.Union[int, typing.List[int]]:
+        """
+            Returns the seed that recreates this source from scratch, e.g. to hand a spawned source's stream
+            to another process.
+        """
+        raise NotImplementedError()
+
+
+def _to_seed_seq(seed) -> numpy.random.SeedSequence:
+    if isinstance(seed, numpy.random.SeedSequence):
+        return seed
+    elif isinstance(seed, (list, tuple)):
+        return numpy.random.SeedSequence(seed[0], spawn_key=tuple(seed[1:]))
+    return numpy.random.SeedSequence(seed)
+
+
+def _from_seed_seq(seed_seq: numpy.random.SeedSequence) -> typing.Union[int, typing.List[int]]:
+    return [seed_seq.entropy] + list(seed_seq.spawn_key) if len(seed_seq.spawn_key) > 0 else seed_seq.entropy
+
+
+class GeneratorNoise(NoiseSource):
+
+    def __init__(self, seed=None):
+        self._seed_seq = _to_seed_seq(seed)
+        self._rng = numpy.random.Generator(numpy.random.PCG64(self._seed_seq))
+
+    def fill(self, out: numpy.ndarray) -> numpy.ndarray:
+        # writes float32s directly, no float64 temporary
+        self._rng.random(out=out, dtype=out.dtype)
+        return out
+
+    def spawn(self, n) -> typing.List['NoiseSource']:
+        return [GeneratorNoise(child) for child in self._seed_seq.spawn(n)]
+
+    def get_seed(self):
+        return _from_seed_seq(self._seed_seq)
+
+
+class TileNoise(NoiseSource):
+
+    def __init__(self, seed=None, tile_size=128, blue=False, _tiles=None):
+        self._seed_seq = _to_seed_seq(seed)
+        self._rng = numpy.random.Generator(numpy.random.PCG64(self._seed_seq))
+        self.tile_size = tile_size
+        self.blue = blue
+        self._tiles = _tiles if _tiles is not None else {}  # n_channels -> tile, shared with spawned children
+
+    def fill(self, out: numpy.ndarray) -> numpy.ndarray:
+        h, w = out.shape[:2]
+        n_channels = out.shape[2] if out.ndim == 3 else 0
+        tile = self._get_tile(n_channels)
+
+        offset = self._rng.integers(0, self.tile_size, size=2)
+        tile = numpy.roll(tile, tuple(offset), axis=(0, 1))
+        reps = (-(-h // self.tile_size), -(-w // self.tile_size)) + ((1,) if n_channels > 0 else ())
+        numpy.copyto(out, numpy.tile(tile, reps)[:h, :w], casting="unsafe")
+        return out
+
+    def spawn(self, n) -> typing.List['NoiseSource']:
+        return [TileNoise(child, tile_size=self.tile_size, blue=self.blue, _tiles=self._tiles)
+                for child in self._seed_seq.spawn(n)]
+
+    def get_seed(self):
+        return _from_seed_seq(self._seed_seq)
+
+    def _get_tile(self, n_channels):
+        if n_channels not in self._tiles:
+            # the tile's generated from its own stream, so that it only depends on the seed
+            tile_seed_seq = numpy.random.SeedSequence(self._seed_seq.entropy,
+                                                      spawn_key=self._seed_seq.spawn_key + (_TILE_SPAWN_KEY,))
+            tile_rng = numpy.random.Generator(numpy.random.PCG64(tile_seed_seq))
+            shape = (self.tile_size, self.tile_size) + ((n_channels,) if n_channels > 0 else ())
+            tile = tile_rng.random(shape, dtype=numpy.float32)
+            if self.blue:
+                tile = _make_blue(tile)
+            self._tiles[n_channels] = tile
+        return self._tiles[n_channels]
+
+
+def _make_blue(white: numpy.ndarray, cutoff=0.125) -> numpy.ndarray:
+    """
+        Turns white noise into (approximately) blue noise, by filtering out its low frequencies and then
+        mapping it back onto a uniform distribution. The filtering's done with an FFT so the result still tiles.
+    """
+    size = white.shape[0]
+    sigma = cutoff * size  # in cycles per tile
+    freqs = numpy.fft.fftfreq(size) * size
+    dist_sq = freqs[:, None] ** 2 + freqs[None, :] ** 2
+    high_pass = 1 - numpy.exp(-dist_sq / (2 * sigma ** 2))
+    if white.ndim == 3:
+        high_pass = high_pass[..., None]
+    filtered = numpy.real(numpy.fft.ifft2(numpy.fft.fft2(white, axes=(0, 1)) * high_pass, axes=(0, 1)))
+
+    # ranks -> uniform values, separately per channel
+    flat = filtered.reshape(size * size, -1)
+    ranks = numpy.argsort(numpy.argsort(flat, axis=0), axis=0)
+    return ((ranks + 0.5) / (size * size)).reshape(white.shape).astype(numpy.float32)
+
+
+def create_noise_source(noise_type, seed=None) -> NoiseSource:
+    noise_type = noise_type.lower() if isinstance(noise_type, str) else noise_type
+    if noise_type == WHITE:
+        return GeneratorNoise(seed)
+    elif noise_type == WHITE_TILE:
+        return TileNoise(seed, blue=False)
+    elif noise_type == BLUE_TILE:
+        return TileNoise(seed, blue=True)
+    else:
+        raise ValueError(f"Unrecognized noise type: {noise_type}")
@@ -0,0 +1,161 @@
+import concurrent.futures
+import multiprocessing
+import multiprocessing.shared_memory
+import os
+import sys
+import typing
+
+import numpy
+
+import deblur
+import lazy_import
+import result_cache
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+class SharedArray:
+    """
+    A numpy array (px) that lives in shared memory. It pickles as just a handle, so sending one to another
+    process (through a pipe, queue or process pool) is instant whatever its size, and the other side gets a
+    view of the same memory rather than a copy.
+
+    Every process that's done with one should close() it. The process that created it owns the memory,
+    which is freed once it's closed there.
+    """
+
+    def __init__(self, shape, dtype, name=None):
+        self.shape = tuple(shape)
+        self.dtype = numpy.dtype(dtype)
+        self._owner = name is None
+        if self._owner:
+            nbytes = max(1, int(numpy.prod(self.shape)) * self.dtype.itemsize)
+            self._shm = multiprocessing.shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            self._shm = multiprocessing.shared_memory.SharedMemory(name=name)
+        self.px = numpy.ndarray(self.shape, dtype=self.dtype, buffer=self._shm.buf)
+
+    @staticmethod
+    def from_array(px: numpy.ndarray) -> 'SharedArray':
+        res = SharedArray(px.shape, px.dtype)
+        res.px[:] = px
+        return res
+
+    def close(self):
+        if self._shm is None:
+            return
+        self.px = None  # the buffer can't be released while there are views into it
+        self._shm.close()
+        if self._owner:
+            self._shm.unlink()
+        self._shm = None
+
+    def __getstate__(self):
+        return self._shm.name, self.shape, self.dtype.str
+
+    def __setstate__(self, state):
+        name, shape, dtype = state
+        self.__init__(shape, dtype, name=name)
+
+
+def init_worker(stdout_to_stderr=False):
+    # a pool already keeps every core busy, cv2's own threads would just fight over them
+    cv2.setNumThreads(1)
+    if stdout_to_stderr:
+        # for when stdout is carrying data, so that logging can't end up in it
+        os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+
+
+class DeblurPool:
+    """
+    A pool of worker processes that deblur images handed to them through shared memory. The kwargs are
+    anything deblur.deblur_image accepts, and apply to every image.
+    """
+
+    def __init__(self, workers=None, use_cache=False, stdout_to_stderr=False, **kwargs):
+        deblur.create_deblurrer(**kwargs)  # catches bad settings now, rather than once per image
+        self.workers = max(1, workers or os.cpu_count() or 1)
+        self.use_cache = use_cache
+        self.kwargs = kwargs
+        ctx = multiprocessing.get_context("spawn")
+        self._executor = concurrent.futures.ProcessPoolExecutor(max_workers=self.workers, mp_context=ctx,
+                                                                initializer=init_worker,
+                                                                initargs=(stdout_to_stderr,))
+
+    def submit(self, target: SharedArray) -> concurrent.futures.Future:
+        """
+            Starts deblurring an image. The future's result is a new SharedArray holding the result, which
+            the caller must close.
+        """
+        output = SharedArray(target.shape, numpy.uint8 if target.dtype == numpy.uint8 else numpy.float32)
+        res = concurrent.futures.Future()
+
+        def _on_done(future):
+            if future.exception() is not None:
+                output.close()
+                res.set_exception(future.exception())
+            else:
+                res.set_result(output)
+
+        self._executor.submit(_deblur_shared, target, output, self.use_cache, self.kwargs).add_done_callback(_on_done)
+        return res
+
+    def close(self):
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def deblur_images(images: typing.List[typing.Union[numpy.ndarray, SharedArray]], workers=None, use_cache=False,
+                  return_shared=False, **kwargs) -> typing.List[typing.Union[numpy.ndarray, SharedArray]]:
+    """
+        Deblurs several images at once across a pool of processes, and returns the results in the same order.
+        The images can be anything deblur.deblur_image accepts, and so can the kwargs (which apply to all of them).
+
+        Images are handed to the workers through shared memory rather than being pickled. Pass SharedArrays
+        instead of arrays to skip the one copy that's left, and set return_shared to get the results back as
+        SharedArrays too (which the caller must close), rather than as copies.
+    """
+    targets = []
+    outputs = []
+    try:
+        for px in images:
+            targets.append(px if isinstance(px, SharedArray) else SharedArray.from_array(px))
+
+        # biggest first, so a big one doesn't start last & leave the other workers idle
+        order = sorted(range(len(targets)), key=lambda i: targets[i].px.size, reverse=True)
+        futures = [None] * len(targets)
+        with DeblurPool(workers=min(workers or os.cpu_count() or 1, max(1, len(targets))), use_cache=use_cache,
+                        **kwargs) as pool:
+            for i in order:
+                futures[i] = pool.submit(targets[i])
+            concurrent.futures.wait(futures)
+
+        outputs = [future.result() for future in futures if future.exception() is None]
+        for future in futures:
+            if future.exception() is not None:
+                raise future.exception()
+
+        if return_shared:
+            res, outputs = outputs, []
+            return res
+        return [output.px.copy() for output in outputs]
+    finally:
+        for target, px in zip(targets, images):
+            if target is not px:
+                target.close()
+        for output in outputs:
+            output.close()
+
+
+def _deblur_shared(target: SharedArray, output: SharedArray, use_cache, kwargs):
+    try:
+        cache = result_cache.ResultCache() if use_cache else None
+        output.px[:] = deblur.deblur_image(target.px, cache=cache, **kwargs)
+    finally:
+        target.close()
+        output.close()
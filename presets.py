@@ -0,0 +1,239 @@
+import collections
+import concurrent.futures
+import hashlib
+import os
+import queue
+import traceback
+import typing
+
+import numpy
+
+import image_io
+import lazy_import
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+PRESET_EXTENSIONS = (".jpg", ".jpeg", ".png", ".tif", ".tiff")
+
+THUMBNAIL_DIR = "userdata/.thumbnails"
+THUMBNAIL_SIZE = 128
+
+DEFAULT_MAX_LOADED_BYTES = 256 * 1024 * 1024
+
+
+class PresetLibrary:
+    """
+    A folder of preset images, indexed by filename. Nothing is decoded until a preset is actually
+    requested, at which point it's loaded on a background thread and handed back to the main
+    thread via poll(). The most recently loaded ones are kept in memory, up to max_loaded_bytes
+    (but the newest is always kept). Small thumbnails are cached on disk so there's something to
+    show while the full image decodes. They're made on their own thread, from a reduced decode,
+    so they don't have to wait for the full image.
+    """
+
+    def __init__(self, path=None, thumbnail_dir=THUMBNAIL_DIR, max_loaded_bytes=DEFAULT_MAX_LOADED_BYTES):
+        self.path = path
+        self.thumbnail_dir = thumbnail_dir
+        self.max_loaded_bytes = max_loaded_bytes
+
+        self._files: typing.Dict[str, str] = {}  # filename -> full path
+        self._loaded: typing.OrderedDict[str, numpy.ndarray] = collections.OrderedDict()  # least recently used first
+        self._loaded_bytes = 0
+        self._callbacks: typing.Dict[str, typing.List[typing.Callable]] = {}
+        self._thumbnail_callbacks: typing.Dict[str, typing.List[typing.Callable]] = {}
+
+        self._finished = queue.Queue()  # (filename, array or None)
+        self._thumbnails_finished = queue.Queue()  # (filename, array or None)
+        # (filename or None, full path), requested thumbnails go ahead of the ones that are only being prepared
+        self._thumbnail_requests = collections.deque()
+        self._thumbnails_to_prepare = collections.deque()
+        self._executor = None
+        self._thumbnail_executor = None
+
+        self.reindex()
+
+    def reindex(self):
+        self._files.clear()
+        if self.path is None:
+            return
+        try:
+            for f in sorted(os.listdir(self.path)):
+                fullpath = os.path.join(self.path, f)
+                if f.lower().endswith(PRESET_EXTENSIONS) and os.path.isfile(fullpath):
+                    self._files[f] = fullpath
+        except IOError:
+            traceback.print_exc()
+
+    def __contains__(self, name):
+        return name in self._files
+
+    def __iter__(self):
+        return iter(self._files)
+
+    def __len__(self):
+        return len(self._files)
+
+    def get_path(self, name) -> str:
+        return self._files[name]
+
+    def is_loading(self, name) -> bool:
+        return name in self._callbacks
+
+    def request(self, name, callback: typing.Callable[[typing.Optional[numpy.ndarray]], None]):
+        """
+            Asks for the given preset to be loaded. The callback is invoked with the decoded image (see image_io)
+            (or None, if it failed to load) from inside poll(), so it always runs on the caller's thread.
+        """
+        if name not in self._files:
+            raise ValueError(f"Unrecognized preset: {name}")
+
+        if name in self._loaded:
+            self._loaded.move_to_end(name)
+            self._finished.put((name, self._loaded[name]))
+        elif name not in self._callbacks:
+            if self._executor is None:
+                self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1, thread_name_prefix="preset_loader")
+            self._executor.submit(self._load_in_background, name, self._files[name])
+
+        self._callbacks.setdefault(name, []).append(callback)
+
+    def request_thumbnail(self, name, callback: typing.Callable[[typing.Optional[numpy.ndarray]], None]):
+        """
+            Asks for a preset's thumbnail, which is read from the disk cache (or made, if it's not there yet)
+            in the background. Like request(), the callback is invoked from inside poll().
+        """
+        if name not in self._files:
+            raise ValueError(f"Unrecognized preset: {name}")
+
+        if name not in self._thumbnail_callbacks:
+            self._thumbnail_requests.append((name, self._files[name]))
+            self._get_thumbnail_executor().submit(self._next_thumbnail_in_background)
+        self._thumbnail_callbacks.setdefault(name, []).append(callback)
+
+    def prepare_thumbnails(self):
+        """
+            Makes any missing thumbnails in the background, so they're already there the first time
+            the presets are browsed.
+        """
+        for fullpath in self._files.values():
+            self._thumbnails_to_prepare.append((None, fullpath))
+            self._get_thumbnail_executor().submit(self._next_thumbnail_in_background)
+
+    def poll(self):
+        """
+            Delivers any finished loads to their callbacks. Should be called regularly from the main thread.
+        """
+        while True:
+            try:
+                name, thumb = self._thumbnails_finished.get_nowait()
+            except queue.Empty:
+                break
+            for callback in self._thumbnail_callbacks.pop(name, []):
+                callback(thumb)
+
+        while True:
+            try:
+                name, img = self._finished.get_nowait()
+            except queue.Empty:
+                return
+
+            if img is not None:
+                self._keep_loaded(name, img)
+            for callback in self._callbacks.pop(name, []):
+                callback(img)
+
+    def _keep_loaded(self, name, img: numpy.ndarray):
+        if name in self._loaded:
+            self._loaded_bytes -= self._loaded.pop(name).nbytes
+        self._loaded[name] = img
+        self._loaded_bytes += img.nbytes
+        while self._loaded_bytes > self.max_loaded_bytes and len(self._loaded) > 1:
+            _, old_img = self._loaded.popitem(last=False)
+            self._loaded_bytes -= old_img.nbytes
+
+    def _get_thumbnail_executor(self):
+        # separate from the full loads, so a thumbnail never has to wait behind a big decode
+        if self._thumbnail_executor is None:
+            self._thumbnail_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                             thread_name_prefix="preset_thumbnailer")
+        return self._thumbnail_executor
+
+    def _load_in_background(self, name, fullpath):
+        img = None
+        try:
+            img = image_io.read_image(fullpath)
+        except Exception:
+            print(f"ERROR: failed to load preset image: {fullpath}")
+            traceback.print_exc()
+
+        self._finished.put((name, img))
+
+    def _next_thumbnail_in_background(self):
+        # there's one of these submitted per queued thumbnail, so both queues always get emptied
+        if self._thumbnail_requests:
+            name, fullpath = self._thumbnail_requests.popleft()
+        else:
+            name, fullpath = self._thumbnails_to_prepare.popleft()
+
+        thumb = None
+        try:
+            if name is None:
+                thumb_path = self._thumbnail_path(fullpath)
+                if thumb_path is not None and os.path.isfile(thumb_path):
+                    return  # nobody's waiting for it, and it's already there
+            else:
+                thumb = self._read_thumbnail(fullpath)
+            if thumb is None:
+                thumb = self._save_thumbnail(fullpath, image_io.read_image(fullpath, max_size=THUMBNAIL_SIZE))
+        except Exception:
+            # a missing thumbnail isn't worth bothering anyone about
+            traceback.print_exc()
+
+        if name is not None:
+            self._thumbnails_finished.put((name, thumb))
+
+    def _read_thumbnail(self, fullpath) -> typing.Optional[numpy.ndarray]:
+        thumb_path = self._thumbnail_path(fullpath)
+        if thumb_path is not None and os.path.isfile(thumb_path):
+            try:
+                return image_io.read_image(thumb_path)
+            except (ValueError, OSError):
+                traceback.print_exc()
+        return None
+
+    def _thumbnail_path(self, fullpath) -> typing.Optional[str]:
+        # the cache key includes the file's mtime and size, so editing a preset invalidates its thumbnail
+        try:
+            stat = os.stat(fullpath)
+        except OSError:
+            return None
+        return os.path.join(self.thumbnail_dir, f"{_path_hash(fullpath)}_{stat.st_mtime_ns}_{stat.st_size}.png")
+
+    def _save_thumbnail(self, fullpath, img: numpy.ndarray) -> numpy.ndarray:
+        h, w = img.shape[:2]
+        scale = min(1.0, THUMBNAIL_SIZE / max(w, h, 1))
+        thumb = cv2.resize(img, (max(1, round(w * scale)), max(1, round(h * scale))),
+                           interpolation=cv2.INTER_AREA)
+
+        thumb_path = self._thumbnail_path(fullpath)
+        if thumb_path is None:
+            return thumb
+
+        os.makedirs(self.thumbnail_dir, exist_ok=True)
+
+        # clear out stale thumbnails for this file
+        prefix = _path_hash(fullpath) + "_"
+        for f in os.listdir(self.thumbnail_dir):
+            if f.startswith(prefix):
+                os.remove(os.path.join(self.thumbnail_dir, f))
+
+        # write to a temp file first so a half-written thumbnail never gets picked up
+        tmp_path = thumb_path + ".tmp.png"
+        image_io.write_image(tmp_path, thumb)
+        os.replace(tmp_path, thumb_path)
+        return thumb
+
+
+def _path_hash(fullpath) -> str:
+    return hashlib.sha1(os.path.abspath(fullpath).encode("utf-8")).hexdigest()[:16]
@@ -0,0 +1,213 @@
+import importlib.util
+import os
+import queue
+import threading
+import traceback
+
+import numpy
+
+import image_io
+import lazy_import
+
+cv2 = lazy_import.cv2  # imported on first use, it's slow
+
+
+# what goes in each frame
+OUTPUT = "output"
+ERROR = "error"
+SIDE_BY_SIDE = "side by side"  # target, output & error
+
+
+def get_all_layouts():
+    return [OUTPUT, ERROR, SIDE_BY_SIDE]
+
+
+GIF_EXTENSIONS = (".gif",)
+VIDEO_EXTENSIONS = (".mp4", ".avi")
+
+
+def is_gif_supported() -> bool:
+    # GIFs are written with Pillow, which is optional
+    return importlib.util.find_spec("PIL") is not None
+
+
+class ConvergenceRecorder:
+    """
+    Records how a simulation converges as an animation, picked by the file's extension: a GIF (which needs
+    Pillow) or a video (mp4 or avi, via cv2). Call capture() after each step or poll, and it grabs a frame
+    every Nth iteration. Frames are encoded & written on a background thread as they come in, so memory use
+    stays flat no matter how long the recording is.
+
+    At most max_queued frames wait for the encoder. If it falls behind, new frames are dropped (and counted)
+    rather than holding up the simulation, unless drop_frames is False.
+    """
+
+    def __init__(self, filepath, every=1, layout=SIDE_BY_SIDE, fps=10, max_size=None, max_queued=8, drop_frames=True):
+        ext = os.path.splitext(filepath)[1].lower()
+        if ext in GIF_EXTENSIONS and not is_gif_supported():
+            raise ValueError("Recording GIFs needs Pillow (pip install pillow), or record an .mp4 instead")
+        elif ext not in GIF_EXTENSIONS + VIDEO_EXTENSIONS:
+            raise ValueError(f"Can't record to {ext or 'a file with no extension'}, "
+                             f"use one of: {', '.join(GIF_EXTENSIONS + VIDEO_EXTENSIONS)}")
+        if layout not in get_all_layouts():
+            raise ValueError(f"Unrecognized layout: {layout}")
+
+        self.filepath = filepath
+        self.every = max(1, every)
+        self.layout = layout
+        self.fps = fps
+        self.max_size = max_size  # frames are shrunk to fit, if given
+        self.drop_frames = drop_frames
+
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.failed = False  # set if the encoder hit an error, frames are ignored after that
+
+        self._next_iteration = 0
+        self._last_output = None
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._finishing = False
+        self._thread = threading.Thread(target=self._run_encoder, name="recorder", daemon=True)
+        self._thread.start()
+
+    def capture(self, sim) -> bool:
+        """
+            Grabs the simulation's current frame if it's due, and returns whether it did.
+        """
+        output = sim.get_output_image()
+        iteration = sim.get_iteration()
+        if self._finishing or self.failed or output is None or output is self._last_output or \
+                iteration < self._next_iteration:
+            return False
+
+        # the frame has to be put together now, since the simulation might reuse these arrays afterwards
+        frame = self._compose(sim, output)
+        self._last_output = output
+        self._next_iteration = (iteration // self.every + 1) * self.every
+        try:
+            self._queue.put(frame, block=not self.drop_frames)
+        except queue.Full:
+            self.n_dropped += 1
+            return False
+        return True
+
+    def finish(self):
+        """
+            Stops taking frames. The ones already captured still get written, see is_finished().
+        """
+        if not self._finishing:
+            self._finishing = True
+            # this blocks (briefly) if the queue's full, since it can't be dropped. Unless the encoder has died,
+            # in which case nothing would ever make room
+            while True:
+                if not self._thread.is_alive():
+                    self.failed = True  # it only stops by itself once it's been told to
+                    break
+                try:
+                    self._queue.put(None, timeout=0.1)
+                    break
+                except queue.Full:
+                    pass
+
+    def is_finished(self) -> bool:
+        return self._finishing and not self._thread.is_alive()
+
+    def close(self):
+        self.finish()
+        self._thread.join()
+
+    def _compose(self, sim, output: numpy.ndarray) -> numpy.ndarray:
+        if self.layout == OUTPUT:
+            return output.copy()
+
+        error = sim.get_error_image()
+        if error is None:
+            error = numpy.zeros_like(output)
+        if self.layout == ERROR:
+            return error.copy()
+
+        target = sim.get_target_image()
+        if target is None or target.shape != output.shape:
+            target = numpy.zeros_like(output)
+        return numpy.hstack((target, output, error))
+
+    def _run_encoder(self):
+        writer = None
+        size = None
+        try:
+            while True:
+                frame = self._queue.get()
+                if frame is None:
+                    break
+                if self.failed:
+                    continue  # just drain the queue, so capture() never blocks on a dead encoder
+
+                try:
+                    if size is None:
+                        h, w = frame.shape[:2]
+                        scale = 1.0 if self.max_size is None else min(1.0, self.max_size / max(w, h))
+                        size = (max(2, round(w * scale)) // 2 * 2, max(2, round(h * scale)) // 2 * 2)  # codecs like even sizes
+                        writer = _GifWriter(self.filepath, self.fps) if self.filepath.lower().endswith(GIF_EXTENSIONS) \
+                            else _VideoWriter(self.filepath, self.fps, size)
+                    if (frame.shape[1], frame.shape[0]) != size:
+                        # also covers the image changing size partway through
+                        frame = cv2.resize(frame, size, interpolation=cv2.INTER_AREA)
+                    writer.write(frame)
+                    self.n_frames += 1
+                except Exception:
+                    print(f"ERROR: failed to record frame to {self.filepath}")
+                    traceback.print_exc()
+                    self.failed = True
+        finally:
+            if writer is not None:
+                try:
+                    writer.close()
+                except Exception:
+                    traceback.print_exc()
+                    self.failed = True
+            if not self.failed:
+                print(f"INFO: recorded {self.n_frames} frames to {self.filepath}" +
+                      (f" ({self.n_dropped} dropped, the encoder couldn't keep up)" if self.n_dropped > 0 else ""))
+
+
+class _VideoWriter:
+
+    def __init__(self, filepath, fps, size):
+        fourcc = cv2.VideoWriter_fourcc(*("MJPG" if filepath.lower().endswith(".avi") else "mp4v"))
+        self._writer = cv2.VideoWriter(filepath, fourcc, fps, size)
+        if not self._writer.isOpened():
+            raise ValueError(f"Couldn't open video for writing: {filepath}")
+
+    def write(self, frame: numpy.ndarray):
+        self._writer.write(cv2.cvtColor(frame, cv2.COLOR_RGB2BGR))
+
+    def close(self):
+        self._writer.release()
+
+
+class _GifWriter:
+    # Pillow only knows how to save a GIF from a list of all its frames, so this writes the file a frame at a
+    # time using the pieces it's built from (the header, then each frame with its own palette).
+
+    def __init__(self, filepath, fps):
+        from PIL import GifImagePlugin, Image
+        self._gif_plugin = GifImagePlugin
+        self._image_module = Image
+        self._duration_ms = round(1000 / fps)
+        self._file = open(filepath, "wb")
+        self._wrote_header = False
+
+    def write(self, frame: numpy.ndarray):
+        im = self._image_module.fromarray(image_io.to_uint8(frame)).quantize(
+            256, method=self._image_module.Quantize.FASTOCTREE)
+        if not self._wrote_header:
+            header, _ = self._gif_plugin.getheader(im.copy(), info={"loop": 0, "duration": self._duration_ms})
+            self._file.write(b"".join(header))
+            self._wrote_header = True
+        for chunk in self._gif_plugin.getdata(im, include_color_table=True, duration=self._duration_ms):
+            self._file.write(chunk)
+
+    def close(self):
+        if self._wrote_header:
+            self._file.write(b";")  # the trailer
+        self._file.close()
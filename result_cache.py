@@ -0,0 +1,119 @@
+import hashlib
+import json
+import os
+import threading
+import traceback
+import typing
+
+import numpy
+
+
+RESULTS_DIR = "userdata/.results"
+DEFAULT_MAX_BYTES = 256 * 1024 * 1024
+
+
+class CachedResult:
+
+    def __init__(self, px: numpy.ndarray, errors: typing.List[float]):
+        self.px = px  # the simulation's working image, see AbstractIterativeGhastDeblurrer.img_px
+        self.errors = errors  # the error after each iteration
+
+
+class ResultCache:
+    """
+    Finished deblurs, stored on disk as .npz files named by a key (see make_key), so that re-running the same
+    image with the same settings is instant. It's safe to share a directory between processes. Once the files
+    add up to more than max_bytes, the least recently used ones get deleted.
+    """
+
+    def __init__(self, path=RESULTS_DIR, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+
+    def get(self, key) -> typing.Optional[CachedResult]:
+        filepath = self._filepath(key)
+        try:
+            with numpy.load(filepath) as data:
+                res = CachedResult(data["px"], data["errors"].tolist())
+            os.utime(filepath)  # mtime is what eviction goes by (atime is often turned off)
+            return res
+        except FileNotFoundError:
+            return None
+        except Exception:
+            # a corrupt (or concurrently evicted) entry is just a miss
+            traceback.print_exc()
+            return None
+
+    def put(self, key, result: CachedResult):
+        try:
+            os.makedirs(self.path, exist_ok=True)
+            # write to a temp file first so a half-written result never gets picked up
+            filepath = self._filepath(key)
+            tmp_path = f"{filepath}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp_path, "wb") as f:
+                numpy.savez(f, px=result.px, errors=numpy.array(result.errors, dtype=numpy.float64))
+            os.replace(tmp_path, filepath)
+            self.evict()
+        except OSError:
+            traceback.print_exc()
+
+    def evict(self):
+        with self._lock:
+            try:
+                entries = []
+                for f in os.listdir(self.path):
+                    if f.endswith(".npz"):
+                        stat = os.stat(os.path.join(self.path, f))
+                        entries.append((stat.st_mtime, stat.st_size, f))
+            except OSError:
+                return
+
+            total = sum(size for _, size, _ in entries)
+            for _, size, f in sorted(entries):
+                if total <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.path, f))
+                except OSError:
+                    pass  # another process beat us to it
+                total -= size
+
+    def clear(self):
+        with self._lock:
+            if os.path.isdir(self.path):
+                for f in os.listdir(self.path):
+                    if f.endswith(".npz"):
+                        os.remove(os.path.join(self.path, f))
+
+    def _filepath(self, key):
+        return os.path.join(self.path, f"{key}.npz")
+
+
+def hash_array(px: numpy.ndarray) -> str:
+    h = hashlib.sha256()
+    h.update(f"{px.shape}{px.dtype}".encode("utf-8"))
+    h.update(numpy.ascontiguousarray(px).data)
+    return h.hexdigest()
+
+
+def make_key(*parts) -> str:
+    """
+        Hashes any mix of JSON-able values, arrays & strings into a key. Arrays nested inside dicts or
+        lists (e.g. a custom kernel in the blur's params) are hashed by their contents.
+    """
+    def _default(obj):
+        if isinstance(obj, numpy.ndarray):
+            return hash_array(obj)
+        elif isinstance(obj, numpy.generic):
+            return obj.item()
+        raise TypeError(f"Can't hash a {type(obj).__name__}")
+
+    h = hashlib.sha256()
+    for part in parts:
+        if isinstance(part, numpy.ndarray):
+            h.update(hash_array(part).encode("utf-8"))
+        else:
+            h.update(json.dumps(part, sort_keys=True, default=_default).encode("utf-8"))
+        h.update(b"\0")
+    return h.hexdigest()[:32]
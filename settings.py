@@ -0,0 +1,92 @@
+import copy
+
+import blurs
+
+
+class _Settings:
+
+    def to_dict(self) -> dict:
+        return copy.deepcopy(vars(self))
+
+    def load_dict(self, values: dict):
+        for key, val in values.items():
+            setattr(self, key, copy.deepcopy(val))
+
+
+class BlurSettings(_Settings):
+
+    def __init__(self):
+        self.blur_type = "gaussian"
+        self.max_radius = 100
+        self.radius = 15
+        self.backpropagation_blur_strength = 1.0
+        self.backpropagation_type = blurs.SAME_AS_BLUR  # see blurs.get_all_backprojections()
+        self.bonus_params = {}
+
+    def do_blur_array(self, px, strength=1.0):
+        effective_radius = round(strength * self.radius)
+        if effective_radius > 0:
+            my_blur = blurs.get_array_blur_func(self.blur_type)
+            return my_blur(px, effective_radius, params=self.bonus_params)
+        else:
+            return px.copy()
+
+    def get_kernel(self, strength=1.0):
+        return blurs.get_kernel(self.blur_type, round(strength * self.radius), params=self.bonus_params)
+
+    def do_backpropagation_blur_array(self, px, strength=1.0):
+        effective_radius = round(strength * self.radius)
+        if effective_radius > 0:
+            my_blur = blurs.get_backprojection_func(self.backpropagation_type, self.blur_type)
+            return my_blur(px, effective_radius, params=self.bonus_params)
+        else:
+            return px.copy()
+
+
+class SimulationSettings(_Settings):
+
+    def __init__(self):
+        self.iteration_limit = 50
+        self.start_intensity = 4
+        self.end_intensity = 3
+        self.engine = "ghast"  # see deblur.get_all_engines()
+        self.color_mode = "rgb"  # see deblur.get_all_color_modes()
+        self.initial_guess = "blurred"  # see deblur.get_all_initial_guesses()
+        self.regularization = 0.01  # for the wiener & tikhonov initial guesses
+        self.intensity_curve = "linear"  # see deblur.get_all_intensity_curves()
+        self.show_relative_error = True
+
+        # for the adaptive intensity curves, which start at start_intensity and adjust it based on the error
+        self.intensity_growth = 1.1
+        self.intensity_backoff = 0.5
+        self.min_intensity = 0.05
+        self.momentum = 0.6
+
+        self.noise_type = "white"  # see noise.get_all_noise_types()
+        self.noise_seed = None  # None = different every time, see noise.NoiseSource for what else it can be
+
+        # when the blur that makes the target changes, carry on from the current image instead of starting over
+        self.warm_start = False
+
+        # skipping tiles that have converged (only for the ghast engine with a linear intensity curve)
+        self.active_set = False
+        self.tile_size = 64
+        self.freeze_threshold = 0.25  # tiles whose mean error & mean update are both below this get skipped
+        self.full_pass_interval = 10
+
+        # how often the output images get converted for display. A new frame is published at most every
+        # N iterations, and at most this many times per second (0 = no limit).
+        self.display_refresh_iterations = 1
+        self.display_refresh_rate = 15.0
+
+    def get_correction_intensity(self, iterations):
+        if iterations >= self.iteration_limit:
+            return self.end_intensity
+        elif iterations <= 0:
+            return self.start_intensity
+        elif self.intensity_curve == "linear":
+            return self.start_intensity + (iterations / self.iteration_limit) * (self.end_intensity - self.start_intensity)
+        elif self.intensity_curve in ("backtracking", "adaptive", "momentum"):
+            return self.start_intensity  # the deblurrer adjusts it from there
+        else:
+            raise ValueError(f"Unknown intensity_curve style: {self.intensity_curve}")
@@ -0,0 +1,360 @@
+import multiprocessing
+import multiprocessing.shared_memory
+import traceback
+import typing
+
+import numpy
+
+import deblur
+import result_cache
+import settings
+
+
+# layout of the control block, which is a small float64 array shared by both processes
+_SEQ = 0        # sequence number of the most recently published frame (written by the worker)
+_ACK = 1        # sequence number of the frame the UI is currently displaying (written by the UI)
+_EPOCH = 2      # epoch of the published frame, bumped by the UI whenever the target changes or it resets
+_ITERATION = 3  # iteration count of the published frame
+_ERROR = 4      # error of the published frame
+_STEPS_DONE = 5  # total number of step requests the worker has used up (or thrown away due to resets)
+_COMPUTE_MS = 6  # timing stats of the worker's simulation
+_DISPLAY_MS = 7
+_HAS_ERROR = 8  # whether the published frame includes the error image
+_CONTROL_SIZE = 9
+
+_N_IMAGES = 3  # output, blurred output, error
+
+
+def _frame_nbytes(size):
+    w, h = size
+    return w * h * 3
+
+
+def _get_size(px: numpy.ndarray):
+    return px.shape[1], px.shape[0]
+
+
+class ProcessDeblurrer(deblur.AbstractIterativeDeblurrer):
+    """
+    Runs a SettingsControlledGhastDeblurrer in a child process, so that the simulation can't hold the
+    GIL and stall the UI. The target and published frames live in shared memory and only small messages
+    (settings, resets, step requests) go through the pipe.
+
+    Frames are double-buffered: frame N is written into slot N % 2, and the worker won't write frame N + 1
+    until the UI has acknowledged frame N (meaning it no longer displays the slot that's about to be
+    overwritten). So the images we hand out are views into shared memory and never need to be copied.
+    """
+
+    def __init__(self, settings: 'settings.SimulationSettings', deblur_settings: 'settings.BlurSettings',
+                 max_queued_steps=3, result_cache: typing.Optional['result_cache.ResultCache'] = None):
+        super().__init__()
+        self.settings = settings
+        self.deblur_settings = deblur_settings
+        self.max_queued_steps = max_queued_steps
+
+        self._control_shm = multiprocessing.shared_memory.SharedMemory(
+            create=True, size=_CONTROL_SIZE * numpy.dtype(numpy.float64).itemsize)
+        self._control = numpy.ndarray((_CONTROL_SIZE,), dtype=numpy.float64, buffer=self._control_shm.buf)
+        self._control[:] = 0
+
+        ctx = multiprocessing.get_context("spawn")
+        recv_conn, self._conn = ctx.Pipe(duplex=False)
+        # the worker opens its own cache on the same directory, they're safe to share
+        cache_args = None if result_cache is None else (result_cache.path, result_cache.max_bytes)
+        self._process = ctx.Process(target=_run_worker, args=(recv_conn, self._control_shm.name, cache_args),
+                                    name="deblur_worker", daemon=True)
+        self._process.start()
+
+        self._epoch = 0
+        self._region = None
+        self._target: typing.Optional[numpy.ndarray] = None
+        self._target_shm = None
+        self._slot_shms = []
+        self._retired_shms = []
+
+        self._last_sent_settings = None
+        self._steps_requested = 0
+
+        self._iteration = 0
+        self._error = -1.0
+        self._frame_seq = 0
+        self._frames: typing.List[typing.Optional[numpy.ndarray]] = [None] * _N_IMAGES
+        self._error_wanted = True  # the worker skips making error images when they aren't
+
+        self._send_settings_if_changed()
+
+    def get_target_image(self) -> numpy.ndarray:
+        return self._target
+
+    def set_target_image(self, px: typing.Optional[numpy.ndarray], keep_image=False):
+        same_size = px is not None and self._target is not None and px.shape[:2] == self._target.shape[:2]
+        self._target = None if px is None else deblur.to_image(px)
+        if not (keep_image and same_size):
+            self._region = None  # the worker's simulation drops it too
+        self._epoch += 1
+        self._frames = [None] * _N_IMAGES  # these point into the old slots, which we're about to release
+        self._retire(([self._target_shm] if self._target_shm is not None else []) + self._slot_shms)
+        self._target_shm = None
+        self._slot_shms = []
+
+        if px is None:
+            self._conn.send(("target", self._epoch, None, None, None, False))
+        else:
+            # the target's sent as floats, so that high bit depth images keep their precision
+            size = _get_size(self._target)
+            self._target_shm = multiprocessing.shared_memory.SharedMemory(create=True, size=_frame_nbytes(size) * 4)
+            target_px = numpy.ndarray((size[1], size[0], 3), dtype=numpy.float32, buffer=self._target_shm.buf)
+            target_px[:] = px
+            del target_px
+
+            self._slot_shms = [multiprocessing.shared_memory.SharedMemory(create=True, size=_frame_nbytes(size) * _N_IMAGES)
+                               for _ in range(2)]
+            self._conn.send(("target", self._epoch, self._target_shm.name, [shm.name for shm in self._slot_shms], size,
+                             keep_image))
+        self._iteration = 0
+        self._error = -1.0
+
+    def get_output_image(self) -> numpy.ndarray:
+        return self._frames[0]
+
+    def get_blurred_output_image(self) -> numpy.ndarray:
+        return self._frames[1]
+
+    def get_error_image(self) -> typing.Optional[numpy.ndarray]:
+        return self._frames[2]
+
+    def set_error_image_wanted(self, wanted: bool):
+        if wanted != self._error_wanted:
+            self._error_wanted = wanted
+            self._conn.send(("want_error", wanted))
+
+    def get_error(self) -> float:
+        return self._error
+
+    def get_iteration_limit(self) -> int:
+        return self.settings.iteration_limit
+
+    def get_iteration(self) -> int:
+        return self._iteration
+
+    def do_blur(self, px: numpy.ndarray, strength=1.0) -> numpy.ndarray:
+        return self.deblur_settings.do_blur_array(px, strength=strength)
+
+    def set_region(self, rect):
+        self._region = None if rect is None else tuple(int(v) for v in rect)
+        self._conn.send(("region", self._region))
+
+    def get_region(self):
+        return self._region
+
+    def get_stats(self) -> typing.Dict[str, float]:
+        return {"compute_ms": float(self._control[_COMPUTE_MS]), "display_ms": float(self._control[_DISPLAY_MS])}
+
+    def step(self):
+        # steps are requested rather than performed, and only a few are allowed to pile up so that
+        # pausing takes effect quickly
+        self._send_settings_if_changed()
+        queued_steps = self._steps_requested - int(self._control[_STEPS_DONE])
+        if queued_steps < self.max_queued_steps:
+            self._conn.send(("step", 1))
+            self._steps_requested += 1
+
+    def reset(self, iter_count=True, img=True, use_cache=True):
+        self._send_settings_if_changed()
+        self._epoch += 1
+        self._conn.send(("reset", self._epoch, iter_count, img, use_cache))
+        if iter_count:
+            self._iteration = 0
+
+    def poll(self):
+        self._send_settings_if_changed()
+        self._release_retired()
+
+        seq = int(self._control[_SEQ])
+        if seq <= self._frame_seq:
+            return
+
+        # the worker won't touch the control block again until we ack this frame, so these reads are consistent
+        epoch = int(self._control[_EPOCH])
+        if epoch >= self._epoch and len(self._slot_shms) > 0:
+            slot = self._slot_shms[seq % 2]
+            size = _get_size(self._target)
+            n = _frame_nbytes(size)
+            self._frames = [numpy.ndarray((size[1], size[0], 3), dtype=numpy.uint8, buffer=slot.buf, offset=i * n)
+                            for i in range(_N_IMAGES)]
+            if not self._control[_HAS_ERROR]:
+                self._frames[2] = None
+            self._iteration = int(self._control[_ITERATION])
+            self._error = float(self._control[_ERROR])
+
+        self._frame_seq = seq
+        self._control[_ACK] = seq
+
+    def close(self):
+        if self._process is not None:
+            try:
+                self._conn.send(("stop",))
+            except (BrokenPipeError, OSError):
+                pass
+            self._process.join(timeout=2)
+            if self._process.is_alive():
+                self._process.terminate()
+            self._process = None
+
+        self._frames = [None] * _N_IMAGES
+        self._retire(([self._target_shm] if self._target_shm is not None else []) + self._slot_shms + [self._control_shm])
+        self._target_shm = None
+        self._slot_shms = []
+        self._control = None
+        self._release_retired()
+
+    def _send_settings_if_changed(self):
+        current = (self.settings.to_dict(), self.deblur_settings.to_dict())
+        if current != self._last_sent_settings:
+            self._conn.send(("settings",) + current)
+            self._last_sent_settings = current
+
+    def _retire(self, shms):
+        self._retired_shms.extend(shms)
+        self._release_retired()
+
+    def _release_retired(self):
+        still_in_use = []
+        for shm in self._retired_shms:
+            try:
+                shm.close()
+                shm.unlink()
+            except BufferError:
+                still_in_use.append(shm)  # something's still holding a view into it, try again later
+            except FileNotFoundError:
+                pass
+        self._retired_shms = still_in_use
+
+
+def _run_worker(conn, control_name, cache_args=None):
+    control_shm = multiprocessing.shared_memory.SharedMemory(name=control_name)
+    control = numpy.ndarray((_CONTROL_SIZE,), dtype=numpy.float64, buffer=control_shm.buf)
+
+    cache = None if cache_args is None else result_cache.ResultCache(*cache_args)
+    sim = deblur.SettingsControlledGhastDeblurrer(settings.SimulationSettings(), settings.BlurSettings(),
+                                                  result_cache=cache)
+    epoch = 0
+    slots = []
+    size = None
+    queued_steps = 0
+    steps_received = 0
+    needs_publish = False
+    want_error = True
+    last_frame_count = -1
+    seq = int(control[_SEQ])
+
+    def handle(msg):
+        nonlocal epoch, slots, size, queued_steps, steps_received, needs_publish, want_error
+        if msg[0] == "settings":
+            sim.settings.load_dict(msg[1])
+            sim.deblur_settings.load_dict(msg[2])
+        elif msg[0] == "step":
+            queued_steps += msg[1]
+            steps_received += msg[1]
+        elif msg[0] == "want_error":
+            want_error = msg[1]
+            needs_publish = needs_publish or want_error  # so the current frame shows up with one
+        elif msg[0] == "region":
+            sim.set_region(msg[1])
+        elif msg[0] == "reset":
+            epoch = msg[1]
+            queued_steps = 0
+            control[_STEPS_DONE] = steps_received
+            sim.reset(iter_count=msg[2], img=msg[3], use_cache=msg[4])
+            needs_publish = True
+        elif msg[0] == "target":
+            _, epoch, target_name, slot_names, size, keep_image = msg
+            for shm in slots:
+                shm.close()
+            slots = []
+            queued_steps = 0
+            control[_STEPS_DONE] = steps_received
+            if target_name is None:
+                sim.set_target_image(None)
+            else:
+                try:
+                    target_shm = multiprocessing.shared_memory.SharedMemory(name=target_name)
+                    slots = [multiprocessing.shared_memory.SharedMemory(name=name) for name in slot_names]
+                except FileNotFoundError:
+                    return  # the UI has already moved on to a newer target
+                target_view = numpy.ndarray((size[1], size[0], 3), dtype=numpy.float32, buffer=target_shm.buf)
+                target = target_view.copy()
+                del target_view
+                target_shm.close()
+                sim.set_target_image(target, keep_image=keep_image)
+            needs_publish = True
+
+    try:
+        running = True
+        while running:
+            idle = queued_steps <= 0 or sim.is_finished_iterating()
+            if idle:
+                sim.flush_display()  # frames can be throttled, so make sure the last one gets shown
+            if sim.published_frame_count != last_frame_count:
+                needs_publish = True
+            waiting_for_ack = needs_publish and control[_ACK] < seq
+
+            if idle and not needs_publish:
+                timeout = None  # nothing to do until the UI sends something
+            elif idle and waiting_for_ack:
+                timeout = 0.005
+            else:
+                timeout = 0
+
+            if conn.poll(timeout):
+                while True:
+                    msg = conn.recv()
+                    if msg[0] == "stop":
+                        running = False
+                        break
+                    handle(msg)
+                    if not conn.poll(0):
+                        break
+                continue
+
+            if not idle:
+                sim.step()
+                queued_steps -= 1
+                control[_STEPS_DONE] += 1
+                if sim.published_frame_count != last_frame_count:
+                    needs_publish = True
+
+            if needs_publish and control[_ACK] >= seq and len(slots) > 0:
+                n = _frame_nbytes(size)
+                # the error image is only made when asked for, so skip it unless it's wanted
+                imgs = (sim.get_output_image(), sim.get_blurred_output_image(),
+                        sim.get_error_image() if want_error else None)
+                for i, img in enumerate(imgs):
+                    if img is not None:
+                        px = numpy.ndarray((size[1], size[0], 3), dtype=numpy.uint8, buffer=slots[(seq + 1) % 2].buf,
+                                           offset=i * n)
+                        px[:] = img
+                        del px
+                control[_HAS_ERROR] = imgs[2] is not None
+                control[_EPOCH] = epoch
+                control[_ITERATION] = sim.get_iteration()
+                control[_ERROR] = sim.get_error()
+                stats = sim.get_stats()
+                control[_COMPUTE_MS] = stats["compute_ms"]
+                control[_DISPLAY_MS] = stats["display_ms"]
+                last_frame_count = sim.published_frame_count
+                seq += 1
+                control[_SEQ] = seq  # written last, this is what makes the frame visible to the UI
+                needs_publish = False
+            elif needs_publish and len(slots) == 0:
+                last_frame_count = sim.published_frame_count
+                needs_publish = False
+    except (EOFError, BrokenPipeError):
+        pass  # the UI went away
+    except Exception:
+        traceback.print_exc()
+    finally:
+        for shm in slots:
+            shm.close()
+        del control
+        control_shm.close()
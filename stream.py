@@ -0,0 +1,190 @@
+import argparse
+import collections
+import json
+import os
+import sys
+import typing
+
+import numpy
+
+import blurs
+import deblur
+import image_io
+import parallel
+
+
+# Deblurs a stream of frames from stdin to stdout, for use in pipelines, e.g.
+#
+#   ffmpeg -i in.mp4 -f rawvideo -pix_fmt rgb24 - | python stream.py --size 640x360 --radius 5 \
+#       | ffmpeg -f rawvideo -pix_fmt rgb24 -s 640x360 -r 30 -i - out.mp4
+#
+# Frames are either raw RGB (3 bytes per pixel, no headers) of a declared size, or a series of .npy blobs
+# (uint8, or floats in [0, 255], with shapes (h, w, 3) or (h, w)), and come out in the same format & order.
+# Only a few frames are in flight at once, and no more are read until the oldest one has been written. So if
+# the next program in the pipeline falls behind, the one before it gets held up too, rather than frames piling
+# up in memory. Frames are read straight into shared memory, which is what the workers deblur them from.
+
+RAW = "raw"
+NPY = "npy"
+
+
+def get_all_formats():
+    return [RAW, NPY]
+
+
+def read_frame(stream, fmt, size=None) -> typing.Optional[parallel.SharedArray]:
+    """
+        Reads the next frame, or returns None if the stream has ended. size is (width, height), which is required
+        for raw frames, and checked against for .npy frames if given. Raises a ValueError for bad frames.
+    """
+    if len(stream.peek(1)) == 0:
+        return None
+
+    if fmt == RAW:
+        shape, dtype = (size[1], size[0], 3), numpy.uint8
+    else:
+        version = numpy.lib.format.read_magic(stream)
+        if version == (1, 0):
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_1_0(stream)
+        else:
+            shape, fortran_order, dtype = numpy.lib.format.read_array_header_2_0(stream)
+        if fortran_order or len(shape) not in (2, 3) or (len(shape) == 3 and shape[2] != 3):
+            raise ValueError(f"Frames must be C-ordered arrays of shape (h, w, 3) or (h, w), got {shape}")
+        if size is not None and (shape[1], shape[0]) != tuple(size):
+            raise ValueError(f"Expected a {size[0]}x{size[1]} frame, got {shape[1]}x{shape[0]}")
+
+    frame = parallel.SharedArray(shape, dtype)
+    try:
+        _read_into(stream, frame.px)
+        if frame.dtype not in (numpy.uint8, numpy.float32):
+            converted = parallel.SharedArray.from_array(frame.px.astype(numpy.float32))
+            frame.close()
+            frame = converted
+    except Exception:
+        frame.close()
+        raise
+    return frame
+
+
+def _read_into(stream, px: numpy.ndarray):
+    buf = memoryview(px).cast("B")
+    n_read = 0
+    while n_read < len(buf):
+        n = stream.readinto(buf[n_read:])
+        if not n:
+            raise ValueError(f"The stream ended partway through a frame ({n_read}/{len(buf)} bytes)")
+        n_read += n
+
+
+def write_frame(stream, fmt, px: numpy.ndarray):
+    if fmt == RAW:
+        stream.write(memoryview(image_io.to_uint8(px)).cast("B"))
+    else:
+        numpy.lib.format.write_array(stream, px, allow_pickle=False)
+    stream.flush()  # so the next program in the pipeline can start on it
+
+
+def run(in_stream, out_stream, pool: parallel.DeblurPool, fmt=RAW, size=None, window=None) -> int:
+    """
+        Deblurs every frame from in_stream to out_stream, with at most window frames in flight, and returns
+        how many there were.
+    """
+    window = window or 2 * pool.workers
+    pending = collections.deque()  # (frame, future), oldest first
+    n_frames = 0
+    try:
+        ended = False
+        while True:
+            while not ended and len(pending) < window:
+                frame = read_frame(in_stream, fmt, size)
+                if frame is None:
+                    ended = True
+                else:
+                    pending.append((frame, pool.submit(frame)))
+            if len(pending) == 0:
+                return n_frames
+
+            frame, future = pending[0]
+            output = future.result()
+            pending.popleft()
+            try:
+                write_frame(out_stream, fmt, output.px)
+            finally:
+                output.close()
+                frame.close()
+            n_frames += 1
+    finally:
+        for frame, future in pending:
+            try:
+                future.result().close()
+            except Exception:
+                pass  # we're already on our way out because of another error
+            frame.close()
+
+
+def _parse_size(text):
+    try:
+        w, h = (int(v) for v in text.lower().split("x"))
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"expected WIDTHxHEIGHT, e.g. 640x360, got: {text}")
+    return w, h
+
+
+def _parse_setting(text):
+    if "=" not in text:
+        raise argparse.ArgumentTypeError(f"expected KEY=VALUE, got: {text}")
+    key, val = text.split("=", 1)
+    try:
+        val = json.loads(val)
+    except ValueError:
+        pass  # a plain string, e.g. color_mode=luminance
+    return key, val
+
+
+def main(args=None):
+    parser = argparse.ArgumentParser(description="Deblurs a stream of frames from stdin, and writes them to stdout.")
+    parser.add_argument("--format", choices=get_all_formats(), default=RAW,
+                        help="raw RGB frames (needs --size), or .npy arrays")
+    parser.add_argument("--size", type=_parse_size, default=None, help="frame size, e.g. 640x360")
+    parser.add_argument("--blur", default=blurs.GAUSSIAN, help=f"one of: {', '.join(blurs.get_all_blurs())}")
+    parser.add_argument("--radius", type=int, default=15)
+    parser.add_argument("--iterations", type=int, default=50)
+    parser.add_argument("--engine", default=deblur.GHAST, help=f"one of: {', '.join(deblur.get_all_engines())}")
+    parser.add_argument("--set", type=_parse_setting, action="append", default=[], metavar="KEY=VALUE",
+                        help="any other setting, e.g. --set noise_seed=1 (can be given more than once)")
+    parser.add_argument("--workers", type=int, default=None, help="how many processes to use (default: one per core)")
+    parser.add_argument("--window", type=int, default=None, help="max frames in flight (default: twice the workers)")
+    parser.add_argument("--cache", action="store_true", help="reuse (and store) finished results")
+    args = parser.parse_args(args)
+
+    if args.format == RAW and args.size is None:
+        parser.error("--size is required for raw frames")
+
+    # stdout's for frames only, anything else that gets printed goes to stderr
+    out_stream = sys.stdout.buffer
+    sys.stdout = sys.stderr
+
+    kwargs = {"blur_type": args.blur.lower(), "radius": args.radius, "iterations": args.iterations,
+              "engine": args.engine}
+    kwargs.update(args.set)
+    try:
+        pool = parallel.DeblurPool(workers=args.workers, use_cache=args.cache, stdout_to_stderr=True, **kwargs)
+    except (TypeError, ValueError) as e:
+        parser.error(str(e))
+
+    with pool:
+        try:
+            n_frames = run(sys.stdin.buffer, out_stream, pool, fmt=args.format, size=args.size, window=args.window)
+            print(f"INFO: deblurred {n_frames} frames")
+        except BrokenPipeError:
+            # whatever was reading our output has stopped, so there's no point carrying on. Point stdout at
+            # devnull so python doesn't complain about it again on the way out.
+            os.dup2(os.open(os.devnull, os.O_WRONLY), out_stream.fileno())
+            print("INFO: output closed, stopping")
+        except ValueError as e:
+            print(f"ERROR: {e}")
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
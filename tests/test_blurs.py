@@ -0,0 +1,46 @@
+import cv2
+import numpy
+import pytest
+
+import blurs
+
+
+def _random_image(dtype, shape=(48, 64, 3), levels=256, seed=0):
+    return numpy.random.default_rng(seed).integers(0, levels, shape).astype(dtype)
+
+
+@pytest.mark.parametrize("radius", [3, 5, 9, 31])
+def test_median_matches_cv2_for_uint8(radius):
+    px = _random_image(numpy.uint8)
+    numpy.testing.assert_array_equal(blurs.median_array(px, radius), cv2.medianBlur(px, radius))
+
+
+@pytest.mark.parametrize("dtype", [numpy.uint16, numpy.float32])
+@pytest.mark.parametrize("radius", [3, 5])
+def test_median_matches_cv2_for_small_kernels(dtype, radius):
+    # cv2 only takes these dtypes for small kernels
+    px = _random_image(dtype, levels=65536 if dtype == numpy.uint16 else 256)
+    if dtype == numpy.float32:
+        px += numpy.random.default_rng(1).random(px.shape, dtype=numpy.float32)
+    res = blurs.median_array(px, radius)
+    assert res.dtype == dtype
+    numpy.testing.assert_array_equal(res, cv2.medianBlur(px, radius))
+
+
+@pytest.mark.parametrize("dtype", [numpy.uint16, numpy.float32, numpy.float64])
+@pytest.mark.parametrize("radius", [9, 31])
+def test_median_is_exact_for_whole_numbers_of_any_dtype(dtype, radius):
+    px = _random_image(numpy.uint8)
+    res = blurs.median_array(px.astype(dtype) + 1000, radius)
+    assert res.dtype == dtype
+    numpy.testing.assert_array_equal(res, cv2.medianBlur(px, radius).astype(dtype) + 1000)
+
+
+@pytest.mark.parametrize("dtype", [numpy.uint16, numpy.float32, numpy.float64])
+def test_median_of_many_values_is_close(dtype):
+    px = _random_image(numpy.uint8)
+    scale = 250 if dtype == numpy.uint16 else 0.37
+    res = blurs.median_array(px.astype(dtype) * dtype(scale), 9)
+    assert res.dtype == dtype
+    expected = cv2.medianBlur(px, 9).astype(numpy.float64) * scale
+    assert numpy.max(numpy.abs(res.astype(numpy.float64) - expected)) <= scale  # within a level
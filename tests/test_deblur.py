@@ -0,0 +1,73 @@
+import numpy
+
+import deblur
+
+
+def _test_target(size=192, radius=5):
+    # smooth shapes rather than noise, so that some tiles converge & get skipped
+    yy, xx = numpy.mgrid[0:size, 0:size]
+    px = numpy.zeros((size, size, 3), dtype=numpy.float32)
+    px[..., 0] = 128 + 100 * numpy.sin(xx / 9.0)
+    px[(xx - 60) ** 2 + (yy - 60) ** 2 < 900] = 230
+    px[120:170, 20:90] = 20
+    return deblur.create_deblurrer(radius=radius).deblur_settings.do_blur_array(px.astype(numpy.uint8))
+
+
+def test_active_set_steps_leave_published_error_alone():
+    # the error image is built when it's asked for, which must still show the frame it was published with
+    def make_sim():
+        sim = deblur.create_deblurrer(radius=5, iterations=60, active_set=True, tile_size=32, full_pass_interval=20,
+                                      freeze_threshold=1.0, noise_seed=1, display_refresh_iterations=1000)
+        sim.set_target_image(_test_target())
+        return sim
+
+    asked_now, asked_later = make_sim(), make_sim()
+    for _ in range(25):
+        for sim in (asked_now, asked_later):
+            sim.step()
+            sim.flush_display()
+        expected = asked_now.get_error_image()
+        asked_later.step()
+        asked_now.step()
+        numpy.testing.assert_array_equal(asked_later.get_error_image(), expected)
+
+
+def test_only_resets_that_start_the_run_over_restart_the_noise():
+    sim = deblur.create_deblurrer(radius=3, iterations=20, noise_seed=1)
+    sim.set_target_image(_test_target(size=32, radius=3))
+    for _ in range(5):
+        sim.step()
+    stream = sim._noise
+
+    sim.settings.show_relative_error = not sim.settings.show_relative_error
+    sim.reset(iter_count=False, img=False)
+    sim.reset(iter_count=True, img=False)
+    assert sim._noise is stream
+
+    sim.deblur_settings.radius = 4
+    sim.reset(iter_count=True, img=False)
+    assert sim._noise is not stream
+    stream = sim._noise
+
+    sim.reset(iter_count=True, img=True)
+    assert sim._noise is not stream
+
+
+def test_warm_start_keeps_the_region():
+    sim = deblur.create_deblurrer(radius=3, iterations=20, noise_seed=1)
+    sim.set_target_image(_test_target(size=64, radius=3))
+    sim.set_region((8, 8, 24, 24))
+    sim.reset()
+    for _ in range(5):
+        sim.step()
+
+    new_target = _test_target(size=64, radius=4)
+    sim.set_target_image(new_target, keep_image=True)
+    assert sim.get_region() == (8, 8, 24, 24)
+    sim.step()
+    sim.flush_display()
+    output = sim.get_output_image()
+    numpy.testing.assert_array_equal(output[40:], deblur.to_image(new_target)[40:])  # outside the region
+
+    sim.set_target_image(new_target)
+    assert sim.get_region() is None
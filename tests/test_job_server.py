@@ -0,0 +1,36 @@
+import multiprocessing
+import os
+import signal
+import time
+
+import numpy
+
+import job_server
+
+
+def _wait_for(condition, timeout=30):
+    end_time = time.time() + timeout
+    while not condition():
+        assert time.time() < end_time, "timed out"
+        time.sleep(0.02)
+
+
+def test_killed_worker_fails_job_and_queue_keeps_going():
+    queue = job_server.JobQueue(n_workers=1, use_cache=False)
+    try:
+        px = numpy.random.default_rng(0).integers(0, 256, (256, 256, 3), dtype=numpy.uint8)
+        job = queue.submit(px, {"iterations": 100000, "radius": 5})
+        _wait_for(lambda: job.iteration > 0)
+
+        workers = [p for p in multiprocessing.active_children() if p.name == "job_worker"]
+        assert len(workers) == 1
+        os.kill(workers[0].pid, signal.SIGKILL)
+        _wait_for(job.is_finished)
+        assert job.state == job_server.FAILED
+
+        next_job = queue.submit(px[:32, :32], {"iterations": 3, "radius": 2})
+        _wait_for(next_job.is_finished)
+        assert next_job.state == job_server.DONE
+        assert next_job.result_px.shape == (32, 32, 3)
+    finally:
+        queue.close()
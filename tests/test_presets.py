@@ -0,0 +1,48 @@
+import time
+
+import numpy
+
+import image_io
+import presets
+
+
+def _make_library(tmp_path, n_files, size=64, **kwargs):
+    folder = tmp_path / "presets"
+    folder.mkdir()
+    for i in range(n_files):
+        px = numpy.full((size, size, 3), i * 10, dtype=numpy.uint8)
+        image_io.write_image(str(folder / f"{i}.png"), px)
+    return presets.PresetLibrary(str(folder), thumbnail_dir=str(tmp_path / "thumbnails"), **kwargs)
+
+
+def _wait_for(library, results, n):
+    deadline = time.time() + 10
+    while len(results) < n and time.time() < deadline:
+        library.poll()
+        time.sleep(0.01)
+    assert len(results) == n
+
+
+def test_only_the_most_recently_loaded_presets_stay_in_memory(tmp_path):
+    one_image = 64 * 64 * 3
+    library = _make_library(tmp_path, 4, max_loaded_bytes=2 * one_image)
+    results = []
+    for name in ("0.png", "1.png", "2.png", "1.png"):
+        library.request(name, results.append)
+        _wait_for(library, results, len(results) + 1)
+
+    assert list(library._loaded) == ["2.png", "1.png"]
+    assert library._loaded_bytes == 2 * one_image
+
+
+def test_thumbnails_dont_need_a_full_load(tmp_path):
+    library = _make_library(tmp_path, 3, size=300)
+    library.prepare_thumbnails()
+    thumbs = []
+    library.request_thumbnail("2.png", thumbs.append)
+    _wait_for(library, thumbs, 1)
+
+    assert max(thumbs[0].shape[:2]) == presets.THUMBNAIL_SIZE
+    assert not library._loaded
+    library._thumbnail_executor.shutdown(wait=True)
+    assert len(list((tmp_path / "thumbnails").iterdir())) == 3
@@ -0,0 +1,31 @@
+import os
+
+import numpy
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import result_cache
+import ui
+
+from test_deblur import _test_target
+
+
+def test_second_identical_run_comes_from_the_cache(tmp_path, monkeypatch):
+    cache = result_cache.ResultCache(str(tmp_path))
+    monkeypatch.setattr(ui.result_cache, "ResultCache", lambda: cache)
+    target = _test_target(size=64)
+
+    def make_sim():
+        sim = ui.State().simulation
+        sim.settings.iterations = 30
+        sim.set_target_image(target)
+        return sim
+
+    first = make_sim()
+    while not first.is_finished_iterating():
+        first.step()
+    first.flush_display()
+
+    second = make_sim()
+    assert second.get_iteration() == second.get_iteration_limit()
+    numpy.testing.assert_array_equal(second.get_output_image(), first.get_output_image())
@@ -1,39 +1,28 @@
+import collections
 import enum
+import math
 import os
 import sys
+import time
 import traceback
 
+import numpy
 import pygame
 import pygame_gui
 import deblur
 import blurs
+import settings
+import presets
+import image_io
+import lazy_import
+import noise
+import recorder
+import result_cache
+import sim_process
 
 import typing
 
 
-class UiControlledIterativeGhastDeblurrer(deblur.AbstractIterativeGhastDeblurrer):
-
-    def __init__(self, settings: 'SimulationSettings', deblur_settings: 'BlurSettings'):
-        super().__init__()
-        self.settings = settings
-        self.deblur_settings = deblur_settings
-
-    def get_correction_intensity(self, iteration):
-        return self.settings.get_correction_intensity(iteration)
-
-    def show_relative_error(self):
-        return self.settings.show_relative_error
-
-    def get_backpropagation_blur_strength(self) -> float:
-        return self.deblur_settings.backpropagation_blur_strength
-
-    def do_blur(self, surf: pygame.Surface, strength=1.0) -> pygame.Surface:
-        return self.deblur_settings.do_blur(surf, strength=strength)
-
-    def get_iteration_limit(self) -> int:
-        return self.settings.iteration_limit
-
-
 class UIFileDialogFixed(pygame_gui.windows.UIFileDialog):
 
     # Note: don't give this a custom object_id or it'll mess up the styling
@@ -84,6 +73,8 @@ class FileDialogManager:
         self.starting_message_size = message_size
         self.confirm_action = None
 
+        self.progress_dialog = None  # the message dialog, if it's showing the status of a background task
+
     def update_next_starting_path(self, new_path):
         if new_path is not None:
             self.next_starting_path = new_path
@@ -147,6 +138,16 @@ class FileDialogManager:
             self.get_initial_rect(for_file_dialog=False), message, self._ui_manager
         )
 
+    def show_progress(self, message):
+        self.show_message(message)
+        self.progress_dialog = self.message_dialog
+
+    def clear_progress(self):
+        # only close the dialog if the user hasn't dismissed it or opened something else in the meantime
+        if self.progress_dialog is not None and self.progress_dialog is self.message_dialog:
+            self.destroy_message_dialog()
+        self.progress_dialog = None
+
     def show_confirm_prompt(self, message, ok_action, object_id):
         self.destroy_dialogs()
         self.message_dialog = pygame_gui.windows.ui_confirmation_dialog.UIConfirmationDialog(
@@ -161,21 +162,102 @@ class FileDialogManager:
             self.confirm_action = None
 
 
+DEFAULT_NOISE_SEED = 0
+
+
+class BlurredTargetCache:
+    """
+    Targets that have already been made from the original image, by their blur settings, so that dragging
+    the blur slider back & forth doesn't keep reblurring it. The least recently used ones are dropped once
+    they add up to more than max_bytes (but the newest is always kept).
+    """
+
+    def __init__(self, max_bytes=256 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self._items: typing.OrderedDict[str, numpy.ndarray] = collections.OrderedDict()
+        self._n_bytes = 0
+
+    @staticmethod
+    def make_key(blur_settings: 'settings.BlurSettings') -> str:
+        values = blur_settings.to_dict()
+        # only the blur itself matters, the kernel's there in case a custom kernel's file has changed
+        return result_cache.make_key(values["blur_type"], values["radius"], values["bonus_params"],
+                                     blur_settings.get_kernel())
+
+    def get(self, key) -> typing.Optional[numpy.ndarray]:
+        px = self._items.get(key)
+        if px is not None:
+            self._items.move_to_end(key)
+        return px
+
+    def put(self, key, px: numpy.ndarray):
+        if key in self._items:
+            self._n_bytes -= self._items.pop(key).nbytes
+        self._items[key] = px
+        self._n_bytes += px.nbytes
+        while self._n_bytes > self.max_bytes and len(self._items) > 1:
+            _, old_px = self._items.popitem(last=False)
+            self._n_bytes -= old_px.nbytes
+
+    def clear(self):
+        self._items.clear()
+        self._n_bytes = 0
+
+
 class State:
 
-    def __init__(self, blur_settings=None, deblur_settings=None, simulation_settings=None, original_presets=None, blurred_presets=None):
+    def __init__(self, blur_settings=None, deblur_settings=None, simulation_settings=None, original_presets=None, blurred_presets=None,
+                 separate_process=False):
+        # the images are arrays (see image_io), plus Surfaces for displaying them
         self.original_image_file = None
+        self.original_px = None
         self.original_image = None
 
         self.target_image_file = None
+        self.target_px = None
         self.target_image = None
 
-        self.blur_settings = blur_settings or BlurSettings()
-        self.simulation = UiControlledIterativeGhastDeblurrer(simulation_settings or SimulationSettings(),
-                                                              deblur_settings or BlurSettings())
+        self.blur_settings = blur_settings or settings.BlurSettings()
+
+        if simulation_settings is None:
+            simulation_settings = settings.SimulationSettings()
+            # the same noise every run, so that running the same image & settings again gives the same result
+            # (and can come straight from the cache)
+            simulation_settings.noise_seed = DEFAULT_NOISE_SEED
+
+        # finished deblurs, so running the same image & settings again is instant
+        self.result_cache = result_cache.ResultCache()
+        self.blurred_targets = BlurredTargetCache()
+        if separate_process:
+            # keeps the simulation from hogging the GIL (and thus the UI) when images are large
+            self.simulation = sim_process.ProcessDeblurrer(simulation_settings, deblur_settings or settings.BlurSettings(),
+                                                           result_cache=self.result_cache)
+        else:
+            self.simulation = deblur.SettingsControlledGhastDeblurrer(simulation_settings,
+                                                                      deblur_settings or settings.BlurSettings(),
+                                                                      result_cache=self.result_cache)
+
+        self.original_presets: presets.PresetLibrary = original_presets or presets.PresetLibrary()
+        self.blurred_presets: presets.PresetLibrary = blurred_presets or presets.PresetLibrary()
+
+        # the simulation hands out arrays, these are the Surfaces wrapped around the latest ones
+        self._output_surfaces = {}
+
+        # decoding & encoding happens in the background, results come back through poll_background_tasks()
+        self.image_io = image_io.BackgroundImageIO()
+
+        # files that have been selected but are still decoding, and their thumbnails (if cached)
+        self.pending_original_file = None
+        self.pending_target_file = None
+        self.original_image_preview = None
+        self.target_image_preview = None
 
-        self.original_presets = dict(original_presets) if original_presets else {}
-        self.blurred_presets = dict(blurred_presets) if blurred_presets else {}
+        # the animation being recorded (if any), and ones that are still being written out
+        self.recorder: typing.Optional[recorder.ConvergenceRecorder] = None
+        self._recording_stale_output = None
+        self._finishing_recorders = []  # (recorder, on_done)
+        self._recording_on_done = None
+        self._recording_saved_refresh = None  # the display refresh settings from before the recording
 
         # display settings
         self.view_mode = Modes.BLUR_AND_DEBLUR
@@ -183,73 +265,211 @@ class State:
         self.integer_upscale = False
         self.autoplay = True
 
-    def set_original_image(self, surf: typing.Optional[pygame.Surface], filename: str = None):
+    def set_original_image(self, px: typing.Optional[numpy.ndarray], filename: str = None):
+        self.pending_original_file = None
+        self.original_image_preview = None
         self.original_image_file = filename
-        self.original_image = surf.convert() if surf is not None else None
-
-        self.regenerate_target_image()
-
-    def set_target_image(self, surf: typing.Optional[pygame.Surface], filename: str = None):
+        self.original_px = px
+        self.original_image = make_display_surface(px)
+
+        self.blurred_targets.clear()
+        self.regenerate_target_image(keep_image=False)
+
+    def set_target_image(self, px: typing.Optional[numpy.ndarray], filename: str = None, keep_image=False):
+        """
+            If keep_image is set, the simulation carries on from its current image rather than starting over.
+        """
+        self.pending_target_file = None
+        self.target_image_preview = None
         self.target_image_file = filename
-        self.target_image = surf.convert() if surf is not None else None
-
-        self.simulation.set_target_image(self.target_image)
-        self.simulation.reset()
+        self.target_px = px
+        self.target_image = make_display_surface(px)
+
+        self._output_surfaces = {}
+        self.simulation.set_target_image(px, keep_image=keep_image)
+        if not keep_image:
+            self.simulation.reset()
+
+    def is_high_bit_depth(self) -> bool:
+        return image_io.is_high_bit_depth(self.target_px)
+
+    def select_original_preset(self, name):
+        self.pending_original_file = name
+        self.original_image_preview = None
+
+        def on_thumbnail(thumb):
+            if self.pending_original_file == name:  # otherwise it's already loaded, or something else got picked
+                self.original_image_preview = make_display_surface(thumb)
+
+        def on_load(img):
+            if self.pending_original_file == name:  # otherwise something else got picked in the meantime
+                self.set_original_image(img, name if img is not None else None)
+        self.original_presets.request_thumbnail(name, on_thumbnail)
+        self.original_presets.request(name, on_load)
+
+    def select_target_preset(self, name):
+        self.pending_target_file = name
+        self.target_image_preview = None
+
+        def on_thumbnail(thumb):
+            if self.pending_target_file == name:
+                self.target_image_preview = make_display_surface(thumb)
+
+        def on_load(img):
+            if self.pending_target_file == name:
+                if img is not None:
+                    self.set_target_image(img, name)
+                else:
+                    self.set_target_image(None)
+                    self.regenerate_target_image()
+        self.blurred_presets.request_thumbnail(name, on_thumbnail)
+        self.blurred_presets.request(name, on_load)
+
+    def import_original_image(self, filepath, on_done: typing.Callable[[bool], None] = None):
+        self.pending_original_file = filepath
+        self.original_image_preview = None
+
+        def on_preview(img):
+            if self.pending_original_file == filepath:
+                self.original_image_preview = make_display_surface(img)
+
+        def on_load(img):
+            if self.pending_original_file == filepath:
+                if img is not None:
+                    self.set_original_image(img, filepath)
+                else:
+                    self.pending_original_file = None
+                    self.original_image_preview = None
+            if on_done is not None:
+                on_done(img is not None)
+        self.image_io.load(filepath, on_load, preview_callback=on_preview)
+
+    def import_target_image(self, filepath, on_done: typing.Callable[[bool], None] = None):
+        self.pending_target_file = filepath
+        self.target_image_preview = None
+
+        def on_preview(img):
+            if self.pending_target_file == filepath:
+                self.target_image_preview = make_display_surface(img)
+
+        def on_load(img):
+            if self.pending_target_file == filepath:
+                if img is not None:
+                    self.set_target_image(img, filepath)
+                else:
+                    self.pending_target_file = None
+                    self.target_image_preview = None
+            if on_done is not None:
+                on_done(img is not None)
+        self.image_io.load(filepath, on_load, preview_callback=on_preview)
+
+    def export_image(self, px: numpy.ndarray, filepath, on_done: typing.Callable[[bool], None] = None, high_bit_depth=False):
+        self.image_io.save(px, filepath, on_done, high_bit_depth=high_bit_depth)
+
+    def start_recording(self, filepath, on_done: typing.Callable[[bool], None] = None):
+        """
+            Restarts the simulation and records it converging, until it finishes or stop_recording() is called.
+            Raises a ValueError if the file type isn't supported.
+        """
+        self.stop_recording()
+        limit = self.get_simulation_settings().iteration_limit
+        self.recorder = recorder.ConvergenceRecorder(filepath, every=max(1, limit // 100))  # at most ~100 frames
+        self._recording_on_done = on_done
+
+        # frames are only captured when the simulation publishes one, so make sure that's every time one's due
+        sim_settings = self.get_simulation_settings()
+        self._recording_saved_refresh = (sim_settings.display_refresh_iterations, sim_settings.display_refresh_rate)
+        sim_settings.display_refresh_iterations = self.recorder.every
+        sim_settings.display_refresh_rate = 0
+        # a separate-process simulation keeps showing its last frame until the reset goes through
+        self._recording_stale_output = self.simulation.get_output_image()
+        self.simulation.reset(iter_count=True, img=True, use_cache=False)  # a cached result would skip to the end
+        self.autoplay = True
 
-    def regenerate_target_image(self):
+    def is_recording(self) -> bool:
+        return self.recorder is not None
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.finish()
+            self._finishing_recorders.append((self.recorder, self._recording_on_done))
+            self.recorder = None
+            self._recording_stale_output = None
+            self._recording_on_done = None
+            sim_settings = self.get_simulation_settings()
+            sim_settings.display_refresh_iterations, sim_settings.display_refresh_rate = self._recording_saved_refresh
+            self._recording_saved_refresh = None
+
+    def close_recordings(self):
+        self.stop_recording()
+        for rec, _ in self._finishing_recorders:
+            rec.close()
+        self._finishing_recorders = []
+
+    def poll_background_tasks(self):
+        self.original_presets.poll()
+        self.blurred_presets.poll()
+        self.image_io.poll()
+        self.simulation.poll()
+
+        if self.recorder is not None:
+            if self.simulation.get_output_image() is not self._recording_stale_output:
+                self._recording_stale_output = None
+                self.recorder.capture(self.simulation)
+            if self.simulation.is_finished_iterating() and self._recording_stale_output is None:
+                self.stop_recording()
+        for rec, on_done in list(self._finishing_recorders):
+            if rec.is_finished():
+                self._finishing_recorders.remove((rec, on_done))
+                if on_done is not None:
+                    on_done(not rec.failed)
+
+    def regenerate_target_image(self, keep_image=None):
+        """
+            Reblurs the original image to make the target (if it's not a loaded one). keep_image is passed on to
+            set_target_image, and defaults to the simulation's warm_start setting.
+        """
+        if keep_image is None:
+            keep_image = self.get_simulation_settings().warm_start
         if self.target_image_file is not None:
             pass  # we're not using a generated target image, no-op
-        elif self.original_image is not None:
-            self.set_target_image(self.get_blur_settings().do_blur(self.original_image))
+        elif self.original_px is not None:
+            key = BlurredTargetCache.make_key(self.get_blur_settings())
+            px = self.blurred_targets.get(key)
+            if px is None:
+                px = self.get_blur_settings().do_blur_array(self.original_px)
+                self.blurred_targets.put(key, px)
+            keep_image = keep_image and self.target_px is not None and self.target_px.shape == px.shape
+            self.set_target_image(px, keep_image=keep_image)
         else:
             self.set_target_image(None)
 
-    def get_blur_settings(self) -> 'BlurSettings':
-        return self.blur_settings
-
-    def get_deblur_settings(self) -> 'BlurSettings':
-        return self.simulation.deblur_settings
-
-    def get_simulation_settings(self) -> 'SimulationSettings':
-        return self.simulation.settings
-
-
-class BlurSettings:
+    def get_output_surface(self) -> typing.Optional[pygame.Surface]:
+        return self._wrap_output("output", self.simulation.get_output_image())
 
-    def __init__(self):
-        self.blur_type = "gaussian"
-        self.max_radius = 100
-        self.radius = 15
-        self.backpropagation_blur_strength = 1.0
-        self.bonus_params = {}
+    def get_blurred_output_surface(self) -> typing.Optional[pygame.Surface]:
+        return self._wrap_output("blurred", self.simulation.get_blurred_output_image())
 
-    def do_blur(self, surf, strength=1.0):
-        effective_radius = round(strength * self.radius)
-        if effective_radius > 0:
-            my_blur = blurs.get_blur_func(self.blur_type)
-            return my_blur(surf, effective_radius, params=self.bonus_params)
-        else:
-            return surf.copy()
+    def get_error_surface(self) -> typing.Optional[pygame.Surface]:
+        return self._wrap_output("error", self.simulation.get_error_image())
 
+    def _wrap_output(self, key, px: typing.Optional[numpy.ndarray]) -> typing.Optional[pygame.Surface]:
+        # every published frame is a new array, so each one only gets wrapped once
+        if px is None:
+            self._output_surfaces.pop(key, None)
+            return None
+        if key not in self._output_surfaces or self._output_surfaces[key][0] is not px:
+            self._output_surfaces[key] = (px, array_to_surface(px))
+        return self._output_surfaces[key][1]
 
-class SimulationSettings:
+    def get_blur_settings(self) -> 'settings.BlurSettings':
+        return self.blur_settings
 
-    def __init__(self):
-        self.iteration_limit = 50
-        self.start_intensity = 4
-        self.end_intensity = 3
-        self.intensity_curve = "linear"
-        self.show_relative_error = True
+    def get_deblur_settings(self) -> 'settings.BlurSettings':
+        return self.simulation.deblur_settings
 
-    def get_correction_intensity(self, iterations):
-        if iterations >= self.iteration_limit:
-            return self.end_intensity
-        elif iterations <= 0:
-            return self.start_intensity
-        elif self.intensity_curve == "linear":
-            return self.start_intensity + (iterations / self.iteration_limit) * (self.end_intensity - self.start_intensity)
-        else:
-            raise ValueError(f"Unknown intensity_curve style: {self.intensity_curve}")
+    def get_simulation_settings(self) -> 'settings.SimulationSettings':
+        return self.simulation.settings
 
 
 def split_rect(rect: pygame.Rect, n: int, horizontally=True) -> typing.List[pygame.Rect]:
@@ -261,18 +481,46 @@ def split_rect(rect: pygame.Rect, n: int, horizontally=True) -> typing.List[pyga
         return [pygame.Rect(rect[0], ys[i], rect[2], ys[i + 1] - ys[i]) for i in range(n)]
 
 
-def render_in_rect_responsibly(img: pygame.Surface, rect: pygame.Rect, dest: pygame.Surface, integer_upscale_only=True):
-    if img is not None:
-        w, h = img.get_size()
+def fit_in_rect(size, rect: pygame.Rect, integer_upscale_only=True) -> pygame.Rect:
+    """
+        Returns where an image of the given size gets drawn by render_in_rect_responsibly.
+    """
+    w, h = size
+    scale = min(rect.width / w, rect.height / h)
+    if scale > 1 and integer_upscale_only:
+        scale = int(scale)
+    scaled_w, scaled_h = int(w * scale), int(h * scale)
+    return pygame.Rect(rect.centerx - scaled_w // 2, rect.centery - scaled_h // 2, scaled_w, scaled_h)
+
+
+def array_to_surface(px: numpy.ndarray) -> pygame.Surface:
+    """
+        Wraps a uint8 array of shape (height, width, 3) in a Surface. No copy is made, so the array must not change
+        while the Surface is in use.
+    """
+    px = numpy.ascontiguousarray(px)
+    return pygame.image.frombuffer(px, (px.shape[1], px.shape[0]), "RGB")
+
+
+def make_display_surface(px: typing.Optional[numpy.ndarray]) -> typing.Optional[pygame.Surface]:
+    """
+        Makes a Surface (in the display's pixel format, if there is a display) that shows an image array.
+    """
+    if px is None:
+        return None
+    surf = array_to_surface(image_io.to_uint8(px))
+    return surf.convert() if pygame.display.get_surface() is not None else surf.copy()
+
+
+def _get_minimum_height(panel: typing.Optional['ControlPanel']) -> int:
+    return 0 if panel is None else panel.get_minimum_height()  # panels that haven't been built yet take no space
 
-        scale = min(rect.width / w, rect.height / h)
-        if scale > 1 and integer_upscale_only:
-            scale = int(scale)
-        scaled_img = pygame.transform.scale(img, (int(w * scale), int(h * scale)))
 
-        x = rect.centerx - scaled_img.get_width() // 2
-        y = rect.centery - scaled_img.get_height() // 2
-        dest.blit(scaled_img, (x, y))
+def render_in_rect_responsibly(img: pygame.Surface, rect: pygame.Rect, dest: pygame.Surface, integer_upscale_only=True):
+    if img is not None:
+        dest_rect = fit_in_rect(img.get_size(), rect, integer_upscale_only=integer_upscale_only)
+        scaled_img = pygame.transform.scale(img, dest_rect.size)
+        dest.blit(scaled_img, dest_rect.topleft)
 
 
 def title_case(text: str) -> str:
@@ -294,6 +542,28 @@ def resource_path(relative_path):
     return os.path.normpath(os.path.join(base_path, relative_path))
 
 
+class StartupTimer:
+    """
+        Measures how long each phase of startup takes, so that slow launches can be pinned on something.
+    """
+
+    def __init__(self, start_time=None):
+        self.start_time = start_time if start_time is not None else time.perf_counter()
+        self._last_time = self.start_time
+        self.phases = []  # (name, ms)
+
+    def mark(self, phase_name):
+        now = time.perf_counter()
+        self.phases.append((phase_name, (now - self._last_time) * 1000))
+        self._last_time = now
+
+    def report(self, title) -> str:
+        total_ms = (self._last_time - self.start_time) * 1000
+        phases = ", ".join(f"{name} {ms:.0f}ms" for name, ms in self.phases)
+        self.phases = []
+        return f"{title} after {total_ms:.0f}ms ({phases})"
+
+
 class Modes(enum.Enum):
 
     BLUR_AND_DEBLUR = "blur & deblur"
@@ -308,6 +578,12 @@ class Modes(enum.Enum):
             raise ValueError(f"unrecognized view mode: {value}")
 
 
+# module-level since BlurControlPanel shadows the name
+ENGINES = deblur.get_all_engines()
+INITIAL_GUESSES = deblur.get_all_initial_guesses()
+COLOR_MODES = deblur.get_all_color_modes()
+INTENSITY_CURVES = deblur.get_all_intensity_curves()
+
 LINE_HEIGHT = 24
 SHORT_LABEL_WIDTH = 6 * 24
 SMALL_GAP = 4
@@ -419,6 +695,13 @@ class ControlPanel:
 
 class BlurControlPanel(ControlPanel):
 
+    UPDATE_ALL_TILES = "Update All"
+    SKIP_CONVERGED_TILES = "Skip Converged"
+
+    # what happens when the blur (and so the target) changes
+    RESTART = "Restart"
+    KEEP_GUESS = "Keep Guess"
+
     def __init__(self, rect, manager, state, deblur=False):
         super().__init__(rect, manager)
         self.is_deblur = deblur
@@ -480,6 +763,103 @@ class BlurControlPanel(ControlPanel):
                 container=self.panel, click_increment=1, object_id="#upper_intensity_slider"
             )
 
+            self.engine_label = pygame_gui.elements.UILabel(
+                rect, "Engine:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.engine_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, ENGINES)),
+                title_case(self.state.get_simulation_settings().engine),
+                rect, manager, container=self.panel,
+                object_id="#engine_selector"
+            )
+
+            self.color_mode_label = pygame_gui.elements.UILabel(
+                rect, "Colors:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.color_mode_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, COLOR_MODES)),
+                title_case(self.state.get_simulation_settings().color_mode),
+                rect, manager, container=self.panel,
+                object_id="#color_mode_selector"
+            )
+
+            self.initial_guess_label = pygame_gui.elements.UILabel(
+                rect, "Start From:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.initial_guess_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, INITIAL_GUESSES)),
+                title_case(self.state.get_simulation_settings().initial_guess),
+                rect, manager, container=self.panel,
+                object_id="#initial_guess_selector"
+            )
+
+            self.warm_start_label = pygame_gui.elements.UILabel(
+                rect, "On Reblur:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.warm_start_selector = pygame_gui.elements.UIDropDownMenu(
+                [BlurControlPanel.RESTART, BlurControlPanel.KEEP_GUESS],
+                BlurControlPanel.KEEP_GUESS if self.state.get_simulation_settings().warm_start
+                else BlurControlPanel.RESTART,
+                rect, manager, container=self.panel,
+                object_id="#warm_start_selector"
+            )
+
+            self.regularization_label = pygame_gui.elements.UILabel(
+                rect, "Smoothing: -1", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            # log scale, from 10^-4 to 10^0
+            self.regularization_slider = pygame_gui.elements.UIHorizontalSlider(
+                rect, round(10 * (math.log10(self.state.get_simulation_settings().regularization) + 4)), (0, 40), manager,
+                container=self.panel, click_increment=1, object_id="#regularization_slider"
+            )
+
+            self.noise_type_label = pygame_gui.elements.UILabel(
+                rect, "Noise:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.noise_type_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, noise.get_all_noise_types())),
+                title_case(self.state.get_simulation_settings().noise_type),
+                rect, manager, container=self.panel,
+                object_id="#noise_type_selector"
+            )
+
+            self.active_set_label = pygame_gui.elements.UILabel(
+                rect, "Tiles:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.active_set_selector = pygame_gui.elements.UIDropDownMenu(
+                [BlurControlPanel.UPDATE_ALL_TILES, BlurControlPanel.SKIP_CONVERGED_TILES],
+                BlurControlPanel.SKIP_CONVERGED_TILES if self.state.get_simulation_settings().active_set
+                else BlurControlPanel.UPDATE_ALL_TILES,
+                rect, manager, container=self.panel,
+                object_id="#active_set_selector"
+            )
+
+            self.intensity_curve_label = pygame_gui.elements.UILabel(
+                rect, "Power Curve:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.intensity_curve_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, INTENSITY_CURVES)),
+                title_case(self.state.get_simulation_settings().intensity_curve),
+                rect, manager, container=self.panel,
+                object_id="#intensity_curve_selector"
+            )
+
             self.backpropagation_blur_strength_label = pygame_gui.elements.UILabel(
                 rect, "Anti-Blur: 100%", manager=manager, container=self.panel,
                 object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
@@ -490,6 +870,18 @@ class BlurControlPanel(ControlPanel):
                 container=self.panel, click_increment=1, object_id="#bp_blur_strength_slider",
             )
 
+            self.backpropagation_type_label = pygame_gui.elements.UILabel(
+                rect, "Anti-Blur Type:", manager=manager, container=self.panel,
+                object_id=pygame_gui.core.ObjectID(class_id="@left_aligned", object_id="label")
+            )
+
+            self.backpropagation_type_selector = pygame_gui.elements.UIDropDownMenu(
+                list(map(title_case, blurs.get_all_backprojections())),
+                title_case(self.settings.backpropagation_type),
+                rect, manager, container=self.panel,
+                object_id="#bp_type_selector"
+            )
+
         self.item_layouts = [
             (self.title_label, LINE_HEIGHT),
             (None, SMALL_GAP),
@@ -501,9 +893,18 @@ class BlurControlPanel(ControlPanel):
             self.item_layouts.extend([
                 (None, SMALL_GAP),
                 (self.advanced_options_label, LINE_HEIGHT),
+                ([(self.engine_label, SHORT_LABEL_WIDTH), (lambda: self.engine_selector, 1.0)], LINE_HEIGHT),
+                ([(self.color_mode_label, SHORT_LABEL_WIDTH), (lambda: self.color_mode_selector, 1.0)], LINE_HEIGHT),
+                ([(self.initial_guess_label, SHORT_LABEL_WIDTH), (lambda: self.initial_guess_selector, 1.0)], LINE_HEIGHT),
+                ([(self.warm_start_label, SHORT_LABEL_WIDTH), (lambda: self.warm_start_selector, 1.0)], LINE_HEIGHT),
+                ([(self.regularization_label, SHORT_LABEL_WIDTH), (self.regularization_slider, 1.0)], LINE_HEIGHT),
                 ([(self.start_intensity_label, SHORT_LABEL_WIDTH), (self.correction_intensity_lower_slider, 1.0)], LINE_HEIGHT),
                 ([(self.end_intensity_label, SHORT_LABEL_WIDTH), (self.correction_intensity_upper_slider, 1.0)], LINE_HEIGHT),
-                ([(self.backpropagation_blur_strength_label, SHORT_LABEL_WIDTH), (self.backpropagation_blur_strength_slider, 1.0)], LINE_HEIGHT)
+                ([(self.intensity_curve_label, SHORT_LABEL_WIDTH), (lambda: self.intensity_curve_selector, 1.0)], LINE_HEIGHT),
+                ([(self.noise_type_label, SHORT_LABEL_WIDTH), (lambda: self.noise_type_selector, 1.0)], LINE_HEIGHT),
+                ([(self.active_set_label, SHORT_LABEL_WIDTH), (lambda: self.active_set_selector, 1.0)], LINE_HEIGHT),
+                ([(self.backpropagation_blur_strength_label, SHORT_LABEL_WIDTH), (self.backpropagation_blur_strength_slider, 1.0)], LINE_HEIGHT),
+                ([(self.backpropagation_type_label, SHORT_LABEL_WIDTH), (lambda: self.backpropagation_type_selector, 1.0)], LINE_HEIGHT)
             ])
         self.item_layouts.append((None, SMALL_GAP))
 
@@ -517,6 +918,8 @@ class BlurControlPanel(ControlPanel):
             self.start_intensity_label.set_text(f"High Power: {simul_settings.start_intensity:.1f}")
             self.end_intensity_label.set_text(  f"Low Power:  {simul_settings.end_intensity:.1f}")
 
+            self.regularization_label.set_text(f"Smoothing:  {simul_settings.regularization:.4f}")
+
             bp_blur_str = int(self.state.get_deblur_settings().backpropagation_blur_strength * 100)
             self.backpropagation_blur_strength_label.set_text( f"Anti-Blur:  {bp_blur_str}%")
 
@@ -648,6 +1051,7 @@ class TopControlPanel(ControlPanel):
     BLURRED_IMAGE = "Blurred Image"
     DEBLURRED_IMAGE = "Deblurred Img."
     ERROR_IMAGE = "Error Image"
+    ANIMATION = "Animation"
 
     def __init__(self, rect, manager, state):
         super().__init__(rect, manager)
@@ -694,7 +1098,8 @@ class TopControlPanel(ControlPanel):
         self.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
 
         self.export_button = pygame_gui.elements.UIDropDownMenu(
-            [TopControlPanel.EXPORT, TopControlPanel.DEBLURRED_IMAGE, TopControlPanel.BLURRED_IMAGE, TopControlPanel.ERROR_IMAGE],
+            [TopControlPanel.EXPORT, TopControlPanel.DEBLURRED_IMAGE, TopControlPanel.BLURRED_IMAGE, TopControlPanel.ERROR_IMAGE,
+             TopControlPanel.ANIMATION],
             TopControlPanel.EXPORT,
             pygame.Rect(0, 24, rect.width, 24),
             manager, container=self.panel,
@@ -726,7 +1131,9 @@ class TopControlPanel(ControlPanel):
     def update_preset_selectors(self, active_original_item, active_blurred_item):
         orig_to_select = TopControlPanel.NONE
         orig_preset_list = [TopControlPanel.NONE]
-        for (path, img) in self.state.original_presets.items():
+        if self.state.pending_original_file is not None:
+            active_original_item = self.state.pending_original_file
+        for path in self.state.original_presets:
             _, tail = os.path.split(path)
             orig_preset_list.append(tail)
             if active_original_item == path:
@@ -742,7 +1149,9 @@ class TopControlPanel(ControlPanel):
 
         blurred_to_select = TopControlPanel.USE_ORIG
         blurred_preset_list = [TopControlPanel.USE_ORIG]
-        for (path, img) in self.state.blurred_presets.items():
+        if self.state.pending_target_file is not None:
+            active_blurred_item = self.state.pending_target_file
+        for path in self.state.blurred_presets:
             _, tail = os.path.split(path)
             blurred_preset_list.append(tail)
             if active_blurred_item == path:
@@ -786,8 +1195,9 @@ class ViewItems(enum.Enum):
 
 class MainWindow:
 
-    def __init__(self, size=(960, 480), state=None):
+    def __init__(self, size=(960, 480), state=None, startup_timer=None):
         self.state: State = state or State()
+        self.startup_timer: StartupTimer = startup_timer or StartupTimer()
 
         self.top_toolbar: TopControlPanel = None
         self.blur_controls: BlurControlPanel = None
@@ -797,9 +1207,16 @@ class MainWindow:
 
         self._base_size = size
         self._fps = 60
+
+        # region selection, in target image coordinates
+        self._drag_start = None
+        self._drag_end = None
         self._clock = None
         self._ui_manager = None
 
+        # control panels that haven't been built yet (attribute name -> ViewItem), see _build_next_panel
+        self._pending_panels = {}
+
     def set_view_mode(self, mode):
         self.state.view_mode = mode
 
@@ -808,15 +1225,15 @@ class MainWindow:
         full_rect = pygame.display.get_surface().get_rect()
 
         if not self.state.hide_controls:
-            top_toolbar_rect = pygame.Rect(0, 0, full_rect.width, self.top_toolbar.get_minimum_height())
+            top_toolbar_rect = pygame.Rect(0, 0, full_rect.width, _get_minimum_height(self.top_toolbar))
             full_rect = pygame.Rect(full_rect.x,
                                     full_rect.y + top_toolbar_rect.y + top_toolbar_rect.height,
                                     full_rect.width, full_rect.height - (top_toolbar_rect.y + top_toolbar_rect.height))
             layout[ViewItems.TOP_TOOLBAR] = top_toolbar_rect
 
         if self.state.view_mode == Modes.DEBLUR:
-            controls_height = max(self.simulation_controls.get_minimum_height(),
-                                  self.deblur_controls.get_minimum_height())
+            controls_height = max(_get_minimum_height(self.simulation_controls),
+                                  _get_minimum_height(self.deblur_controls))
             image_rect_height = full_rect[3] if self.state.hide_controls else full_rect[3] - controls_height
             image_rect = pygame.Rect(full_rect[0], full_rect[1], full_rect[2], image_rect_height)
             vert_split = split_rect(image_rect, 2, horizontally=False)
@@ -836,9 +1253,9 @@ class MainWindow:
 
             return layout
         elif self.state.view_mode == Modes.BLUR_AND_DEBLUR:
-            controls_height = max(self.blur_controls.get_minimum_height(),
-                                  self.simulation_controls.get_minimum_height(),
-                                  self.deblur_controls.get_minimum_height())
+            controls_height = max(_get_minimum_height(self.blur_controls),
+                                  _get_minimum_height(self.simulation_controls),
+                                  _get_minimum_height(self.deblur_controls))
             image_rect_height = full_rect[3] if self.state.hide_controls else full_rect[3] - controls_height
             image_rect = pygame.Rect(full_rect[0], full_rect[1], full_rect[2], image_rect_height)
             split_3x1 = split_rect(image_rect, 3, horizontally=True)
@@ -858,6 +1275,21 @@ class MainWindow:
 
         return layout
 
+    def _build_next_panel(self, layout):
+        # panels that are on screen go first, the rest (e.g. the blur controls in deblur mode) get built last
+        visible = [name for name, item in self._pending_panels.items() if layout.get(item) is not None]
+        name = visible[0] if len(visible) > 0 else next(iter(self._pending_panels))
+        del self._pending_panels[name]
+
+        dummy = pygame.Rect(0, 0, 200, 200)
+        if name == "simulation_controls":
+            self.simulation_controls = SimulationControlPanel(dummy, self._ui_manager, self.state)
+        elif name == "blur_controls":
+            self.blur_controls = BlurControlPanel(dummy, self._ui_manager, self.state)
+        elif name == "deblur_controls":
+            self.deblur_controls = BlurControlPanel(dummy, self._ui_manager, self.state, deblur=True)
+        self.startup_timer.mark(name.replace("_", " "))
+
     def _update_ui_positions(self, layout):
         controls = {
             ViewItems.TOP_TOOLBAR: self.top_toolbar,
@@ -874,11 +1306,20 @@ class MainWindow:
         self._update_ui_positions(layout)
         self._ui_manager.update(dt)
 
+        exporting_error = clean_for_obj_id(TopControlPanel.ERROR_IMAGE) in self.file_dialog_manager.object_id
+        self.state.simulation.set_error_image_wanted(layout.get(ViewItems.ERROR_IMAGE_PANE) is not None or
+                                                     self.state.is_recording() or exporting_error)
+        self.state.poll_background_tasks()
+
         simul = self.state.simulation
         if self.state.autoplay and not simul.is_finished_iterating():
             simul.step()
 
-        caption = f"Deblur [iter={simul.get_iteration()}, error={simul.get_error():.2f}, fps={self._clock.get_fps():.1f}]"
+        caption = f"Deblur [iter={simul.get_iteration()}, error={simul.get_error():.2f}, fps={self._clock.get_fps():.1f}"
+        stats = simul.get_stats()
+        if "compute_ms" in stats and "display_ms" in stats:
+            caption += f", step={stats['compute_ms']:.1f}ms, display={stats['display_ms']:.1f}ms"
+        caption += "]"
         pygame.display.set_caption(caption)
 
     def _render(self, layout):
@@ -889,26 +1330,121 @@ class MainWindow:
         self._ui_manager.draw_ui(screen)
 
     def _render_layout(self, layout):
+        # these are lambdas so that images which aren't in the current layout never get built
         images = {
-            ViewItems.TARGET_IMAGE_PANE: self.state.target_image,
-            ViewItems.OUTPUT_IMAGE_PANE: self.state.simulation.get_output_image(),
-            ViewItems.BLURRED_OUTPUT_IMAGE_PANE: self.state.simulation.get_blurred_output_image(),
-            ViewItems.ERROR_IMAGE_PANE: self.state.simulation.get_error_image(),
-            ViewItems.ORIGINAL_IMAGE_PANE: self.state.original_image
+            ViewItems.TARGET_IMAGE_PANE: lambda: self.state.target_image_preview if self.state.target_image_preview is not None
+                                                 else self.state.target_image,
+            ViewItems.OUTPUT_IMAGE_PANE: self.state.get_output_surface,
+            ViewItems.BLURRED_OUTPUT_IMAGE_PANE: self.state.get_blurred_output_surface,
+            ViewItems.ERROR_IMAGE_PANE: self.state.get_error_surface,
+            ViewItems.ORIGINAL_IMAGE_PANE: lambda: self.state.original_image_preview if self.state.original_image_preview is not None
+                                                   else self.state.original_image
         }
         screen = pygame.display.get_surface()
         for key, rect in layout.items():
             if key in images and rect is not None and rect.width >= 0 and rect.height >= 0:
-                render_in_rect_responsibly(images[key], rect, screen, integer_upscale_only=self.state.integer_upscale)
+                render_in_rect_responsibly(images[key](), rect, screen, integer_upscale_only=self.state.integer_upscale)
+
+        # outline the deblurred region (and the one being dragged out, if any)
+        outlines = []
+        if self.state.simulation.get_region() is not None:
+            outlines.append((self.state.simulation.get_region(), (255, 255, 0)))
+        if self._drag_start is not None and self._drag_end is not None:
+            outlines.append((self._get_drag_rect(), (255, 255, 255)))
+        if len(outlines) > 0 and self.state.target_image is not None:
+            for key in (ViewItems.TARGET_IMAGE_PANE, ViewItems.OUTPUT_IMAGE_PANE):
+                if layout[key] is not None:
+                    img_rect = fit_in_rect(self.state.target_image.get_size(), layout[key],
+                                           integer_upscale_only=self.state.integer_upscale)
+                    scale = img_rect.width / self.state.target_image.get_width()
+                    for region, color in outlines:
+                        x, y, w, h = region
+                        pygame.draw.rect(screen, color, pygame.Rect(img_rect.x + int(x * scale), img_rect.y + int(y * scale),
+                                                                    max(1, int(w * scale)), max(1, int(h * scale))), width=1)
+
+    def _screen_to_image_pos(self, pos, layout, clamp=False):
+        # returns the target image coordinates under a point in the target or output pane, or None
+        target = self.state.target_image
+        if target is None:
+            return None
+        for key in (ViewItems.TARGET_IMAGE_PANE, ViewItems.OUTPUT_IMAGE_PANE):
+            if layout[key] is not None and (clamp or layout[key].collidepoint(pos)):
+                img_rect = fit_in_rect(target.get_size(), layout[key], integer_upscale_only=self.state.integer_upscale)
+                if clamp or img_rect.collidepoint(pos):
+                    scale = img_rect.width / target.get_width()
+                    x = int((pos[0] - img_rect.x) / scale)
+                    y = int((pos[1] - img_rect.y) / scale)
+                    return (max(0, min(x, target.get_width())), max(0, min(y, target.get_height())))
+        return None
+
+    def _get_drag_rect(self):
+        (x1, y1), (x2, y2) = self._drag_start, self._drag_end
+        return (min(x1, x2), min(y1, y2), abs(x2 - x1), abs(y2 - y1))
+
+    def set_region(self, rect):
+        self.state.simulation.set_region(rect)
+        self.state.simulation.reset(iter_count=True, img=True)
+
+    def handle_mouse_event(self, e):
+        layout = self.get_layout()
+        if e.type == pygame.MOUSEBUTTONDOWN and e.button == 1:
+            self._drag_start = self._screen_to_image_pos(e.pos, layout)
+            self._drag_end = None
+        elif e.type == pygame.MOUSEMOTION and self._drag_start is not None:
+            self._drag_end = self._screen_to_image_pos(e.pos, layout, clamp=True)
+        elif e.type == pygame.MOUSEBUTTONUP and e.button == 1 and self._drag_start is not None:
+            self._drag_end = self._screen_to_image_pos(e.pos, layout, clamp=True)
+            if self._drag_end is not None:
+                x, y, w, h = self._get_drag_rect()
+                if w >= 4 and h >= 4:  # otherwise it was probably just a click
+                    self.set_region((x, y, w, h))
+            self._drag_start = None
+            self._drag_end = None
+        elif e.type == pygame.MOUSEBUTTONDOWN and e.button == 3:
+            if self.state.simulation.get_region() is not None and self._screen_to_image_pos(e.pos, layout) is not None:
+                self.set_region(None)
 
     def handle_potential_ui_event(self, e):
         if e.type == pygame_gui.UI_DROP_DOWN_MENU_CHANGED:
             if "#deblur_blur_type" in e.ui_object_id:
-                self.state.get_deblur_settings().blur_type = e.text
-                self.state.simulation.reset(iter_count=True, img=False)
+                if e.text.lower() == blurs.CUSTOM_KERNEL:
+                    # don't switch until we actually have a kernel
+                    self.deblur_controls.set_selector_value("#deblur_blur_type", title_case(self.state.get_deblur_settings().blur_type))
+                    self.file_dialog_manager.prompt_for_image_to_load("#import_file_dialog_deblur_kernel",
+                                                                      window_title="Import Deblur Kernel (Image or .npy)")
+                else:
+                    self.state.get_deblur_settings().blur_type = e.text
+                    self.state.simulation.reset(iter_count=True, img=False)
             elif "#blur_blur_type" in e.ui_object_id:
-                self.state.get_blur_settings().blur_type = e.text
-                self.state.regenerate_target_image()
+                if e.text.lower() == blurs.CUSTOM_KERNEL:
+                    self.blur_controls.set_selector_value("#blur_blur_type", title_case(self.state.get_blur_settings().blur_type))
+                    self.file_dialog_manager.prompt_for_image_to_load("#import_file_dialog_blur_kernel",
+                                                                      window_title="Import Blur Kernel (Image or .npy)")
+                else:
+                    self.state.get_blur_settings().blur_type = e.text
+                    self.state.regenerate_target_image()
+            elif "#engine_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().engine = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=True)
+            elif "#color_mode_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().color_mode = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=True)
+            elif "#initial_guess_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().initial_guess = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=True)
+            elif "#warm_start_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().warm_start = e.text == BlurControlPanel.KEEP_GUESS
+            elif "#noise_type_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().noise_type = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=False)
+            elif "#active_set_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().active_set = e.text == BlurControlPanel.SKIP_CONVERGED_TILES
+            elif "#intensity_curve_selector" in e.ui_object_id:
+                self.state.get_simulation_settings().intensity_curve = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=False)
+            elif "#bp_type_selector" in e.ui_object_id:
+                self.state.get_deblur_settings().backpropagation_type = e.text.lower()
+                self.state.simulation.reset(iter_count=True, img=False)
             elif "#view_mode_selector" in e.ui_object_id:
                 self.state.view_mode = Modes.get_mode(e.text)
             elif "#original_image_selector" in e.ui_object_id:
@@ -917,7 +1453,7 @@ class MainWindow:
                     self.file_dialog_manager.prompt_for_image_to_load(f"#import_file_dialog_original_image",
                                                                       window_title=f"Import Original Image")
                 elif e.text in self.state.original_presets:
-                    self.state.set_original_image(self.state.original_presets[e.text], e.text)
+                    self.state.select_original_preset(e.text)
                 else:
                     self.state.set_original_image(None)
                 self.top_toolbar.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
@@ -927,13 +1463,18 @@ class MainWindow:
                     self.file_dialog_manager.prompt_for_image_to_load(f"#import_file_dialog_blurred_image",
                                                                       window_title=f"Import Blurred Image")
                 elif e.text in self.state.blurred_presets:
-                    self.state.set_target_image(self.state.blurred_presets[e.text], e.text)
+                    self.state.select_target_preset(e.text)
                 elif e.text == TopControlPanel.USE_ORIG:
                     self.state.set_target_image(None)
                     self.state.regenerate_target_image()
                 self.top_toolbar.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
             elif "#export_selector" in e.ui_object_id:
-                if e.text != TopControlPanel.EXPORT:
+                if e.text == TopControlPanel.ANIMATION and self.state.is_recording():
+                    # picking it again stops the recording early
+                    print("INFO: stopping the recording...")
+                    self.top_toolbar.set_selector_value("#export_selector", TopControlPanel.EXPORT)
+                    self.state.stop_recording()
+                elif e.text != TopControlPanel.EXPORT:
                     print(f"INFO: exporting {e.text}...")
                     self.top_toolbar.set_selector_value("#export_selector", TopControlPanel.EXPORT)
                     self.file_dialog_manager.prompt_for_export_dest(f"#export_file_dialog_{clean_for_obj_id(e.text)}",
@@ -958,6 +1499,16 @@ class MainWindow:
             elif "#simulation_iteration_limit" in e.ui_object_id:
                 if int(e.value) != self.state.get_simulation_settings().iteration_limit:
                     self.state.get_simulation_settings().iteration_limit = int(e.value)
+            elif "#regularization_slider" in e.ui_object_id:
+                regularization = 10 ** (int(e.value) / 10 - 4)
+                if regularization != self.state.get_simulation_settings().regularization:
+                    sim_settings = self.state.get_simulation_settings()
+                    sim_settings.regularization = regularization
+                    # it's only used by the deconvolution initial guesses & the half-res chroma
+                    if sim_settings.initial_guess != deblur.BLURRED:
+                        self.state.simulation.reset(iter_count=True, img=True)
+                    elif sim_settings.color_mode == deblur.LUMINANCE_HALF_CHROMA:
+                        self.state.simulation.reset(iter_count=True, img=False)
             elif "#bp_blur_strength_slider" in e.ui_object_id:
                 if int(e.value) != int(self.state.get_deblur_settings().backpropagation_blur_strength * 100):
                     self.state.get_deblur_settings().backpropagation_blur_strength = e.value / 100.0
@@ -981,8 +1532,14 @@ class MainWindow:
             print(f"INFO: path picked: {e.text}")
             if "#export_file_dialog" in self.file_dialog_manager.object_id:
                 img_to_save = None
+                is_animation = clean_for_obj_id(TopControlPanel.ANIMATION) in self.file_dialog_manager.object_id
+                high_bit_depth = False
                 filename = "image"
-                if clean_for_obj_id(TopControlPanel.BLURRED_IMAGE) in self.file_dialog_manager.object_id:
+                ext = ".png"
+                if is_animation:
+                    filename = "convergence"
+                    ext = ".gif" if recorder.is_gif_supported() else ".mp4"
+                elif clean_for_obj_id(TopControlPanel.BLURRED_IMAGE) in self.file_dialog_manager.object_id:
                     img_to_save = self.state.simulation.get_blurred_output_image()
                     filename = "blurred"
                 elif clean_for_obj_id(TopControlPanel.ERROR_IMAGE) in self.file_dialog_manager.object_id:
@@ -991,30 +1548,46 @@ class MainWindow:
                 elif clean_for_obj_id(TopControlPanel.DEBLURRED_IMAGE) in self.file_dialog_manager.object_id:
                     img_to_save = self.state.simulation.get_output_image()
                     filename = "deblurred"
+                    if self.state.is_high_bit_depth() and isinstance(self.state.simulation, deblur.AbstractIterativeGhastDeblurrer):
+                        # 16-bit in, 16-bit out (if it's saved as a PNG or TIFF). The separate-process simulation
+                        # only shares 8-bit frames though.
+                        img_to_save = self.state.simulation.get_output_px()
+                        high_bit_depth = True
 
-                if img_to_save is not None:
+                if img_to_save is not None or is_animation:
                     if os.path.isdir(e.text):
                         # if they selected a directory, generate a filename
-                        filepath = os.path.join(e.text, filename + ".png")
+                        filepath = os.path.join(e.text, filename + ext)
                         i = 1
                         while os.path.isfile(filepath):
-                            filepath = os.path.join(e.text, filename + f"_{i}.png")
+                            filepath = os.path.join(e.text, filename + f"_{i}{ext}")
                             i += 1
                     else:
                         filepath = e.text
+                        if os.path.splitext(filepath)[1] == "":
+                            filepath += ext  # the format's picked by the extension, so there has to be one
 
                     just_filename = os.path.split(filepath)[1]
 
-                    def export_action():
-                        try:
-                            pygame.image.save(img_to_save, filepath)
-                            print(f"INFO: saved image to {filepath}")
+                    def on_saved(success):
+                        self.file_dialog_manager.clear_progress()
+                        if success:
                             self.file_dialog_manager.show_message(f"Saved {just_filename}")
-                        except pygame.error:
-                            print(f"ERROR: failed to export image to: {filepath}")
-                            traceback.print_exc()
+                        else:
                             self.file_dialog_manager.show_message(f"Failed to save {just_filename}")
 
+                    def export_action():
+                        if is_animation:
+                            try:
+                                self.state.start_recording(filepath, on_done=on_saved)
+                                print(f"INFO: recording to {filepath} until the simulation finishes "
+                                      f"(or pick {TopControlPanel.ANIMATION} again to stop)")
+                            except ValueError as err:
+                                self.file_dialog_manager.show_message(str(err))
+                        else:
+                            self.file_dialog_manager.show_progress(f"Saving {just_filename}...")
+                            self.state.export_image(img_to_save, filepath, on_done=on_saved, high_bit_depth=high_bit_depth)
+
                     if os.path.isfile(filepath):
                         # ask if we want to overwrite
                         self.file_dialog_manager.show_confirm_prompt(f"The selected file already exists. Overwrite {just_filename}?",
@@ -1022,23 +1595,52 @@ class MainWindow:
                     else:
                         export_action()
 
-            elif "#import_file_dialog" in self.file_dialog_manager.object_id:
+            elif "#import_file_dialog" in self.file_dialog_manager.object_id and \
+                    "_kernel" in self.file_dialog_manager.object_id:
+                is_deblur = "deblur_kernel" in self.file_dialog_manager.object_id
                 try:
-                    imported_img = pygame.image.load(e.text)
-                    did_load = False
-                    if "blurred_image" in self.file_dialog_manager.object_id:
-                        self.state.set_target_image(imported_img, e.text)
-                        did_load = True
-                    elif "original_image" in self.file_dialog_manager.object_id:
-                        self.state.set_original_image(imported_img, e.text)
-                        did_load = True
-
-                    if did_load:
-                        self.top_toolbar.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
-                except pygame.error:
-                    print(f"ERROR: failed to import image: {e.text}")
+                    kernel = blurs.load_kernel(e.text)
+                    blur_settings = self.state.get_deblur_settings() if is_deblur else self.state.get_blur_settings()
+                    blur_settings.blur_type = blurs.CUSTOM_KERNEL
+                    blur_settings.bonus_params["kernel_path"] = e.text
+                    blur_settings.radius = min(blurs.get_kernel_radius(kernel), blur_settings.max_radius)
+
+                    controls = self.deblur_controls if is_deblur else self.blur_controls
+                    obj_id = "#deblur_blur_type" if is_deblur else "#blur_blur_type"
+                    controls.set_selector_value(obj_id, title_case(blurs.CUSTOM_KERNEL))
+                    controls.radius_slider.set_current_value(blur_settings.radius)
+
+                    if is_deblur:
+                        self.state.simulation.reset(iter_count=True, img=False)
+                    else:
+                        self.state.regenerate_target_image()
+                except (ValueError, IOError):
+                    print(f"ERROR: failed to import kernel: {e.text}")
                     traceback.print_exc()
-                    self.file_dialog_manager.show_message(f"Failed to import {e.text}")
+                    self.file_dialog_manager.show_message(f"Failed to import kernel {e.text}")
+                self.file_dialog_manager.object_id = ""
+            elif "#import_file_dialog" in self.file_dialog_manager.object_id:
+                filepath = e.text
+                just_filename = os.path.split(filepath)[1]
+
+                def on_loaded(success):
+                    self.file_dialog_manager.clear_progress()
+                    if success:
+                        self.top_toolbar.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
+                    else:
+                        self.file_dialog_manager.show_message(f"Failed to import {filepath}")
+
+                did_start = False
+                if "blurred_image" in self.file_dialog_manager.object_id:
+                    self.state.import_target_image(filepath, on_done=on_loaded)
+                    did_start = True
+                elif "original_image" in self.file_dialog_manager.object_id:
+                    self.state.import_original_image(filepath, on_done=on_loaded)
+                    did_start = True
+
+                if did_start:
+                    self.file_dialog_manager.show_progress(f"Importing {just_filename}...")
+                    self.top_toolbar.update_preset_selectors(self.state.original_image_file, self.state.target_image_file)
                 self.file_dialog_manager.object_id = ""
         elif e.type == pygame_gui.UI_CONFIRMATION_DIALOG_CONFIRMED:
             if "#overwrite_file_confirmation" in e.ui_object_id:
@@ -1061,19 +1663,28 @@ class MainWindow:
             self.init_display()
 
         self._clock = pygame.time.Clock()
+        self.startup_timer.mark("display")
 
         self._ui_manager = pygame_gui.UIManager(self._base_size)
         self._ui_manager.add_font_paths("emoji", resource_path("assets/fonts/NotoEmoji-Regular.ttf"))
         self._ui_manager.preload_fonts([{'name': 'emoji', 'point_size': 14, 'style': 'regular'}])
+        self.startup_timer.mark("fonts")
 
         self._ui_manager.get_theme().load_theme(resource_path("assets/themes/theme.json"))
+        self.startup_timer.mark("theme")
 
         dummy = pygame.Rect(0, 0, 200, 200)
         self.top_toolbar = TopControlPanel(dummy, self._ui_manager, self.state)
-        self.simulation_controls = SimulationControlPanel(dummy, self._ui_manager, self.state)
-        self.blur_controls = BlurControlPanel(dummy, self._ui_manager, self.state)
-        self.deblur_controls = BlurControlPanel(dummy, self._ui_manager, self.state, deblur=True)
         self.file_dialog_manager = FileDialogManager(self._ui_manager, starting_path="userdata/")
+        self.startup_timer.mark("toolbar")
+
+        # the other panels take a while to build, so they're built one per frame after the first one's shown
+        self._pending_panels = {
+            "blur_controls": ViewItems.BLUR_CONTROLS,
+            "simulation_controls": ViewItems.SIMULATION_CONTROLS,
+            "deblur_controls": ViewItems.DEBLUR_CONTROLS
+        }
+        first_frame = True
 
         running = True
         while running:
@@ -1119,6 +1730,12 @@ class MainWindow:
                         print(f"INFO: integer upscaling only set to {self.state.integer_upscale} [toggle with I]")
                     elif e.key == pygame.K_SPACE:
                         self.state.simulation.step()
+                    elif e.key == pygame.K_f:
+                        print("INFO: deblurring the full image [press F]")
+                        self.set_region(None)
+                        self.state.autoplay = True
+                elif e.type in (pygame.MOUSEBUTTONDOWN, pygame.MOUSEBUTTONUP, pygame.MOUSEMOTION):
+                    self.handle_mouse_event(e)
                 else:
                     self.handle_potential_ui_event(e)
 
@@ -1131,36 +1748,39 @@ class MainWindow:
 
             pygame.display.flip()
 
-
-def load_presets(path):
-    res = {}
-    try:
-        for f in os.listdir(path):
-            fullpath = os.path.join(path, f)
-            if os.path.isfile(fullpath):
-                if fullpath.endswith(".jpg") or fullpath.endswith(".png"):
-                    try:
-                        img = pygame.image.load(fullpath)
-                        res[f] = img
-                    except:
-                        print(f"ERROR: failed to load preset image: {fullpath}")
-                        traceback.print_exc()
-    except IOError:
-        traceback.print_exc()
-    return res
-
-
-def launch_app():
-    blurred_presets = load_presets("presets/blurred")
-    normal_presets = load_presets("presets/normal")
-
-    state = State(original_presets=normal_presets, blurred_presets=blurred_presets)
-    win = MainWindow(state=state)
+            if first_frame:
+                self.startup_timer.mark("first frame")
+                print(f"INFO: {self.startup_timer.report('first frame')}")
+                first_frame = False
+            elif len(self._pending_panels) > 0:
+                self._build_next_panel(layout)
+                if len(self._pending_panels) == 0:
+                    cv2_ms = lazy_import.cv2.load_ms
+                    print(f"INFO: {self.startup_timer.report('all controls ready')}" +
+                          (f", cv2 took {cv2_ms:.0f}ms to import" if cv2_ms is not None else ""))
+
+        self.state.close_recordings()
+        self.state.simulation.close()
+
+
+def launch_app(separate_process=False, start_time=None):
+    startup_timer = StartupTimer(start_time)
+    startup_timer.mark("imports")
+
+    # presets are only indexed here, they get decoded in the background when they're first selected
+    blurred_presets = presets.PresetLibrary("presets/blurred")
+    normal_presets = presets.PresetLibrary("presets/normal")
+    blurred_presets.prepare_thumbnails()
+    normal_presets.prepare_thumbnails()
+
+    state = State(original_presets=normal_presets, blurred_presets=blurred_presets, separate_process=separate_process)
+    startup_timer.mark("state")
+    win = MainWindow(state=state, startup_timer=startup_timer)
     win.init_display()
 
     # i do like the parrot
     if "parrot.jpg" in normal_presets:
-        win.state.set_original_image(normal_presets["parrot.jpg"], "parrot.jpg")
+        win.state.select_original_preset("parrot.jpg")
 
     win.state.simulation.deblur_settings.blur_type = "gaussian"
     win.state.simulation.deblur_settings.radius = 15